@@ -0,0 +1,207 @@
+"""
+Multi-process test of the leader lease and the shared queues.
+
+Starts the fake Telegram API and several webhook server processes sharing
+one Mongo database, then checks that:
+
+- exactly one process is the leader and only it registered the webhook
+- every /github delivery, whichever process took it, is sent once
+- a Telegram update posted to a process that is not the leader is handed
+  over and answered
+- with --failover, killing the leader hands its duties to another process
+
+Needs a reachable Mongo server, configured like the bot (MONGO_SERVER,
+MONGODB_PORT, MONGO_USERNAME, MONGO_PASSWORD); a throwaway database is
+created and dropped:
+
+    python benchmarks/cluster.py --nodes 3 --requests 300 --failover
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import signal
+import subprocess
+import sys
+import time
+import urllib.request
+import uuid
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+GWHTB = os.path.join(HERE, "..", "gwhtb")
+sys.path.insert(0, GWHTB)
+sys.path.insert(0, HERE)
+
+from load import IDENTITY, SECRET, drive, free_port  # noqa: E402
+from payloads import push_payload  # noqa: E402
+
+LEASE = 3
+
+
+def get_json(url):
+    with urllib.request.urlopen(url, timeout=5) as response:
+        return json.loads(response.read())
+
+
+def post_json(url, data):
+    request = urllib.request.Request(
+        url,
+        data=json.dumps(data).encode("utf-8"),
+        headers={"Content-Type": "application/json"},
+    )
+    with urllib.request.urlopen(request, timeout=5) as response:
+        return response.status
+
+
+def wait_for(check, timeout, what):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            if check():
+                return
+        except OSError:
+            pass
+        time.sleep(0.2)
+    raise AssertionError(f"timed out waiting for {what}")
+
+
+def start_nodes(count, env):
+    nodes = {}
+    for _ in range(count):
+        port = free_port()
+        command = [sys.executable, "-m", "uvicorn", "main:create_app", "--factory"]
+        command += ["--app-dir", GWHTB, "--port", str(port), "--log-level", "warning"]
+        nodes[port] = subprocess.Popen(command, env=env)
+    for port in nodes:
+        wait_for(
+            lambda: get_json(f"http://127.0.0.1:{port}/health/leader") is not None,
+            30,
+            f"node on port {port}",
+        )
+    return nodes
+
+
+def leaders(nodes):
+    return [
+        port
+        for port in nodes
+        if get_json(f"http://127.0.0.1:{port}/health/leader")["leader"]
+    ]
+
+
+def sent(telegram_port, method="sendMessage"):
+    return get_json(f"http://127.0.0.1:{telegram_port}/stats")["calls"].get(method, 0)
+
+
+async def spread(ports, requests, deliveries):
+    """Drive `requests` deliveries spread evenly over the nodes"""
+    share = requests // len(ports)
+    reports = await asyncio.gather(
+        *[
+            drive(f"http://127.0.0.1:{port}", IDENTITY, SECRET, share, 10, deliveries)
+            for port in ports
+        ]
+    )
+    return share * len(ports), reports
+
+
+def seed(database):
+    os.environ["MONGO_INITDB_DATABASE"] = database
+    import db  # pylint: disable=import-outside-toplevel
+
+    db.global_init()
+    user = db.User(telegram_id="1")
+    user.save()
+    db.Secret(identity=IDENTITY, secret=SECRET, chat_id="1", user=user).save()
+    return db
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--nodes", type=int, default=3)
+    parser.add_argument("--requests", type=int, default=300)
+    parser.add_argument("--failover", action="store_true")
+    args = parser.parse_args()
+
+    database = f"gwhtb_cluster_{uuid.uuid4().hex[:8]}"
+    db = seed(database)
+    telegram_port = free_port()
+    env = dict(
+        os.environ,
+        TOKEN="1:cluster",
+        URL="http://127.0.0.1",
+        TELEGRAM_BASE_URL=f"http://127.0.0.1:{telegram_port}/bot",
+        TELEGRAM_HTTP_VERSION="1.1",
+        DB_BACKEND="mongo",
+        DELIVERY_BACKEND="mongo",
+        MONGO_INITDB_DATABASE=database,
+        LEADER_LEASE=str(LEASE),
+        DELIVERY_POLL_INTERVAL="0.1",
+        RATELIMIT_GLOBAL="10000",
+        RATELIMIT_PRIVATE="10000",
+        LOG_LEVEL="WARNING",
+    )
+    fake = subprocess.Popen(
+        [sys.executable, os.path.join(HERE, "fake_telegram.py")]
+        + ["--port", str(telegram_port), "--latency", "0.01"]
+    )
+    nodes = {}
+    try:
+        wait_for(
+            lambda: get_json(f"http://127.0.0.1:{telegram_port}/stats"), 10, "fake"
+        )
+        nodes = start_nodes(args.nodes, env)
+        wait_for(lambda: len(leaders(nodes)) == 1, LEASE * 2, "a leader")
+        leader = leaders(nodes)[0]
+        assert sent(telegram_port, "setWebhook") == 1, "webhook set more than once"
+
+        deliveries = [("push", json.dumps(push_payload()).encode("utf-8"))]
+        expected, reports = asyncio.run(spread(list(nodes), args.requests, deliveries))
+        follower = next(port for port in nodes if port != leader)
+        post_json(
+            f"http://127.0.0.1:{follower}/telegram",
+            {
+                "update_id": 1,
+                "message": {
+                    "message_id": 1,
+                    "date": int(time.time()),
+                    "chat": {"id": 1, "type": "private"},
+                    "from": {"id": 1, "is_bot": False, "first_name": "a"},
+                    "text": "/start",
+                    "entities": [{"type": "bot_command", "offset": 0, "length": 6}],
+                },
+            },
+        )
+        expected += 1
+        wait_for(lambda: sent(telegram_port) >= expected, 60, "every message")
+        result = {
+            "nodes": args.nodes,
+            "leader": leader,
+            "requests_per_s": round(sum(r["requests_per_s"] for r in reports), 1),
+            "sent": sent(telegram_port),
+        }
+
+        if args.failover:
+            nodes.pop(leader).send_signal(signal.SIGKILL)
+            start = time.monotonic()
+            wait_for(lambda: len(leaders(nodes)) == 1, LEASE * 4, "a new leader")
+            result["failover_s"] = round(time.monotonic() - start, 2)
+            assert sent(telegram_port, "setWebhook") == 2, "webhook not set again"
+            more, _ = asyncio.run(spread(list(nodes), args.requests, deliveries))
+            expected += more
+            wait_for(lambda: sent(telegram_port) >= expected, 60, "every message")
+            result["sent"] = sent(telegram_port)
+
+        time.sleep(1)
+        assert sent(telegram_port) == expected, f"sent {sent(telegram_port)}"
+        print(json.dumps(result, indent=2))
+    finally:
+        for process in list(nodes.values()) + [fake]:
+            process.terminate()
+            process.wait()
+        db.User._get_db().client.drop_database(database)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,113 @@
+"""
+Local stand-in for the Telegram Bot API.
+
+Answers every bot method with a plausible result after an injectable
+latency, rejects a share of the calls with 429 if asked to, and rejects
+messages over Telegram's 4096 character limit with 400.
+
+    python benchmarks/fake_telegram.py --port 8081 --latency 0.05
+    TELEGRAM_BASE_URL=http://127.0.0.1:8081/bot python gwhtb/main.py
+"""
+
+import argparse
+import asyncio
+import collections
+import json
+import random
+import time
+from urllib.parse import parse_qs
+
+import uvicorn
+from starlette.applications import Starlette
+from starlette.requests import Request
+from starlette.responses import JSONResponse
+from starlette.routing import Route
+
+
+class FakeTelegram(object):
+    """
+    :param latency: seconds every call takes
+    :param error_rate: share of `sendMessage` calls answered with a 429
+    :param retry_after: `retry_after` sent with the 429s
+    """
+
+    def __init__(self, latency=0.0, error_rate=0.0, retry_after=1):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.retry_after = retry_after
+        self.calls = collections.Counter()
+        self.rejected = 0
+        self.messages = []
+        self.app = Starlette(
+            routes=[
+                Route("/bot{token}/{method}", self.method, methods=["GET", "POST"]),
+                Route("/stats", self.stats, methods=["GET"]),
+            ]
+        )
+
+    async def _params(self, request: Request) -> dict:
+        body = await request.body()
+        if request.headers.get("content-type", "").startswith("application/json"):
+            return json.loads(body)
+        return {key: values[0] for key, values in parse_qs(body.decode()).items()}
+
+    def _result(self, method, params):
+        if method == "getMe":
+            return {
+                "id": 1,
+                "is_bot": True,
+                "first_name": "bench",
+                "username": "bench_bot",
+            }
+        if method in ("sendMessage", "editMessageText"):
+            self.messages.append(params)
+            chat_id = int(params.get("chat_id", 0))
+            return {
+                "message_id": len(self.messages),
+                "date": int(time.time()),
+                "chat": {"id": chat_id, "type": "group" if chat_id < 0 else "private"},
+                "text": params.get("text", ""),
+            }
+        return True
+
+    async def method(self, request: Request):
+        method = request.path_params["method"]
+        params = await self._params(request)
+        self.calls[method] += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        if method == "sendMessage" and random.random() < self.error_rate:
+            self.rejected += 1
+            return JSONResponse(
+                {
+                    "ok": False,
+                    "error_code": 429,
+                    "description": f"Too Many Requests: retry after {self.retry_after}",
+                    "parameters": {"retry_after": self.retry_after},
+                },
+                status_code=429,
+            )
+        if len(params.get("text", "").encode("utf-16-le")) // 2 > 4096:
+            self.rejected += 1
+            return JSONResponse(
+                {
+                    "ok": False,
+                    "error_code": 400,
+                    "description": "Bad Request: message is too long",
+                },
+                status_code=400,
+            )
+        return JSONResponse({"ok": True, "result": self._result(method, params)})
+
+    async def stats(self, request: Request):
+        return JSONResponse({"calls": dict(self.calls), "rejected": self.rejected})
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--port", type=int, default=8081)
+    parser.add_argument("--latency", type=float, default=0.0)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    args = parser.parse_args()
+    fake = FakeTelegram(latency=args.latency, error_rate=args.error_rate)
+    uvicorn.run(fake.app, port=args.port, log_level="warning")
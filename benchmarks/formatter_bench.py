@@ -0,0 +1,175 @@
+"""
+Micro-benchmark of event formatting.
+
+Compares the compiled formatter with the previous implementation, kept
+below as `legacy_*`: `str.format` on every call, 18 `str.replace` passes
+per escaped field and every event formatted twice. The legacy templates
+did not escape their fields at all, so the compiled path does more work
+for those events. Pushes now list at most `PUSH_MAX_COMMITS` commits and
+are split into messages that fit Telegram's limit; the legacy output for
+1000 commits was one message Telegram would have rejected. The template
+cases render a secret's own template, looked up the way /github does,
+once for the same event and once for events that never repeat a value.
+
+    python benchmarks/formatter_bench.py
+"""
+
+import itertools
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "gwhtb"))
+
+import templates  # pylint: disable=wrong-import-position
+import webhook  # pylint: disable=wrong-import-position
+
+LEGACY_CHARS = "_*[]()~`>#+-=|{}.!"
+
+
+def legacy_escape(text):
+    for char in LEGACY_CHARS:
+        text = text.replace(char, rf"\{char}")
+    return text
+
+
+def legacy_push(data):
+    header = (
+        f"In repo:\n[{legacy_escape(data['repository']['full_name'])}]"
+        f"({legacy_escape(data['repository']['html_url'])}) \n"
+        f"[{legacy_escape(data['head_commit']['committer']['name'])}]"
+        f"({legacy_escape(data['sender']['html_url'])}) "
+        f"*pushed* [{legacy_escape(data['ref'])}]"
+        f"({legacy_escape(data['head_commit']['url'])})\n\n"
+    )
+    return header + "\n\n".join(
+        [
+            f"_*commit message*_: \n`{legacy_escape(commit['message'])}`"
+            for commit in data["commits"]
+        ]
+    )
+
+
+def legacy_format(event_type, data, source=None):
+    try:
+        if source is not None:
+            return source.format(**data)
+        if event_type in webhook.EVENT_DESCRIPTIONS:
+            return webhook.EVENT_DESCRIPTIONS[event_type].format(**data)
+        return legacy_push(data)
+    except KeyError:
+        return event_type
+
+
+def push(commits):
+    return {
+        "ref": "refs/heads/main",
+        "repository": {
+            "full_name": "bench/mono-repo",
+            "html_url": "https://github.com/bench/mono-repo",
+        },
+        "sender": {"login": "bench", "html_url": "https://github.com/bench"},
+        "head_commit": {
+            "committer": {"name": "Bench Marker"},
+            "url": "https://github.com/bench/mono-repo/commit/0a1b2c",
+        },
+        "commits": [
+            {"message": f"fix(core): handle edge-case #{n} [skip ci]\n\n* details."}
+            for n in range(commits)
+        ],
+    }
+
+
+PULL_REQUEST = {
+    "action": "opened",
+    "sender": {"login": "octo-cat"},
+    "pull_request": {"number": 1347},
+    "repository": {"full_name": "bench/mono-repo"},
+}
+
+WORKFLOW_RUN = {
+    "action": "completed",
+    "workflow_run": {
+        "name": "CI",
+        "run_number": 4711,
+        "conclusion": "failure",
+        "head_branch": "main",
+    },
+    "repository": {"full_name": "bench/mono-repo"},
+}
+
+PULL_REQUEST_TEMPLATE = "PR #{pull_request[number]} {action} by {sender[login]}"
+
+
+def distinct(count):
+    """`count` pull request events, no two with the same number or sender"""
+    return [
+        {
+            **PULL_REQUEST,
+            "sender": {"login": f"octo-cat-{n}"},
+            "pull_request": {"number": n},
+        }
+        for n in range(count)
+    ]
+
+
+# (name, event type, payload, iterations, template of the secret)
+CASES = [
+    ("push, 1000 commits", "push", push(1000), 20, None),
+    ("push, 3 commits", "push", push(3), 20000, None),
+    ("pull_request", "pull_request", PULL_REQUEST, 50000, None),
+    (
+        "pull_request, template",
+        "pull_request",
+        PULL_REQUEST,
+        50000,
+        PULL_REQUEST_TEMPLATE,
+    ),
+    (
+        "template, new values",
+        "pull_request",
+        distinct(50000),
+        50000,
+        PULL_REQUEST_TEMPLATE,
+    ),
+    ("workflow_run", "workflow_run", WORKFLOW_RUN, 50000, None),
+]
+
+
+def best(func, number, repeat=5):
+    """Fastest of `repeat` runs, the others measure whatever else ran meanwhile"""
+    return min(timeit.repeat(func, number=number, repeat=repeat))
+
+
+def main():
+    print(f"{'case':<24}{'legacy us':>12}{'compiled us':>14}{'speedup':>10}")
+    for name, event_type, payloads, number, source in CASES:
+        secret_templates = templates.Templates(
+            [(event_type, source)] if source is not None else ()
+        )
+        if isinstance(payloads, dict):
+            payloads = [payloads]
+        events = itertools.cycle(payloads)
+
+        def run_legacy():
+            data = next(events)
+            # the legacy path formatted every event twice, once for the log line
+            legacy_format(event_type, data, source)
+            legacy_format(event_type, data, source)
+
+        def run_compiled():
+            data = next(events)
+            webhook.format_messages(
+                event_type, data, secret_templates.template(event_type, data)
+            )
+
+        legacy = best(run_legacy, number)
+        compiled = best(run_compiled, number)
+        print(
+            f"{name:<24}{legacy / number * 1e6:>12.1f}"
+            f"{compiled / number * 1e6:>14.1f}{legacy / compiled:>9.1f}x"
+        )
+
+
+if __name__ == "__main__":
+    main()
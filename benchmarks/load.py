@@ -0,0 +1,359 @@
+"""
+Load benchmark for the /github endpoint.
+
+Without --url the webhook server is started in this process with the
+in-memory database and delivery backends, against a local stand-in for the
+Telegram API, so it runs offline:
+
+    python benchmarks/load.py --requests 2000 --concurrency 50
+
+Throughput, p50/p99 latency and status codes are reported, in process
+also the resident memory, the calls made to the database and delivery
+backends and the Bot API calls the stand-in received.
+
+--events sends a round-robin mix of event types (`all` for every type the
+bot formats, see payloads.py), --huge-push-files adds a push of 5000
+commits touching that many files each, --replay sends a mix recorded
+with payloads.py instead. Every request carries its own delivery id.
+
+--invalid-signature signs every request with a wrong secret to measure
+how cheaply a flood of forged deliveries is turned away, --payload-mb
+pads the push payload, e.g. to GitHub's 25 MB cap, --targets fans every
+delivery out to that many chats. --latency and --error-rate shape the
+Bot API stand-in, --db mongomock runs the Mongo backends against
+mongomock instead of the in-memory ones (its `bulk_write` predates
+pymongo 4.9, so the `last_invoked` flush logs errors there) and --drain
+waits for the queued sends after the last request. Sends are paced by
+the real Telegram limits, raise RATELIMIT_* to measure delivery speed.
+
+With --url an already running server is driven instead, e.g. an older
+revision to compare against:
+
+    python benchmarks/load.py --url http://127.0.0.1:4560 --identity ID --secret SECRET
+"""
+
+import argparse
+import asyncio
+import hashlib
+import hmac
+import json
+import logging
+import os
+import resource
+import socket
+import statistics
+import sys
+import threading
+import time
+import uuid
+from collections import Counter
+from urllib.parse import urlsplit
+
+import uvicorn
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, "..", "gwhtb"))
+sys.path.insert(0, HERE)
+
+import payloads  # pylint: disable=wrong-import-position
+
+IDENTITY = "bench-identity"
+SECRET = "bench-secret"
+
+
+def signed(body: bytes, secret: str, event_type="push") -> dict:
+    digest = hmac.new(secret.encode("utf-8"), body, hashlib.sha256).hexdigest()
+    return {
+        "Content-Type": "application/json",
+        "X-Github-Event": event_type,
+        "X-Hub-Signature-256": f"sha256={digest}",
+    }
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def percentile(values, q):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * q))]
+
+
+async def post(reader, writer, host, path, headers, body):
+    """Minimal keep-alive HTTP/1.1 POST, so the load generator stays cheap"""
+    head = [f"POST {path} HTTP/1.1", f"Host: {host}", f"Content-Length: {len(body)}"]
+    head += [f"{key}: {value}" for key, value in headers.items()]
+    writer.write(("\r\n".join(head) + "\r\n\r\n").encode("latin-1") + body)
+    status = int((await reader.readline()).split()[1])
+    length = 0
+    while True:
+        line = await reader.readline()
+        if line in (b"\r\n", b""):
+            break
+        key, _, value = line.decode("latin-1").partition(":")
+        if key.lower() == "content-length":
+            length = int(value)
+    await reader.readexactly(length)
+    return status
+
+
+async def drive(url, identity, secret, requests, concurrency, deliveries):
+    """
+    Send `requests` deliveries round-robin from `deliveries`, a list of
+    `(event_type, body)`, over `concurrency` keep-alive connections.
+    """
+    prepared = [
+        (event_type, signed(body, secret, event_type), body)
+        for event_type, body in deliveries
+    ]
+    run = uuid.uuid4().hex[:12]
+    host, _, port = urlsplit(url).netloc.partition(":")
+    path = f"/github?identity={identity}"
+    latencies, statuses, by_event = [], Counter(), {}
+    pending = iter(range(requests))
+
+    async def client_loop():
+        reader, writer = await asyncio.open_connection(host, int(port or 80))
+        try:
+            for n in pending:
+                event_type, headers, body = prepared[n % len(prepared)]
+                headers = dict(headers, **{"X-GitHub-Delivery": f"{run}-{n}"})
+                start = time.perf_counter()
+                status = await post(reader, writer, host, path, headers, body)
+                latencies.append(time.perf_counter() - start)
+                statuses[status] += 1
+                by_event.setdefault(event_type, Counter())[status] += 1
+        finally:
+            writer.close()
+
+    start = time.perf_counter()
+    await asyncio.gather(*[client_loop() for _ in range(concurrency)])
+    elapsed = time.perf_counter() - start
+
+    report = {
+        "requests": requests,
+        "concurrency": concurrency,
+        "requests_per_s": round(requests / elapsed, 1),
+        "p50_ms": round(statistics.median(latencies) * 1000, 2),
+        "p99_ms": round(percentile(latencies, 0.99) * 1000, 2),
+        "statuses": dict(statuses),
+    }
+    if len(by_event) > 1:
+        report["statuses_by_event"] = {
+            event_type: dict(counts) for event_type, counts in sorted(by_event.items())
+        }
+    return report
+
+
+def rss_mb() -> float:
+    """Resident memory of this process, 0 where /proc is missing"""
+    try:
+        with open("/proc/self/statm", encoding="ascii") as statm:
+            pages = int(statm.read().split()[1])
+    except OSError:
+        return 0.0
+    return round(pages * os.sysconf("SC_PAGE_SIZE") / 2**20, 1)
+
+
+def peak_rss_mb() -> float:
+    # kilobytes on Linux
+    return round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+
+
+def count_calls(owner, names, counter, prefix):
+    """
+    Count calls of the methods `names` of `owner`, an instance or a class.
+    Calls the methods make to each other, e.g. `put_many` to `put`, are not
+    counted again.
+    """
+    nested = threading.local()
+    for name in names:
+        method = getattr(owner, name)
+
+        def counted(*args, _method=method, _key=f"{prefix}.{name}", **kwargs):
+            if getattr(nested, "depth", 0):
+                return _method(*args, **kwargs)
+            counter[_key] += 1
+            nested.depth = 1
+            try:
+                return _method(*args, **kwargs)
+            finally:
+                nested.depth = 0
+
+        setattr(owner, name, counted)
+
+
+REPOSITORY_CALLS = (
+    "get_secret",
+    "get_user",
+    "secrets_page",
+    "insert",
+    "save",
+    "delete",
+    "touch",
+    "claim_delivery",
+    "flush",
+)
+QUEUE_CALLS = ("put", "put_many", "claim", "ack", "retry", "bury")
+
+
+async def serve(app, port):
+    server = uvicorn.Server(
+        uvicorn.Config(app=app, port=port, log_level="warning", lifespan="on")
+    )
+    task = asyncio.create_task(server.serve())
+    while not server.started:
+        await asyncio.sleep(0.01)
+    return server, task
+
+
+async def drain(fake, timeout, quiet=1.5):
+    """Wait up to `timeout` seconds until the stand-in got no call for `quiet`"""
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + timeout
+    seen = -1
+    while loop.time() < deadline and sum(fake.calls.values()) != seen:
+        seen = sum(fake.calls.values())
+        await asyncio.sleep(quiet)
+
+
+def use_mongomock():
+    """Point the `core` connection at mongomock before anything connects"""
+    import mongoengine  # pylint: disable=import-outside-toplevel
+
+    try:
+        import mongomock  # pylint: disable=import-outside-toplevel
+    except ImportError:
+        raise SystemExit("--db mongomock needs `pip install mongomock`") from None
+    mongoengine.connect(
+        db="bench",
+        alias="core",
+        host="mongodb://localhost",
+        mongo_client_class=mongomock.MongoClient,
+    )
+    # cached, so `db.global_init` registering the real server changes nothing
+    mongoengine.get_connection("core")
+
+
+async def in_process(args, deliveries):
+    """Run the webhook server and the fake Telegram API in this process"""
+    from fake_telegram import FakeTelegram  # pylint: disable=import-outside-toplevel
+
+    backend = "mongo" if args.db == "mongomock" else "memory"
+    telegram_port, app_port = free_port(), free_port()
+    os.environ.update(
+        {
+            "TOKEN": "1:bench",
+            "URL": f"http://127.0.0.1:{app_port}",
+            "TELEGRAM_BASE_URL": f"http://127.0.0.1:{telegram_port}/bot",
+            "TELEGRAM_HTTP_VERSION": "1.1",
+            "DB_BACKEND": backend,
+            "DELIVERY_BACKEND": backend,
+        }
+    )
+    if args.db == "mongomock":
+        use_mongomock()
+    import db  # pylint: disable=import-outside-toplevel
+    import delivery  # pylint: disable=import-outside-toplevel
+    import main  # pylint: disable=import-outside-toplevel
+
+    logging.getLogger().setLevel(logging.WARNING)
+
+    fake = FakeTelegram(latency=args.latency, error_rate=args.error_rate)
+    user = db.User(telegram_id="1")
+    await db.repository.save(user)
+    secret = db.Secret(identity=IDENTITY, secret=SECRET, chat_id="1", user=user)
+    secret.targets = [db.Target(chat_id=str(n)) for n in range(1, args.targets + 1)]
+    await db.repository.save(secret)
+
+    calls = Counter()
+    count_calls(db.repository.backend, REPOSITORY_CALLS, calls, "db")
+    queue_backend = (
+        delivery.MongoBackend if backend == "mongo" else delivery.MemoryBackend
+    )
+    count_calls(queue_backend, QUEUE_CALLS, calls, "queue")
+
+    memory = {"start_mb": rss_mb()}
+    telegram_server, telegram_task = await serve(fake.app, telegram_port)
+    app_server, app_task = await serve(main.create_app(), app_port)
+    try:
+        report = await drive(
+            f"http://127.0.0.1:{app_port}",
+            IDENTITY,
+            args.secret,
+            args.requests,
+            args.concurrency,
+            deliveries,
+        )
+        memory["after_requests_mb"] = rss_mb()
+        if args.drain:
+            await drain(fake, args.drain)
+    finally:
+        app_server.should_exit = True
+        await app_task
+        telegram_server.should_exit = True
+        await telegram_task
+    memory["peak_mb"] = peak_rss_mb()
+    report["memory"] = memory
+    report["db_calls"] = dict(sorted(calls.items()))
+    report["telegram_calls"] = dict(fake.calls)
+    report["telegram_rejected"] = fake.rejected
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--url", help="drive an already running server")
+    parser.add_argument("--identity", default=IDENTITY)
+    parser.add_argument("--secret", default=SECRET)
+    parser.add_argument("--requests", type=int, default=2000)
+    parser.add_argument("--concurrency", type=int, default=50)
+    parser.add_argument("--events", default="push", help="`all` or comma separated")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--replay", help="JSON lines file written by payloads.py")
+    parser.add_argument("--commits", type=int, default=3)
+    parser.add_argument("--huge-push-files", type=int, default=0)
+    parser.add_argument("--payload-mb", type=float, default=0)
+    parser.add_argument("--latency", type=float, default=0.05)
+    parser.add_argument("--error-rate", type=float, default=0.0, help="share of 429s")
+    parser.add_argument("--invalid-signature", action="store_true")
+    parser.add_argument("--targets", type=int, default=1, help="chats per secret")
+    parser.add_argument("--db", choices=("memory", "mongomock"), default="memory")
+    parser.add_argument("--drain", type=float, default=0, help="seconds to wait")
+    args = parser.parse_args()
+
+    if args.replay:
+        mix = payloads.replay(args.replay)
+    else:
+        mix = payloads.mix(
+            payloads.parse_events(args.events),
+            seed=args.seed,
+            huge_push_files=args.huge_push_files,
+            commits=args.commits,
+            size=int(args.payload_mb * 1000 * 1000),
+        )
+    deliveries = [
+        (event_type, json.dumps(data).encode("utf-8")) for event_type, data in mix
+    ]
+    if args.invalid_signature:
+        args.secret = "not-" + args.secret
+    if args.url:
+        report = asyncio.run(
+            drive(
+                args.url,
+                args.identity,
+                args.secret,
+                args.requests,
+                args.concurrency,
+                deliveries,
+            )
+        )
+    else:
+        report = asyncio.run(in_process(args, deliveries))
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
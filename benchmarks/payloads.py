@@ -0,0 +1,416 @@
+"""
+Realistic GitHub webhook payloads for every event type the bot formats.
+
+Payloads carry the bulk of a real delivery (full repository and user
+objects, bodies, labels, file lists) next to the fields the templates
+read, so parsing and field extraction are measured on representative
+input. Generation is seeded, a mix can also be written to a JSON lines
+file and replayed later:
+
+    python benchmarks/payloads.py --events all --record mix.jsonl
+    python benchmarks/load.py --replay mix.jsonl
+"""
+
+import argparse
+import json
+import os
+import random
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "gwhtb"))
+
+import webhook  # pylint: disable=wrong-import-position
+
+EVENTS = sorted(set(webhook.EVENT_DESCRIPTIONS) | set(webhook.FUNC_EVENT_FORMATS))
+
+ACTIONS = {
+    "check_run": ("created", "completed", "rerequested"),
+    "check_suite": ("requested", "completed"),
+    "discussion": ("created", "answered", "closed"),
+    "discussion_comment": ("created", "edited"),
+    "workflow_job": ("queued", "in_progress", "completed"),
+    "workflow_run": ("requested", "in_progress", "completed"),
+    "issues": ("opened", "closed", "labeled", "assigned"),
+    "member": ("added", "removed"),
+    "membership": ("added", "removed"),
+    "pull_request": ("opened", "synchronize", "closed", "review_requested"),
+    "pull_request_review": ("submitted", "dismissed"),
+    "pull_request_review_comment": ("created", "edited"),
+    "release": ("published", "created"),
+    "repository": ("created", "archived", "renamed"),
+    "watch": ("started",),
+}
+
+WORDS = (
+    "fix add remove refactor update handle edge case cache parser client server "
+    "retry timeout race config docs test build release bump deps api webhook"
+).split()
+
+
+def user(login, user_id=1):
+    """A user object as GitHub embeds it in every payload"""
+    url = f"https://api.github.com/users/{login}"
+    return {
+        "login": login,
+        "id": user_id,
+        "node_id": f"MDQ6VXNlcj{user_id}",
+        "avatar_url": f"https://avatars.githubusercontent.com/u/{user_id}?v=4",
+        "gravatar_id": "",
+        "url": url,
+        "html_url": f"https://github.com/{login}",
+        "followers_url": f"{url}/followers",
+        "following_url": f"{url}/following{{/other_user}}",
+        "gists_url": f"{url}/gists{{/gist_id}}",
+        "starred_url": f"{url}/starred{{/owner}}{{/repo}}",
+        "subscriptions_url": f"{url}/subscriptions",
+        "organizations_url": f"{url}/orgs",
+        "repos_url": f"{url}/repos",
+        "events_url": f"{url}/events{{/privacy}}",
+        "received_events_url": f"{url}/received_events",
+        "type": "User",
+        "site_admin": False,
+    }
+
+
+def repository(full_name="bench/mono-repo"):
+    owner, name = full_name.split("/")
+    api = f"https://api.github.com/repos/{full_name}"
+    repo = {
+        "id": 123456789,
+        "node_id": "MDEwOlJlcG9zaXRvcnkxMjM0NTY3ODk=",
+        "name": name,
+        "full_name": full_name,
+        "private": False,
+        "owner": user(owner, 2),
+        "html_url": f"https://github.com/{full_name}",
+        "description": "Monorepo used to benchmark the webhook pipeline",
+        "fork": False,
+        "url": api,
+        "created_at": "2019-04-01T10:00:00Z",
+        "updated_at": "2024-05-01T10:00:00Z",
+        "pushed_at": "2024-05-01T10:00:00Z",
+        "git_url": f"git://github.com/{full_name}.git",
+        "ssh_url": f"git@github.com:{full_name}.git",
+        "clone_url": f"https://github.com/{full_name}.git",
+        "homepage": None,
+        "size": 48213,
+        "stargazers_count": 1380,
+        "watchers_count": 1380,
+        "language": "Python",
+        "forks_count": 211,
+        "open_issues_count": 97,
+        "default_branch": "main",
+        "topics": ["webhooks", "telegram", "bot"],
+        "visibility": "public",
+    }
+    for rel in (
+        "forks",
+        "keys",
+        "collaborators",
+        "teams",
+        "hooks",
+        "issue_events",
+        "events",
+        "assignees",
+        "branches",
+        "tags",
+        "blobs",
+        "git_tags",
+        "git_refs",
+        "trees",
+        "statuses",
+        "languages",
+        "stargazers",
+        "contributors",
+        "subscribers",
+        "subscription",
+        "commits",
+        "git_commits",
+        "comments",
+        "issue_comment",
+        "contents",
+        "compare",
+        "merges",
+        "archive",
+        "downloads",
+        "issues",
+        "pulls",
+        "milestones",
+        "notifications",
+        "labels",
+        "releases",
+        "deployments",
+    ):
+        repo[f"{rel}_url"] = f"{api}/{rel}"
+    return repo
+
+
+def sentence(rng, words=8):
+    return " ".join(rng.choice(WORDS) for _ in range(words))
+
+
+def body(rng, paragraphs=4):
+    """Markdown body full of characters MarkdownV2 has to escape"""
+    return "\n\n".join(
+        f"## {sentence(rng, 3)}\n* {sentence(rng)} (#{rng.randint(1, 9999)})\n"
+        f"`{rng.choice(WORDS)}_{rng.choice(WORDS)}()` -> [link](https://x.y/{n}).!"
+        for n in range(paragraphs)
+    )
+
+
+def labels(rng, count=3):
+    return [
+        {"id": n, "name": rng.choice(WORDS), "color": "ededed", "default": False}
+        for n in range(count)
+    ]
+
+
+def _value(key, rng, event_type):
+    """Value for a template field nobody filled in yet"""
+    if key == "action":
+        return rng.choice(ACTIONS.get(event_type, ("created",)))
+    if key in ("login", "name"):
+        return rng.choice(("octo-cat", "hubot", "dependabot[bot]", "mona.lisa"))
+    if key in ("number", "id"):
+        return rng.randint(1, 20000)
+    if key == "context":
+        return rng.choice(("ci/build", "ci/lint", "codecov/patch"))
+    if key in ("sha", "commit_id"):
+        return "%040x" % rng.getrandbits(160)
+    if key == "state":
+        return rng.choice(("success", "failure", "pending", "approved"))
+    if key == "conclusion":
+        return rng.choice(("success", "failure", "cancelled", "skipped"))
+    if key == "run_number":
+        return rng.randint(1, 5000)
+    if key == "head_branch":
+        return rng.choice(("main", "release/1.2", "feature/cache-v2"))
+    if key == "head_sha":
+        return "%040x" % rng.getrandbits(160)
+    if key in ("title", "workflow_name"):
+        return sentence(rng, 4)
+    if key == "ref":
+        return rng.choice(("main", "release/1.2", "feature/cache-v2"))
+    if key == "ref_type":
+        return rng.choice(("branch", "tag"))
+    if key == "environment":
+        return rng.choice(("production", "staging"))
+    if key == "tag_name":
+        return f"v{rng.randint(0, 9)}.{rng.randint(0, 20)}.{rng.randint(0, 9)}"
+    return f"{key}-{rng.randint(0, 999)}"
+
+
+def _fill(data, path, rng, event_type):
+    for key in path[:-1]:
+        data = data.setdefault(key, {})
+    data.setdefault(path[-1], _value(path[-1], rng, event_type))
+
+
+def _bulk(event_type, rng) -> dict:
+    """Parts of a real payload the bot never reads"""
+    author = user("octo-cat", 3)
+    issue = {
+        "title": sentence(rng),
+        "body": body(rng),
+        "user": author,
+        "labels": labels(rng),
+        "assignees": [user("hubot", 4)],
+        "state": "open",
+        "comments": rng.randint(0, 50),
+        "created_at": "2024-05-01T10:00:00Z",
+    }
+    extra = {
+        "commit_comment": {"comment": {"user": author, "body": body(rng, 2)}},
+        "issue_comment": {
+            "issue": issue,
+            "comment": {"user": author, "body": body(rng, 2)},
+        },
+        "issues": {"issue": issue},
+        "pull_request": {
+            "pull_request": dict(
+                issue,
+                head={"ref": "feature/cache-v2", "sha": "%040x" % rng.getrandbits(160)},
+                base={"ref": "main", "repo": repository()},
+                additions=rng.randint(1, 5000),
+                deletions=rng.randint(1, 5000),
+                changed_files=rng.randint(1, 300),
+            )
+        },
+        "pull_request_review": {
+            "review": {"user": author, "body": body(rng, 1)},
+            "pull_request": dict(issue, base={"ref": "main"}),
+        },
+        "pull_request_review_comment": {
+            "comment": {"user": author, "body": body(rng, 1), "diff_hunk": body(rng)},
+            "pull_request": dict(issue, base={"ref": "main"}),
+        },
+        "release": {"release": {"author": author, "body": body(rng, 6)}},
+        "gollum": {
+            "pages": [
+                {"page_name": sentence(rng, 2), "action": "edited", "sha": "0" * 40}
+                for _ in range(5)
+            ]
+        },
+        "fork": {"forkee": dict(repository("hubot/mono-repo"), owner=user("hubot"))},
+        "ping": {"zen": "Keep it logically awesome.", "hook_id": 1, "hook": {}},
+        "check_run": {
+            "check_run": {
+                "status": "completed",
+                "output": {"title": sentence(rng), "summary": body(rng, 2)},
+                "app": {"slug": "github-actions", "owner": user("github", 9)},
+            }
+        },
+        "workflow_run": {
+            "workflow_run": {
+                "event": "push",
+                "status": "completed",
+                "head_commit": {"message": body(rng, 1), "author": author},
+                "actor": author,
+                "repository": repository(),
+            },
+            "workflow": {"path": ".github/workflows/ci.yml", "state": "active"},
+        },
+        "workflow_job": {
+            "workflow_job": {
+                "labels": ["ubuntu-latest"],
+                "steps": [
+                    {"name": sentence(rng, 3), "status": "completed", "number": n}
+                    for n in range(12)
+                ],
+            }
+        },
+        "discussion": {"discussion": {"body": body(rng), "user": author}},
+        "discussion_comment": {
+            "discussion": {"body": body(rng), "user": author},
+            "comment": {"user": author, "body": body(rng, 2)},
+        },
+    }
+    return extra.get(event_type, {})
+
+
+def payload(event_type, rng=None, **push) -> dict:
+    """
+    A delivery of `event_type` with every field its template reads.
+
+    :param push: arguments of `push_payload` for pushes
+    """
+    rng = rng or random.Random(0)
+    if event_type == "push":
+        return push_payload(rng=rng, **push)
+    data = {"repository": repository(), "sender": user("octo-cat", 3)}
+    data.update(_bulk(event_type, rng))
+    # the templates of single actions read fields of their own
+    paths = ()
+    for key, template in webhook.COMPILED_DESCRIPTIONS.items():
+        if key.partition(":")[0] == event_type:
+            paths += template.paths
+    if event_type in webhook.THREADS:
+        # the fields naming the PR, deployment or commit a thread is about
+        paths += webhook.THREADS[event_type][2]
+    for path in paths:
+        _fill(data, path, rng, event_type)
+    return data
+
+
+def push_payload(commits=3, size=0, files=3, rng=None):
+    """
+    Push of `commits` commits touching `files` files each, padded to about
+    `size` bytes. GitHub lists at most 20 commits, `size` in the payload
+    counts all of them.
+    """
+    rng = rng or random.Random(0)
+    full_name = "bench/mono-repo"
+    listed = [
+        {
+            "id": "%040x" % rng.getrandbits(160),
+            "message": f"{sentence(rng, 4)} (#{n})\n\n* {sentence(rng)}.",
+            "timestamp": "2024-05-01T10:00:00Z",
+            "url": f"https://github.com/{full_name}/commit/{n}",
+            "author": {"name": "Bench Marker", "email": "bench@example.com"},
+            "committer": {"name": "Bench Marker", "email": "bench@example.com"},
+            "added": [f"src/{rng.choice(WORDS)}/{k}.py" for k in range(files)],
+            "removed": [],
+            "modified": [f"src/{rng.choice(WORDS)}/{k}.py" for k in range(files)],
+        }
+        for n in range(min(commits, 20))
+    ]
+    data = {
+        "ref": "refs/heads/main",
+        "before": "%040x" % rng.getrandbits(160),
+        "after": "%040x" % rng.getrandbits(160),
+        "compare": f"https://github.com/{full_name}/compare/0a1b2c...3d4e5f",
+        "size": commits,
+        "repository": repository(full_name),
+        "pusher": {"name": "bench", "email": "bench@example.com"},
+        "sender": user("bench", 5),
+        "commits": listed,
+        "head_commit": dict(listed[-1]) if listed else None,
+    }
+    if data["head_commit"] is None:
+        data["head_commit"] = {"committer": {"name": "bench"}, "url": data["compare"]}
+    padding = size - len(json.dumps(data))
+    if padding > 0:
+        # unused by the bot, like most of a real payload
+        data["padding"] = [{"blob": "x" * 1000} for _ in range(padding // 1012)]
+    return data
+
+
+def mix(events=("push",), seed=0, huge_push_files=0, **push) -> list:
+    """
+    `(event_type, payload)` pairs, one per event type. With
+    `huge_push_files` a push listing 20 of 5000 commits, each touching
+    that many files, is added.
+
+    :param push: arguments of `push_payload` for the regular push
+    """
+    rng = random.Random(seed)
+    deliveries = [
+        (event_type, payload(event_type, rng, **push)) for event_type in events
+    ]
+    if huge_push_files:
+        deliveries.append(
+            ("push", push_payload(commits=5000, files=huge_push_files, rng=rng))
+        )
+    return deliveries
+
+
+def record(path, deliveries):
+    with open(path, "w", encoding="utf-8") as file:
+        for event_type, data in deliveries:
+            file.write(json.dumps({"event": event_type, "payload": data}) + "\n")
+
+
+def replay(path) -> list:
+    with open(path, encoding="utf-8") as file:
+        return [
+            (entry["event"], entry["payload"])
+            for entry in (json.loads(line) for line in file if line.strip())
+        ]
+
+
+def parse_events(value) -> list:
+    """`all` or a comma separated list of event types"""
+    if value == "all":
+        return EVENTS
+    events = [event for event in value.split(",") if event]
+    unknown = set(events) - set(EVENTS)
+    if unknown:
+        raise SystemExit(f"unknown event types: {', '.join(sorted(unknown))}")
+    return events
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--events", default="all")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--huge-push-files", type=int, default=500)
+    parser.add_argument("--record", required=True, help="JSON lines file to write")
+    args = parser.parse_args()
+    deliveries = mix(parse_events(args.events), args.seed, args.huge_push_files)
+    record(args.record, deliveries)
+    for event_type, data in deliveries:
+        print(f"{event_type:<30}{len(json.dumps(data)):>10} bytes")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,151 @@
+"""
+Simulated-clock harness for the Telegram send scheduler.
+
+A fake bot enforces Telegram's flood limits on a virtual clock and raises
+`RetryAfter` like the real API would. The scheduler must keep the bot busy
+at the global limit without ever being throttled, and serve quiet chats
+while a noisy group has a long backlog.
+
+The second run is in real time through the delivery queue: a group's
+backlog is queued ahead of one message for another chat, which must not
+wait for the delivery workers to work the backlog off.
+
+    python benchmarks/ratelimit_sim.py
+"""
+
+import asyncio
+import collections
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "gwhtb"))
+os.environ.setdefault("DB_BACKEND", "memory")
+
+import telegram  # pylint: disable=wrong-import-position
+
+import delivery  # pylint: disable=wrong-import-position
+import main  # pylint: disable=wrong-import-position
+import ratelimit  # pylint: disable=wrong-import-position
+
+EPSILON = 1e-6
+
+
+class SimulatedClock(object):
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+    async def sleep(self, delay):
+        # let the sends dispatched so far hit the bot before time moves on
+        await asyncio.sleep(0)
+        self.now += max(delay, 0)
+
+
+class FakeBot(object):
+    """Accepts at most 30 messages/s overall, 20/min per group and 1/s per private chat"""
+
+    def __init__(self, clock):
+        self.clock = clock
+        self.sent = []  # (time, chat_id)
+        self.by_chat = collections.defaultdict(list)
+        self.rejected = 0
+
+    def _count(self, times, window):
+        return sum(1 for t in times if t > self.clock() - window + EPSILON)
+
+    async def send_message(self, chat_id, text):
+        now = self.clock()
+        recent = [t for t, _ in self.sent[-64:]]
+        window, limit = (60, 20) if chat_id.startswith("-") else (1, 1)
+        if (
+            self._count(recent, 1) >= 30
+            or self._count(self.by_chat[chat_id], window) >= limit
+        ):
+            self.rejected += 1
+            raise telegram.error.RetryAfter(1)
+        self.sent.append((now, chat_id))
+        self.by_chat[chat_id].append(now)
+        return text
+
+
+async def simulate():
+    clock = SimulatedClock()
+    bot = FakeBot(clock)
+    scheduler = ratelimit.Scheduler(clock=clock, sleep=clock.sleep)
+
+    chats = ["-1000"] * 100  # a noisy monorepo group
+    chats += [f"{i}" for i in range(60) for _ in range(5)]  # private chats
+    chats += [f"-{i}" for i in range(1, 21) for _ in range(3)]  # quiet groups
+    await asyncio.gather(
+        *[
+            # called like send_github does, the bot's chat_id is a keyword
+            scheduler.submit(
+                chat_id, bot.send_message, chat_id=chat_id, text=f"message {n}"
+            )
+            for n, chat_id in enumerate(chats)
+        ]
+    )
+
+    first_send = {}
+    for t, chat_id in bot.sent:
+        first_send.setdefault(chat_id, t)
+    busy = [t for t, _ in bot.sent if t < 10]
+    quiet_wait = max(t for chat_id, t in first_send.items() if chat_id != "-1000")
+
+    print(f"messages sent        : {len(bot.sent)}")
+    print(f"simulated duration   : {clock.now:.1f}s")
+    print(f"429 responses        : {bot.rejected}")
+    print(f"throughput first 10s : {len(busy) / 10:.1f} msg/s")
+    print(f"slowest first message: {quiet_wait:.2f}s")
+
+    assert len(bot.sent) == len(chats), "some messages were not delivered"
+    assert bot.rejected == 0, "the scheduler exceeded a flood limit"
+    assert len(busy) >= 29 * 10, "throughput is below the global limit"
+    assert quiet_wait < 5, "quiet chats were starved by the noisy one"
+
+
+class RecordingBot(object):
+    def __init__(self):
+        self.sent = []  # (time, chat_id, text)
+
+    async def send_message(self, chat_id, text, **kwargs):
+        self.sent.append((time.monotonic(), chat_id, text))
+        return telegram.Message(len(self.sent), None, None, text=text)
+
+
+async def outbox(backlog=20, group_rate=2.0):
+    bot = RecordingBot()
+    main.ratelimit.scheduler = ratelimit.Scheduler(group_rate=group_rate)
+    queue = delivery.DeliveryQueue(
+        delivery.MemoryBackend(),
+        lambda payload: main.send_github(bot, payload),
+        poll_interval=0.05,
+    )
+    jobs = [{"chat_id": "-1000", "texts": [f"noisy {n}"]} for n in range(backlog)]
+    jobs.append({"chat_id": "42", "texts": ["quiet"]})
+    await queue.put_many(jobs)
+    started = time.monotonic()
+    await queue.start()
+    while len(bot.sent) < len(jobs) and time.monotonic() - started < backlog:
+        await asyncio.sleep(0.05)
+    await queue.stop()
+
+    quiet_wait = next(t for t, chat_id, _ in bot.sent if chat_id == "42") - started
+    noisy = [text for _, chat_id, text in bot.sent if chat_id == "-1000"]
+    print(f"outbox: {backlog} jobs for a group at {group_rate}/s, one for another chat")
+    print(f"messages sent        : {len(bot.sent)}")
+    print(f"duration             : {time.monotonic() - started:.1f}s")
+    print(f"other chat's message : {quiet_wait:.2f}s")
+
+    assert len(bot.sent) == len(jobs), "some messages were not delivered"
+    assert noisy == [f"noisy {n}" for n in range(backlog)], "the group's order changed"
+    assert quiet_wait < 1, "the other chat waited for the group's backlog"
+
+
+if __name__ == "__main__":
+    asyncio.run(simulate())
+    asyncio.run(outbox())
+    print("OK")
@@ -0,0 +1,77 @@
+"""
+Micro-benchmark of the /github verification and decoding path.
+
+Compares, per delivery, what the handler used to do (a new HMAC keyed on
+every request, `json.loads` of the whole body, the full payload kept)
+with the cached key, orjson and the extracted fields, for a usual push,
+a 25 MB one and forged deliveries.
+
+    python benchmarks/verify_bench.py
+"""
+
+import hashlib
+import hmac
+import json
+import os
+import sys
+import timeit
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, "..", "gwhtb"))
+sys.path.insert(0, HERE)
+
+import webhook  # pylint: disable=wrong-import-position
+from payloads import push_payload  # pylint: disable=wrong-import-position
+
+SECRET = "bench-secret"
+
+
+def headers(body, secret=SECRET):
+    digest = hmac.new(secret.encode("utf-8"), body, hashlib.sha256).hexdigest()
+    return {
+        "content-type": "application/json",
+        "X-Github-Event": "push",
+        "x-hub-signature-256": f"sha256={digest}",
+    }
+
+
+def legacy(headers, body):
+    digest = hmac.new(SECRET.encode("utf-8"), body, hashlib.sha256).hexdigest()
+    signature = headers.get("x-hub-signature-256", "").split("=", 1)
+    if len(signature) < 2 or not hmac.compare_digest(signature[1], digest):
+        return None
+    return json.loads(body)
+
+
+def current(headers, body):
+    wbh = webhook.for_secret(SECRET)
+    if not wbh.verify(headers, body):
+        return None
+    return webhook.extract("push", webhook._loads(body))
+
+
+def main():
+    small = json.dumps(push_payload(3)).encode("utf-8")
+    large = json.dumps(push_payload(3, 25 * 1000 * 1000)).encode("utf-8")
+    cases = [
+        ("push, 1 KB", small, headers(small), 20000),
+        ("push, 25 MB", large, headers(large), 5),
+        ("forged, 1 KB", small, headers(small, "wrong"), 20000),
+        ("forged, 25 MB", large, headers(large, "wrong"), 5),
+        ("unsigned, 25 MB", large, {"X-Github-Event": "push"}, 5),
+    ]
+    print(f"{'case':<18}{'legacy ms':>12}{'current ms':>12}{'speedup':>10}")
+    for name, body, hdrs, number in cases:
+        before = timeit.timeit(lambda: legacy(hdrs, body), number=number)
+        after = timeit.timeit(lambda: current(hdrs, body), number=number)
+        print(
+            f"{name:<18}{before / number * 1e3:>12.3f}"
+            f"{after / number * 1e3:>12.3f}{before / after:>9.1f}x"
+        )
+    print(
+        f"kept of the 25 MB payload: {len(json.dumps(current(cases[1][2], large)))} B"
+    )
+
+
+if __name__ == "__main__":
+    main()
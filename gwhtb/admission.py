@@ -0,0 +1,129 @@
+import logging
+import math
+import os
+import time
+
+from ratelimit import TokenBucket
+
+logger = logging.getLogger(__name__)
+
+
+class Rejected(Exception):
+    """
+    A request turned away before any work was done for it.
+
+    :param reason: `in_flight`, `key_in_flight` or `rate`
+    :param retry_after: whole seconds the client should wait
+    """
+
+    def __init__(self, reason, retry_after):
+        super().__init__(f"{reason}, retry after {retry_after}s")
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+class Admission(object):
+    """
+    Sheds load at the door of an endpoint instead of queueing it.
+
+    A request is admitted while the endpoint has fewer than `max_in_flight`
+    requests in progress, its key (e.g. the secret identity) fewer than
+    `max_in_flight_per_key`, and the key's token bucket has a token left.
+    Limits of 0 are off.
+
+    :param max_in_flight: requests in progress on the endpoint
+    :param max_in_flight_per_key: requests in progress for one key
+    :param rate: requests per second for one key
+    :param burst: capacity of the bucket of every key
+    :param max_keys: buckets kept, full ones are forgotten past this
+    """
+
+    def __init__(
+        self,
+        max_in_flight=0,
+        max_in_flight_per_key=0,
+        rate=0.0,
+        burst=1,
+        max_keys=10000,
+        clock=time.monotonic,
+    ):
+        self.max_in_flight = max_in_flight
+        self.max_in_flight_per_key = max_in_flight_per_key
+        self.rate = rate
+        self.burst = burst
+        self.max_keys = max_keys
+        self.clock = clock
+        self.in_flight = 0
+        self._in_flight = {}  # key -> requests in progress
+        self._buckets = {}
+        self.rejected = {"in_flight": 0, "key_in_flight": 0, "rate": 0}
+
+    def _bucket(self, key, now):
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            if len(self._buckets) >= self.max_keys:
+                # a full bucket behaves exactly like a new one, forget those
+                for old in [k for k, b in self._buckets.items() if b.full(now)]:
+                    del self._buckets[old]
+            bucket = self._buckets[key] = TokenBucket(self.rate, self.burst, now)
+        return bucket
+
+    def _reject(self, reason, retry_after):
+        self.rejected[reason] += 1
+        raise Rejected(reason, max(1, math.ceil(retry_after)))
+
+    def acquire(self, key=None):
+        """Admit a request or raise `Rejected`, admitted ones must `release`"""
+        if self.max_in_flight and self.in_flight >= self.max_in_flight:
+            self._reject("in_flight", 1)
+        if key is not None:
+            if (
+                self.max_in_flight_per_key
+                and self._in_flight.get(key, 0) >= self.max_in_flight_per_key
+            ):
+                self._reject("key_in_flight", 1)
+            if self.rate:
+                now = self.clock()
+                bucket = self._bucket(key, now)
+                delay = bucket.delay(now)
+                if delay > 0:
+                    self._reject("rate", delay)
+                bucket.take(now)
+            self._in_flight[key] = self._in_flight.get(key, 0) + 1
+        self.in_flight += 1
+
+    def release(self, key=None):
+        self.in_flight -= 1
+        if key is not None:
+            left = self._in_flight[key] - 1
+            if left:
+                self._in_flight[key] = left
+            else:
+                del self._in_flight[key]
+
+    def stats(self) -> dict:
+        return {
+            "in_flight": self.in_flight,
+            "keys_in_flight": len(self._in_flight),
+            "buckets": len(self._buckets),
+            "rejected": dict(self.rejected),
+        }
+
+
+def github_from_env() -> Admission:
+    """Limits of /github from `GITHUB_*` environment variables, keyed by identity"""
+    return Admission(
+        max_in_flight=int(os.environ.get("GITHUB_MAX_IN_FLIGHT", "256")),
+        max_in_flight_per_key=int(
+            os.environ.get("GITHUB_MAX_IN_FLIGHT_PER_IDENTITY", "16")
+        ),
+        rate=float(os.environ.get("GITHUB_IDENTITY_RATE", "10")),
+        burst=int(os.environ.get("GITHUB_IDENTITY_BURST", "50")),
+    )
+
+
+def telegram_from_env() -> Admission:
+    """Limits of /telegram from `TELEGRAM_WEBHOOK_MAX_IN_FLIGHT`"""
+    return Admission(
+        max_in_flight=int(os.environ.get("TELEGRAM_WEBHOOK_MAX_IN_FLIGHT", "64"))
+    )
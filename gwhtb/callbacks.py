@@ -0,0 +1,130 @@
+import base64
+import enum
+
+from bson import ObjectId
+
+# Telegram refuses `callback_data` longer than this many bytes
+MAX_CALLBACK_DATA = 64
+
+
+class State(enum.IntEnum):
+    """Screens and actions of the inline menu, one byte each in `callback_data`"""
+
+    MAIN = 1
+    NEW_SECRET = 2
+    SECRETS = 3
+    SECRET = 4
+    DELETE = 5
+    DIGEST = 6
+    TARGET = 7
+    FILTERS = 8
+    FILTER_EVENT = 9
+    FILTER_BRANCHES = 10
+    FILTER_ACTIONS = 11
+    EXIT = 12
+    TEMPLATES = 13
+    TEMPLATE = 14
+    TEMPLATE_RESET = 15
+
+
+# numeric states of the keyboards sent before the encoding below, buttons of
+# old messages keep working; they carry the full identity instead of a slot
+LEGACY_STATES = {
+    "7917": State.MAIN,
+    "30564": State.NEW_SECRET,
+    "20356": State.SECRETS,
+    "20243": State.SECRET,
+    "18787": State.DELETE,
+    "6491": State.EXIT,
+}
+
+
+def _varint(value: int) -> bytes:
+    out = bytearray()
+    while True:
+        byte, value = value & 0x7F, value >> 7
+        if value:
+            out.append(byte | 0x80)
+        else:
+            out.append(byte)
+            return bytes(out)
+
+
+def _read_varint(raw: bytes, position: int):
+    value = shift = 0
+    while True:
+        if position >= len(raw):
+            raise ValueError("truncated varint")
+        byte, position = raw[position], position + 1
+        value |= (byte & 0x7F) << shift
+        shift += 7
+        if not byte & 0x80:
+            return value, position
+
+
+def encode(state: State, *args) -> str:
+    """
+    Pack a state and its arguments into `callback_data`.
+
+    The state takes one byte, an `int` argument a varint, an `ObjectId`
+    its 12 raw bytes and a `str` its UTF-8 length and bytes, base64 without
+    padding on top. Encoded data always starts with `A`, so it never
+    collides with the legacy numeric states.
+
+    :param args: non-negative `int`s, `ObjectId`s and short `str`s
+    """
+    raw = bytearray((state,))
+    for arg in args:
+        if isinstance(arg, ObjectId):
+            raw.append(0)
+            raw += arg.binary
+        elif isinstance(arg, str):
+            text = arg.encode()
+            raw.append(2)
+            raw += _varint(len(text))
+            raw += text
+        else:
+            raw.append(1)
+            raw += _varint(arg)
+    data = base64.urlsafe_b64encode(bytes(raw)).rstrip(b"=").decode()
+    if len(data) > MAX_CALLBACK_DATA:
+        raise ValueError(f"callback data of {state!r} is {len(data)} bytes long")
+    return data
+
+
+def decode(data: str):
+    """
+    Unpack `callback_data` into `(state, args)`, inverse of `encode`.
+
+    Legacy numeric data is returned with its arguments as strings.
+
+    :raises ValueError: on data this module did not produce
+    """
+    state, _, rest = data.partition("-")
+    if state in LEGACY_STATES:
+        return LEGACY_STATES[state], rest.split("-") if rest else []
+
+    raw = base64.urlsafe_b64decode(data + "=" * (-len(data) % 4))
+    if not raw:
+        raise ValueError("empty callback data")
+    state, args, position = State(raw[0]), [], 1
+    while position < len(raw):
+        tag, position = raw[position], position + 1
+        if tag == 0:
+            if position + 12 > len(raw):
+                raise ValueError("truncated object id")
+            args.append(ObjectId(raw[position : position + 12]))
+            position += 12
+        elif tag == 1:
+            value, position = _read_varint(raw, position)
+            args.append(value)
+        elif tag == 2:
+            length, position = _read_varint(raw, position)
+            if position + length > len(raw):
+                raise ValueError("truncated string")
+            # UnicodeDecodeError is a ValueError too
+            args.append(raw[position : position + length].decode())
+            position += length
+        else:
+            raise ValueError(f"unknown argument tag {tag}")
+    return state, args
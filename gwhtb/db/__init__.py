@@ -1,2 +1,10 @@
 from .db import global_init
-from .users import User, Secret
+from .users import User, Secret, Target, secret_cache
+from .deliveries import Delivery, SeenDelivery
+from .leases import Lease
+from .versions import CacheVersion
+from .messages import MessageRef, message_cache
+from .repository import Repository, from_env as repository_from_env
+
+# shared by the webhook routes and the telegram menu
+repository = repository_from_env()
@@ -0,0 +1,49 @@
+from __future__ import annotations
+import mongoengine
+from datetime import datetime
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class Delivery(mongoengine.Document):
+    queue = mongoengine.StringField(required=True)
+    payload = mongoengine.DictField(required=True)
+    status = mongoengine.StringField(
+        default="pending", choices=("pending", "in_flight", "dead")
+    )
+    attempts = mongoengine.IntField(default=0)
+    next_attempt = mongoengine.DateTimeField(default=datetime.utcnow)
+    locked_until = mongoengine.DateTimeField()
+    last_error = mongoengine.StringField()
+    created = mongoengine.DateTimeField(default=datetime.utcnow)
+    dead_at = mongoengine.DateTimeField()
+
+    meta = {
+        "db_alias": "core",
+        "collection": "deliveries",
+        "indexes": [
+            {"fields": ["queue", "status", "next_attempt"]},
+            {
+                "fields": ["dead_at"],
+                "expireAfterSeconds": 2592000,
+            },  # dead letters are kept for 30 days
+        ],
+    }
+
+
+class SeenDelivery(mongoengine.Document):
+    guid = mongoengine.StringField(required=True)
+    created = mongoengine.DateTimeField(default=datetime.utcnow)
+
+    meta = {
+        "db_alias": "core",
+        "collection": "seen_deliveries",
+        "indexes": [
+            {"fields": ["guid"], "unique": True},
+            {
+                "fields": ["created"],
+                "expireAfterSeconds": 259200,
+            },  # GitHub only redelivers during 3 days
+        ],
+    }
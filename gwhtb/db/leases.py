@@ -0,0 +1,18 @@
+from __future__ import annotations
+import mongoengine
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class Lease(mongoengine.Document):
+    """A named lock held by `holder` until `expires`, renewed while alive"""
+
+    name = mongoengine.StringField(primary_key=True)
+    holder = mongoengine.StringField(required=True)
+    expires = mongoengine.DateTimeField(required=True)
+
+    meta = {
+        "db_alias": "core",
+        "collection": "leases",
+    }
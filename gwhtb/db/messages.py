@@ -0,0 +1,80 @@
+from __future__ import annotations
+import collections
+import os
+import threading
+import mongoengine
+from datetime import datetime
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class MessageRef(mongoengine.Document):
+    """Telegram message later events about the same PR, deployment or commit continue"""
+
+    chat_id = mongoengine.StringField(required=True)
+    thread_id = mongoengine.IntField()  # forum topic, None for the whole chat
+    key = mongoengine.StringField(required=True)  # see `webhook.thread`
+    message_id = mongoengine.IntField(required=True)
+    updated = mongoengine.DateTimeField(default=datetime.utcnow)
+
+    meta = {
+        "db_alias": "core",
+        "collection": "message_refs",
+        "indexes": [
+            {"fields": ["chat_id", "thread_id", "key"], "unique": True},
+            {
+                "fields": ["updated"],
+                "expireAfterSeconds": int(
+                    os.environ.get("MESSAGE_INDEX_TTL", "604800")
+                ),
+            },  # a week after the last event by default
+        ],
+    }
+
+
+class MessageCache(object):
+    """
+    Bounded LRU cache of `(chat_id, thread_id, key)` -> message id.
+
+    Keys without a message are cached as `None` as well, most events start
+    a thread of their own.
+
+    :param maxsize: number of keys kept, the least recently used go first
+    """
+
+    def __init__(self, maxsize=10000):
+        self.maxsize = maxsize
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def lookup(self, key):
+        """Return `(True, message_id)` on a hit, `(False, None)` on a miss"""
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return True, self._entries[key]
+            self.misses += 1
+            return False, None
+
+    def store(self, key, message_id):
+        with self._lock:
+            self._entries[key] = message_id
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> dict:
+        return {"size": len(self._entries), "hits": self.hits, "misses": self.misses}
+
+
+message_cache = MessageCache(
+    maxsize=int(os.environ.get("MESSAGE_INDEX_SIZE", "10000")),
+)
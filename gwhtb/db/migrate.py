@@ -0,0 +1,105 @@
+"""
+Bring the `secret` and `user` collections to the current schema.
+
+- identities shared by several secrets are redrawn for all but the oldest,
+  webhooks of the others never verified since lookups returned the oldest
+- the `identity` index is rebuilt as unique; a temporary index keeps
+  identity lookups indexed while it is swapped, so the bot keeps serving
+- indexes on `Secret.user` and `Secret.chat_id` are created
+- the `User.secrets` back-references are removed
+
+Every step is idempotent. Run it against the live database before starting
+the new version, which would otherwise fail to create the unique index:
+
+    cd gwhtb && python -m db.migrate [--dry-run]
+"""
+
+import argparse
+import logging
+import secrets
+
+from .db import global_init
+from .users import User, Secret
+
+logger = logging.getLogger(__name__)
+
+TEMPORARY_INDEX = "identity_migration"
+
+
+def _collection(document):
+    # `_get_collection` would create the new indexes before the old are dropped
+    return document._get_db()[document._get_collection_name()]
+
+
+def duplicate_identities(collection) -> list:
+    """Ids of every secret sharing its identity with an older one"""
+    groups = collection.aggregate(
+        [
+            {"$sort": {"_id": 1}},
+            {"$group": {"_id": "$identity", "ids": {"$push": "$_id"}}},
+            {"$match": {"ids.1": {"$exists": True}}},
+        ],
+        allowDiskUse=True,
+    )
+    return [_id for group in groups for _id in group["ids"][1:]]
+
+
+def redraw_identities(collection, ids, dry_run=False):
+    for _id in ids:
+        document = collection.find_one({"_id": _id}, {"identity": 1, "chat_id": 1})
+        identity = secrets.token_hex(nbytes=20)
+        logger.warning(
+            "secret %s of chat %s: identity %s -> %s",
+            _id,
+            document["chat_id"],
+            document["identity"],
+            identity,
+        )
+        if not dry_run:
+            collection.update_one({"_id": _id}, {"$set": {"identity": identity}})
+
+
+def rebuild_identity_index(collection):
+    indexes = collection.index_information()
+    if indexes.get("identity_1", {}).get("unique"):
+        return
+    collection.create_index([("identity", 1), ("_id", 1)], name=TEMPORARY_INDEX)
+    if "identity_1" in indexes:
+        collection.drop_index("identity_1")
+    collection.create_index([("identity", 1)], name="identity_1", unique=True)
+    collection.drop_index(TEMPORARY_INDEX)
+
+
+def migrate(dry_run=False):
+    secret_collection = _collection(Secret)
+    duplicates = duplicate_identities(secret_collection)
+    logger.info("%s secrets share an identity with an older one", len(duplicates))
+    redraw_identities(secret_collection, duplicates, dry_run=dry_run)
+
+    users = _collection(User).count_documents({"secrets": {"$exists": True}})
+    logger.info("%s users carry a secrets list", users)
+    if dry_run:
+        return
+
+    rebuild_identity_index(secret_collection)
+    Secret.ensure_indexes()
+    User.ensure_indexes()
+    _collection(User).update_many(
+        {"secrets": {"$exists": True}}, {"$unset": {"secrets": ""}}
+    )
+    logger.info("migration done")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        "--dry-run", action="store_true", help="only report what would change"
+    )
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    global_init()
+    migrate(dry_run=args.dry_run)
+
+
+if __name__ == "__main__":
+    main()
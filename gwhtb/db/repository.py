@@ -0,0 +1,446 @@
+from __future__ import annotations
+import asyncio
+import functools
+import logging
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+import mongoengine
+from bson import ObjectId
+from pymongo import UpdateOne
+
+from .deliveries import SeenDelivery
+from .messages import MessageRef, message_cache
+from .users import User, Secret, WEBHOOK_FIELDS, secret_cache
+from .versions import CacheVersion
+
+logger = logging.getLogger(__name__)
+
+# changed keys a version document remembers, a process that missed more
+# than these since its last look drops its whole cache
+CHANGES_KEPT = 100
+
+
+def _reference_id(value):
+    """Id of a reference field value without dereferencing it"""
+    return getattr(value, "id", value)
+
+
+class TouchBuffer(object):
+    """
+    Write-behind accumulator for `last_invoked` of secrets and users.
+
+    `last_invoked` only feeds the TTL indexes, so instead of saving both
+    documents on every webhook the ids are collected and flushed with one
+    `bulk_write` per collection.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._secrets = {}  # id -> last_invoked
+        self._users = {}
+
+    def add(self, secret):
+        now = datetime.utcnow()
+        with self._lock:
+            self._secrets[secret.id] = now
+            user_id = _reference_id(secret._data.get("user"))
+            if user_id is not None:
+                self._users[user_id] = now
+
+    def __len__(self):
+        return len(self._secrets) + len(self._users)
+
+    def flush(self):
+        with self._lock:
+            batches = ((Secret, self._secrets), (User, self._users))
+            self._secrets, self._users = {}, {}
+        for document, pending in batches:
+            if not pending:
+                continue
+            try:
+                document._get_collection().bulk_write(
+                    [
+                        UpdateOne({"_id": _id}, {"$max": {"last_invoked": invoked}})
+                        for _id, invoked in pending.items()
+                    ],
+                    ordered=False,
+                )
+            except Exception:
+                self._restore(document, pending)
+                raise
+            logger.debug("touched %s %s documents", len(pending), document.__name__)
+
+    def _restore(self, document, pending):
+        """Put back updates of a failed flush, they are retried on the next one"""
+        with self._lock:
+            current = self._secrets if document is Secret else self._users
+            for _id, invoked in pending.items():
+                current[_id] = max(invoked, current.get(_id, invoked))
+
+
+class MongoBackend(object):
+    """mongoengine calls, run on a bounded thread pool off the event loop"""
+
+    # collections the webhook routes and the menu use, warmed up at startup
+    documents = (User, Secret, SeenDelivery, MessageRef, CacheVersion)
+
+    def __init__(self, max_workers=8):
+        self._executor = ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix="mongo"
+        )
+        self.touches = TouchBuffer()
+
+    async def run(self, func, *args, **kwargs):
+        return await asyncio.get_running_loop().run_in_executor(
+            self._executor, functools.partial(func, *args, **kwargs)
+        )
+
+    def warm_up(self, document):
+        # the first access creates the indexes, better here than in a request
+        document._get_collection()  # pylint: disable=protected-access
+
+    def ping(self):
+        mongoengine.get_db("core").command("ping")
+
+    def get_secret(self, identity, fields=()):
+        return Secret.get(identity=identity, fields=fields)
+
+    def get_user(self, telegram_id):
+        return User.get(telegram_id=telegram_id)
+
+    def secrets_page(self, user, after=None, before=None, limit=10):
+        query = Secret.objects(user=user)
+        if before is not None:
+            query = query.filter(id__lt=before).order_by("-id")
+        else:
+            if after is not None:
+                query = query.filter(id__gt=after)
+            query = query.order_by("id")
+        # the menu lists secrets by name, the rest is loaded when one is opened
+        page = list(query.only("identity", "repository").limit(limit + 1))
+        return page[::-1] if before is not None else page
+
+    def insert(self, document):
+        document.save(force_insert=True)
+
+    def save(self, document):
+        document.save()
+
+    def delete(self, document):
+        document.delete()
+
+    def touch(self, secret):
+        self.touches.add(secret)
+
+    def claim_delivery(self, guid):
+        try:
+            SeenDelivery(guid=guid).save(force_insert=True)
+        except mongoengine.NotUniqueError:
+            return False
+        return True
+
+    def release_delivery(self, guid):
+        SeenDelivery.objects(guid=guid).delete()
+
+    def get_message(self, chat_id, thread_id, key):
+        ref = (
+            MessageRef.objects(chat_id=chat_id, thread_id=thread_id, key=key)
+            .only("message_id")
+            .first()
+        )
+        return ref.message_id if ref is not None else None
+
+    def set_message(self, chat_id, thread_id, key, message_id):
+        MessageRef.objects(chat_id=chat_id, thread_id=thread_id, key=key).update_one(
+            set__message_id=message_id, set__updated=datetime.utcnow(), upsert=True
+        )
+
+    def bump_version(self, name, key):
+        collection = CacheVersion._get_collection()  # pylint: disable=protected-access
+        collection.update_one(
+            {"_id": name},
+            {
+                "$inc": {"version": 1},
+                "$push": {"changed": {"$each": [key], "$slice": -CHANGES_KEPT}},
+            },
+            upsert=True,
+        )
+
+    def read_version(self, name):
+        collection = CacheVersion._get_collection()  # pylint: disable=protected-access
+        found = collection.find_one({"_id": name})
+        if found is None:
+            return 0, []
+        return found.get("version", 0), found.get("changed", [])
+
+    def flush(self):
+        self.touches.flush()
+
+    def shutdown(self):
+        self.flush()
+        self._executor.shutdown(wait=True)
+
+
+class MemoryBackend(object):
+    """Keeps documents in dicts, for tests and benchmarks without a Mongo server"""
+
+    documents = ()
+
+    def __init__(self):
+        self.users = {}  # telegram_id -> User
+        self.secrets = {}  # identity -> Secret
+        self.deliveries = set()
+        self.messages = {}  # (chat_id, thread_id, key) -> message id
+
+    async def run(self, func, *args, **kwargs):
+        return func(*args, **kwargs)
+
+    def ping(self):
+        pass
+
+    def get_secret(self, identity, fields=()):
+        return self.secrets.get(identity)
+
+    def get_user(self, telegram_id):
+        return self.users.get(telegram_id)
+
+    def user_secrets(self, user):
+        return [
+            secret
+            for secret in self.secrets.values()
+            if secret.user is not None and secret.user.id == user.id
+        ]
+
+    def secrets_page(self, user, after=None, before=None, limit=10):
+        owned = sorted(self.user_secrets(user), key=lambda secret: secret.id)
+        if before is not None:
+            return [secret for secret in owned if secret.id < before][-limit - 1 :]
+        if after is not None:
+            owned = [secret for secret in owned if secret.id > after]
+        return owned[: limit + 1]
+
+    def insert(self, document):
+        if isinstance(document, Secret) and document.identity in self.secrets:
+            raise mongoengine.NotUniqueError(f"identity {document.identity} exists")
+        self.save(document)
+
+    def save(self, document):
+        if document.id is None:
+            document.id = ObjectId()
+        if isinstance(document, Secret):
+            self.secrets[document.identity] = document
+        else:
+            self.users[document.telegram_id] = document
+
+    def delete(self, document):
+        if isinstance(document, Secret):
+            self.secrets.pop(document.identity, None)
+        else:
+            self.users.pop(document.telegram_id, None)
+            for secret in self.user_secrets(document):
+                self.delete(secret)
+
+    def touch(self, secret):
+        secret.last_invoked = datetime.utcnow()
+        self.save(secret)
+        if secret.user is not None:
+            secret.user.last_invoked = datetime.utcnow()
+
+    def claim_delivery(self, guid):
+        if guid in self.deliveries:
+            return False
+        self.deliveries.add(guid)
+        return True
+
+    def release_delivery(self, guid):
+        self.deliveries.discard(guid)
+
+    def get_message(self, chat_id, thread_id, key):
+        return self.messages.get((chat_id, thread_id, key))
+
+    def set_message(self, chat_id, thread_id, key, message_id):
+        self.messages[(chat_id, thread_id, key)] = message_id
+
+    def bump_version(self, name, key):
+        pass  # a single process, its own cache is the only one
+
+    def read_version(self, name):
+        return 0, []
+
+    def flush(self):
+        pass
+
+    def shutdown(self):
+        pass
+
+
+class Repository(object):
+    """
+    Async access to `User` and `Secret` for handlers running on the event loop.
+
+    :param backend: `MongoBackend` or `MemoryBackend`
+    """
+
+    def __init__(self, backend, flush_interval=5.0, sync_interval=2.0):
+        self.backend = backend
+        self.flush_interval = flush_interval
+        self.sync_interval = sync_interval
+        self._flusher = None
+        self._syncer = None
+        self._secrets_version = None
+
+    async def warm_up(self):
+        """Connect and create the indexes of every collection at once"""
+        await asyncio.gather(
+            *(
+                self.backend.run(self.backend.warm_up, document)
+                for document in self.backend.documents
+            )
+        )
+
+    async def ping(self):
+        """Round trip to the database, raises if it cannot be reached"""
+        await self.backend.run(self.backend.ping)
+
+    async def get_secret(self, identity: str, fields: tuple = ()) -> Secret:
+        """:param fields: load only these fields, all of them if empty"""
+        return await self.backend.run(self.backend.get_secret, identity, fields)
+
+    async def cached_secret(self, identity: str) -> Secret:
+        """
+        `get_secret` through `secret_cache`, for the webhook hot path.
+
+        Only `WEBHOOK_FIELDS` are loaded, saving the result writes just the
+        fields that were changed.
+        """
+        found, secret = secret_cache.lookup(identity)
+        if not found:
+            secret = await self.get_secret(identity, WEBHOOK_FIELDS)
+            secret_cache.store(identity, secret)
+        return secret
+
+    async def get_user(self, telegram_id: str) -> User:
+        return await self.backend.run(self.backend.get_user, telegram_id)
+
+    async def secrets_page(
+        self, user: User, after: ObjectId = None, before: ObjectId = None, limit=10
+    ) -> tuple:
+        """
+        Secrets of `user` in creation order, a page at a time.
+
+        :param after: id of the last secret of the previous page
+        :param before: id of the first secret of the next page, to go back
+        :return: `(secrets, more)`, `more` is true if there are secrets past
+            the page in the direction it was fetched
+        """
+        page = await self.backend.run(
+            self.backend.secrets_page, user, after, before, limit
+        )
+        if before is not None:
+            return page[-limit:], len(page) > limit
+        return page[:limit], len(page) > limit
+
+    async def insert(self, document):
+        """Save a new document, `mongoengine.NotUniqueError` if its key is taken"""
+        await self.backend.run(self.backend.insert, document)
+
+    async def save(self, document):
+        await self.backend.run(self.backend.save, document)
+
+    async def delete(self, document):
+        await self.backend.run(self.backend.delete, document)
+
+    def touch(self, secret: Secret):
+        """Bump `last_invoked` of a saved secret and its user, written behind"""
+        self.backend.touch(secret)
+
+    async def claim_delivery(self, guid: str) -> bool:
+        """Record a delivery GUID, `False` if it was already recorded"""
+        return await self.backend.run(self.backend.claim_delivery, guid)
+
+    async def release_delivery(self, guid: str):
+        """Forget a delivery GUID, so its redelivery is processed again"""
+        await self.backend.run(self.backend.release_delivery, guid)
+
+    async def message_id(self, chat_id: str, thread_id: int, key: str) -> int:
+        """Message an earlier event with the same thread `key` was sent as"""
+        cache_key = (chat_id, thread_id, key)
+        found, message_id = message_cache.lookup(cache_key)
+        if not found:
+            message_id = await self.backend.run(
+                self.backend.get_message, chat_id, thread_id, key
+            )
+            message_cache.store(cache_key, message_id)
+        return message_id
+
+    async def remember_message(
+        self, chat_id: str, thread_id: int, key: str, message_id: int
+    ):
+        """Record the message later events with this thread `key` continue"""
+        message_cache.store((chat_id, thread_id, key), message_id)
+        await self.backend.run(
+            self.backend.set_message, chat_id, thread_id, key, message_id
+        )
+
+    async def invalidate_secret(self, identity: str):
+        """Drop a changed or deleted secret from the cache of every process"""
+        secret_cache.invalidate(identity)
+        await self.backend.run(self.backend.bump_version, "secrets", identity)
+
+    async def sync_caches(self):
+        """Drop the secrets other processes changed since the last call"""
+        version, changed = await self.backend.run(self.backend.read_version, "secrets")
+        seen, self._secrets_version = self._secrets_version, version
+        if seen is None or not 0 <= version - seen <= len(changed):
+            # too much to tell what changed, or the first look
+            secret_cache.clear()
+        else:
+            for identity in changed[len(changed) - (version - seen) :]:
+                secret_cache.invalidate(identity)
+
+    async def _sync_forever(self):
+        while True:
+            await asyncio.sleep(self.sync_interval)
+            try:
+                await self.sync_caches()
+            except Exception:  # pylint: disable=broad-except
+                logger.exception("could not read the cache invalidations")
+
+    async def flush(self):
+        await self.backend.run(self.backend.flush)
+
+    async def _flush_forever(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self.flush()
+            except Exception:  # pylint: disable=broad-except
+                logger.exception("could not flush last_invoked updates")
+
+    async def start(self):
+        self._flusher = asyncio.create_task(self._flush_forever())
+        self._syncer = asyncio.create_task(self._sync_forever())
+
+    def shutdown(self):
+        """Stop the periodic tasks and write what is pending"""
+        if self._flusher is not None:
+            self._flusher.cancel()
+            self._flusher = None
+        if self._syncer is not None:
+            self._syncer.cancel()
+            self._syncer = None
+        self.backend.shutdown()
+
+
+def from_env() -> Repository:
+    """Build the repository from `DB_*` environment variables"""
+    if os.environ.get("DB_BACKEND", "mongo") == "memory":
+        return Repository(MemoryBackend())
+    return Repository(
+        MongoBackend(max_workers=int(os.environ.get("DB_WORKERS", "8"))),
+        flush_interval=float(os.environ.get("DB_FLUSH_INTERVAL", "5")),
+        sync_interval=float(os.environ.get("SECRET_CACHE_SYNC_INTERVAL", "2")),
+    )
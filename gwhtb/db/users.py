@@ -1,4 +1,8 @@
 from __future__ import annotations
+import collections
+import os
+import threading
+import time
 import mongoengine
 from datetime import datetime
 import logging
@@ -8,13 +12,14 @@ logger = logging.getLogger(__name__)
 
 class User(mongoengine.Document):
     telegram_id = mongoengine.StringField(required=True)
-    secrets = mongoengine.ListField(mongoengine.ReferenceField("Secret"))
     created = mongoengine.DateTimeField(default=datetime.utcnow)
     last_invoked = mongoengine.DateTimeField(default=datetime.utcnow)
 
     meta = {
         "db_alias": "core",
         "collections": "users",
+        # users saved before `db.migrate` still carry the dropped `secrets` list
+        "strict": False,
         "indexes": [
             {"fields": ["telegram_id"]},
             {
@@ -28,9 +33,12 @@ class User(mongoengine.Document):
     def get(telegram_id: str = None) -> User:
         return User.objects(telegram_id=telegram_id).first()
 
-    def update(self):
-        self.last_invoked = datetime.utcnow
-        self.save()
+
+class Target(mongoengine.EmbeddedDocument):
+    """A chat, or a topic of a forum chat, events of a secret are sent to"""
+
+    chat_id = mongoengine.StringField(required=True)
+    thread_id = mongoengine.IntField()  # forum topic, None for the whole chat
 
 
 class Secret(mongoengine.Document):
@@ -39,6 +47,16 @@ class Secret(mongoengine.Document):
     chat_id = mongoengine.StringField(required=True)
     user = mongoengine.ReferenceField(User, reverse_delete_rule=mongoengine.CASCADE)
     repository = mongoengine.StringField(default="None", required=False)
+    digest_window = mongoengine.IntField(default=0)  # seconds, 0 sends every event
+    digest_max_events = mongoengine.IntField(default=20)
+    # chats the events are fanned out to, empty means `chat_id` alone
+    targets = mongoengine.ListField(mongoengine.EmbeddedDocumentField(Target))
+    # subscription rules, empty lists let everything through
+    events = mongoengine.ListField(mongoengine.StringField())
+    branches = mongoengine.ListField(mongoengine.StringField())  # globs
+    actions = mongoengine.ListField(mongoengine.StringField())  # "event:action"
+    # "event" or "event:action" -> template replacing the built-in one
+    templates = mongoengine.DictField(field=mongoengine.StringField())
     created = mongoengine.DateTimeField(default=datetime.utcnow)
     last_invoked = mongoengine.DateTimeField(default=datetime.utcnow)
 
@@ -46,7 +64,9 @@ class Secret(mongoengine.Document):
         "db_alias": "core",
         "collections": "secrets",
         "indexes": [
-            {"fields": ["identity"]},
+            {"fields": ["identity"], "unique": True},
+            {"fields": ["user", "id"]},  # pages of a user's secrets
+            {"fields": ["chat_id"]},
             {
                 "fields": ["last_invoked"],
                 "expireAfterSeconds": 31536000,
@@ -55,13 +75,102 @@ class Secret(mongoengine.Document):
     }
 
     @staticmethod
-    def get(identity: str = None) -> User:
-        return Secret.objects(identity=identity).first()
+    def get(identity: str = None, fields: tuple = ()) -> Secret:
+        """:param fields: load only these fields, all of them if empty"""
+        query = Secret.objects(identity=identity)
+        if fields:
+            query = query.only(*fields)
+        return query.first()
+
+    def destinations(self) -> list:
+        """Targets events of this secret are sent to"""
+        return list(self.targets) or [Target(chat_id=self.chat_id)]
+
+    def owner_id(self):
+        """Id of the user the secret belongs to, without loading the user"""
+        user = self._data.get("user")
+        return getattr(user, "id", user)
+
+
+# fields the /github route reads, secrets cached for webhooks load only these
+WEBHOOK_FIELDS = (
+    "identity",
+    "secret",
+    "chat_id",
+    "user",
+    "repository",
+    "digest_window",
+    "digest_max_events",
+    "targets",
+    "events",
+    "branches",
+    "actions",
+    "templates",
+)
+
+
+class SecretCache(object):
+    """
+    Bounded LRU cache of identity -> secret lookups with a TTL.
+
+    Unknown identities are cached as well, for `negative_ttl` seconds, so
+    floods of invalid identities do not reach Mongo.
+
+    :param maxsize: number of identities kept, the least recently used go first
+    :param ttl: seconds a found secret is kept
+    :param negative_ttl: seconds an unknown identity is kept
+    """
+
+    def __init__(self, maxsize=4096, ttl=300, negative_ttl=30, clock=time.monotonic):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.clock = clock
+        self._entries = collections.OrderedDict()  # identity -> (expires, secret)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def lookup(self, identity):
+        """Return `(True, secret)` on a hit, `(False, None)` on a miss"""
+        with self._lock:
+            entry = self._entries.get(identity)
+            if entry is not None and entry[0] > self.clock():
+                self._entries.move_to_end(identity)
+                self.hits += 1
+                return True, entry[1]
+            self.misses += 1
+            return False, None
+
+    def store(self, identity, secret):
+        ttl = self.ttl if secret is not None else self.negative_ttl
+        with self._lock:
+            self._entries[identity] = (self.clock() + ttl, secret)
+            self._entries.move_to_end(identity)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, identity):
+        with self._lock:
+            self._entries.pop(identity, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
 
-    def update(self):
-        self.last_invoked = datetime.utcnow
-        self.save()
-        self.user.update()
+    def stats(self) -> dict:
+        return {
+            "size": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
 
 
-User.register_delete_rule(Secret, "secrets", mongoengine.PULL)
+secret_cache = SecretCache(
+    maxsize=int(os.environ.get("SECRET_CACHE_SIZE", "4096")),
+    ttl=float(os.environ.get("SECRET_CACHE_TTL", "300")),
+    negative_ttl=float(os.environ.get("SECRET_CACHE_NEGATIVE_TTL", "30")),
+)
@@ -0,0 +1,19 @@
+from __future__ import annotations
+import mongoengine
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class CacheVersion(mongoengine.Document):
+    """Counts the changes to a cached collection, so every process drops its copies"""
+
+    name = mongoengine.StringField(primary_key=True)
+    version = mongoengine.IntField(default=0)
+    # keys of the latest changes, oldest first
+    changed = mongoengine.ListField(mongoengine.StringField())
+
+    meta = {
+        "db_alias": "core",
+        "collection": "cache_versions",
+    }
@@ -0,0 +1,66 @@
+import collections
+import logging
+import os
+
+import db
+
+logger = logging.getLogger(__name__)
+
+
+class Deduplicator(object):
+    """
+    Recognises GitHub redeliveries by their `X-Github-Delivery` GUID.
+
+    Recent GUIDs are kept in a bounded in-memory set, older ones are found
+    through the TTL-indexed `seen_deliveries` collection. A delivery is
+    claimed when it is first seen and released if it is not accepted in
+    the end, so GitHub's redelivery of a failed one is not suppressed.
+
+    :param maxsize: number of GUIDs kept in memory
+    """
+
+    def __init__(self, maxsize=50000):
+        self.maxsize = maxsize
+        self._recent = collections.OrderedDict()
+        self.checked = 0
+        self.suppressed = 0
+
+    def _remember(self, guid):
+        self._recent[guid] = None
+        if len(self._recent) > self.maxsize:
+            self._recent.popitem(last=False)
+
+    async def is_duplicate(self, guid) -> bool:
+        if guid is None:
+            return False
+        self.checked += 1
+        if guid in self._recent:
+            self.suppressed += 1
+            return True
+        claimed = await db.repository.claim_delivery(guid)
+        # only known once the claim is recorded, a failed one is retried
+        self._remember(guid)
+        if not claimed:
+            self.suppressed += 1
+            return True
+        return False
+
+    async def release(self, guid):
+        """Undo the claim of `is_duplicate` for a delivery that was not accepted"""
+        if guid is None:
+            return
+        self._recent.pop(guid, None)
+        try:
+            await db.repository.release_delivery(guid)
+        except Exception:  # pylint: disable=broad-except
+            logger.exception("could not release delivery %s", guid)
+
+    def stats(self) -> dict:
+        return {
+            "size": len(self._recent),
+            "checked": self.checked,
+            "suppressed": self.suppressed,
+        }
+
+
+deduplicator = Deduplicator(maxsize=int(os.environ.get("DEDUP_SIZE", "50000")))
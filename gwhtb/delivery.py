@@ -0,0 +1,412 @@
+import asyncio
+import heapq
+import itertools
+import logging
+import os
+import random
+import threading
+import time
+from datetime import datetime, timedelta
+
+import mongoengine
+import telegram
+
+import db
+from tools import retry_after_seconds
+
+logger = logging.getLogger(__name__)
+
+# errors that will not go away by retrying the same request
+PERMANENT_ERRORS = (
+    telegram.error.BadRequest,
+    telegram.error.Forbidden,
+    telegram.error.InvalidToken,
+)
+
+
+class Deferred(Exception):
+    """Raised by a handler to put its job back for `delay` seconds, not an attempt"""
+
+    def __init__(self, delay):
+        super().__init__(f"deferred for {delay:.1f}s")
+        self.delay = delay
+
+
+class Job(object):
+    def __init__(self, id, payload, attempts=0):
+        self.id = id
+        self.payload = payload
+        self.attempts = attempts
+        self.last_error = None
+
+
+class MemoryBackend(object):
+    """Process-local queue. Nothing survives a restart, use it for tests and local runs."""
+
+    blocking = False
+    durable = False
+    heartbeat = None  # nothing is leased
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._ids = itertools.count(1)
+        self._pending = []  # heap of (due, id, job)
+        self._in_flight = {}
+        self.dead = []
+
+    def put(self, payload):
+        with self._lock:
+            job = Job(id=next(self._ids), payload=payload)
+            heapq.heappush(self._pending, (time.time(), job.id, job))
+        return job.id
+
+    def put_many(self, payloads):
+        return [self.put(payload) for payload in payloads]
+
+    def claim(self):
+        with self._lock:
+            if not self._pending or self._pending[0][0] > time.time():
+                return None
+            _, _, job = heapq.heappop(self._pending)
+            self._in_flight[job.id] = job
+            return job
+
+    def ack(self, job):
+        with self._lock:
+            self._in_flight.pop(job.id, None)
+
+    def retry(self, job, delay, error):
+        with self._lock:
+            self._in_flight.pop(job.id, None)
+            job.attempts += 1
+            job.last_error = error
+            heapq.heappush(self._pending, (time.time() + delay, job.id, job))
+
+    def defer(self, job, delay):
+        with self._lock:
+            self._in_flight.pop(job.id, None)
+            heapq.heappush(self._pending, (time.time() + delay, job.id, job))
+
+    def bury(self, job, error):
+        with self._lock:
+            self._in_flight.pop(job.id, None)
+            job.attempts += 1
+            job.last_error = error
+            self.dead.append(job)
+
+    def depth(self):
+        with self._lock:
+            return len(self._pending) + len(self._in_flight)
+
+    def due(self):
+        """Jobs in flight or claimable now, retries planned for later excluded"""
+        now = time.time()
+        with self._lock:
+            return len(self._in_flight) + sum(
+                1 for due, _, _ in self._pending if due <= now
+            )
+
+    def warm_up(self):
+        pass
+
+
+class MongoBackend(object):
+    """Queue persisted in the `deliveries` collection of the `core` connection.
+
+    Claimed jobs are leased and the lease is renewed while they are handled,
+    if a worker dies before acking, the job becomes claimable again once
+    `lease` expires.
+    """
+
+    blocking = True
+    durable = True
+
+    def __init__(self, queue="telegram", lease=60):
+        self.queue = queue
+        self.lease = timedelta(seconds=lease)
+        # seconds between two renewals of the lease of a job in flight
+        self.heartbeat = lease / 3
+
+    def warm_up(self):
+        # the first access creates the indexes, better here than in a request
+        db.Delivery._get_collection()  # pylint: disable=protected-access
+
+    def put(self, payload):
+        delivery = db.Delivery(queue=self.queue, payload=payload)
+        delivery.save()
+        return delivery.id
+
+    def put_many(self, payloads):
+        deliveries = db.Delivery.objects.insert(
+            [db.Delivery(queue=self.queue, payload=payload) for payload in payloads]
+        )
+        return [delivery.id for delivery in deliveries]
+
+    def claim(self):
+        now = datetime.utcnow()
+        # a lease that expired means the worker died or hung handling the
+        # job, that counts as an attempt, or a job killing its worker would
+        # be taken again forever
+        delivery = (
+            db.Delivery.objects(
+                queue=self.queue, status="in_flight", locked_until__lte=now
+            )
+            .order_by("locked_until")
+            .modify(
+                new=True,
+                set__locked_until=now + self.lease,
+                inc__attempts=1,
+                set__last_error="lease expired",
+            )
+        )
+        if delivery is None:
+            delivery = (
+                db.Delivery.objects(
+                    queue=self.queue, status="pending", next_attempt__lte=now
+                )
+                .order_by("next_attempt")
+                .modify(
+                    new=True,
+                    set__status="in_flight",
+                    set__locked_until=now + self.lease,
+                )
+            )
+        if delivery is None:
+            return None
+        # plain dicts, mongoengine's are tied to the document through a weakref
+        # that dies with it, so the handler could not record its progress
+        payload = delivery.to_mongo()["payload"]
+        return Job(id=delivery.id, payload=payload, attempts=delivery.attempts)
+
+    def extend(self, job):
+        db.Delivery.objects(id=job.id, status="in_flight").update_one(
+            set__locked_until=datetime.utcnow() + self.lease
+        )
+
+    def ack(self, job):
+        db.Delivery.objects(id=job.id).delete()
+
+    def retry(self, job, delay, error):
+        db.Delivery.objects(id=job.id).update_one(
+            set__status="pending",
+            # keeps the progress the handler recorded in the payload
+            set__payload=job.payload,
+            inc__attempts=1,
+            set__next_attempt=datetime.utcnow() + timedelta(seconds=delay),
+            set__last_error=error,
+            unset__locked_until=True,
+        )
+
+    def defer(self, job, delay):
+        db.Delivery.objects(id=job.id).update_one(
+            set__status="pending",
+            set__payload=job.payload,
+            set__next_attempt=datetime.utcnow() + timedelta(seconds=delay),
+            unset__locked_until=True,
+        )
+
+    def bury(self, job, error):
+        db.Delivery.objects(id=job.id).update_one(
+            set__status="dead",
+            inc__attempts=1,
+            set__dead_at=datetime.utcnow(),
+            set__last_error=error,
+            unset__locked_until=True,
+        )
+
+    def depth(self):
+        return db.Delivery.objects(
+            queue=self.queue, status__in=("pending", "in_flight")
+        ).count()
+
+
+class DeliveryQueue(object):
+    """
+    Outbound queue drained by a pool of async workers.
+
+    :param backend: `MongoBackend` or `MemoryBackend`
+    :param handler: coroutine function called with the payload of each job
+    :param workers: number of concurrent workers
+    :param max_attempts: attempts before a job is moved to the dead letters
+    :param base_delay: first retry delay in seconds, doubled on every attempt
+    :param max_delay: upper bound of the retry delay in seconds
+    :param poll_interval: how often idle workers look for due retries
+    """
+
+    def __init__(
+        self,
+        backend,
+        handler,
+        workers=4,
+        max_attempts=8,
+        base_delay=1.0,
+        max_delay=300.0,
+        poll_interval=1.0,
+    ):
+        self.backend = backend
+        self.handler = handler
+        self.workers = workers
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.poll_interval = poll_interval
+        self._loop = None
+        self._event = None
+        self._tasks = []
+        self._stopping = False
+
+    async def _run(self, func, *args):
+        if self.backend.blocking:
+            return await asyncio.get_running_loop().run_in_executor(None, func, *args)
+        return func(*args)
+
+    def _wake(self):
+        if self._loop is not None:
+            self._loop.call_soon_threadsafe(self._event.set)
+
+    async def put(self, payload):
+        job_id = await self._run(self.backend.put, payload)
+        self._wake()
+        return job_id
+
+    async def put_many(self, payloads):
+        """Persist several jobs at once, e.g. one per target of a secret"""
+        job_ids = await self._run(self.backend.put_many, payloads)
+        self._wake()
+        return job_ids
+
+    async def depth(self):
+        return await self._run(self.backend.depth)
+
+    async def warm_up(self):
+        await self._run(self.backend.warm_up)
+
+    def backoff(self, attempts):
+        delay = min(self.max_delay, self.base_delay * 2**attempts)
+        return delay * random.uniform(0.5, 1.0)
+
+    async def _process(self, job):
+        if job.attempts >= self.max_attempts:
+            # only re-claims after an expired lease get here, `_retry` buries
+            # the jobs that fail in the handler
+            logger.warning(
+                "job %s dead-lettered after %s attempts: lease expired",
+                job.id,
+                job.attempts,
+            )
+            await self._run(self.backend.bury, job, "lease expired")
+            return
+        # a handler waiting for a busy chat may outlive the lease of its job
+        heartbeat = None
+        if self.backend.heartbeat:
+            heartbeat = asyncio.create_task(self._keep_leased(job))
+        try:
+            await self.handler(job.payload)
+        except Deferred as deferred:
+            await self._run(self.backend.defer, job, deferred.delay)
+        except telegram.error.RetryAfter as error:
+            # the scheduler absorbed a few of these already
+            await self._retry(job, retry_after_seconds(error), error)
+        except PERMANENT_ERRORS as error:
+            logger.warning("job %s dead-lettered: %s", job.id, error)
+            await self._run(self.backend.bury, job, str(error))
+        except Exception as error:  # pylint: disable=broad-except
+            await self._retry(job, self.backoff(job.attempts), error)
+        else:
+            await self._run(self.backend.ack, job)
+        finally:
+            if heartbeat is not None:
+                heartbeat.cancel()
+
+    async def _retry(self, job, delay, error):
+        """Retry `job` in `delay` seconds, or bury it after `max_attempts`"""
+        if job.attempts + 1 >= self.max_attempts:
+            logger.warning(
+                "job %s dead-lettered after %s attempts: %s",
+                job.id,
+                job.attempts + 1,
+                error,
+            )
+            await self._run(self.backend.bury, job, str(error))
+        else:
+            logger.info("job %s failed, retrying in %.1fs: %s", job.id, delay, error)
+            await self._run(self.backend.retry, job, delay, str(error))
+
+    async def _keep_leased(self, job):
+        while True:
+            await asyncio.sleep(self.backend.heartbeat)
+            try:
+                await self._run(self.backend.extend, job)
+            except Exception:  # pylint: disable=broad-except
+                logger.exception("could not extend the lease of job %s", job.id)
+
+    async def _worker(self):
+        while not self._stopping:
+            try:
+                job = await self._run(self.backend.claim)
+            except Exception:  # pylint: disable=broad-except
+                logger.exception("could not claim a delivery")
+                job = None
+            if job is None:
+                self._event.clear()
+                try:
+                    await asyncio.wait_for(self._event.wait(), self.poll_interval)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            await self._process(job)
+
+    async def start(self):
+        self._loop = asyncio.get_running_loop()
+        self._event = asyncio.Event()
+        self._stopping = False
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    async def stop(self, timeout=10.0):
+        """Let workers finish the job at hand, then stop them"""
+        self._stopping = True
+        if self._event is not None:
+            self._event.set()
+        if not self._tasks:
+            return
+        _, pending = await asyncio.wait(self._tasks, timeout=timeout)
+        for task in pending:
+            task.cancel()
+        self._tasks = []
+
+    async def drain(self, timeout=10.0):
+        """
+        `stop`, after sending what a restart would lose.
+
+        A durable backend keeps pending jobs for the next leader, only the
+        ones at hand are finished. A process-local one is worked off until
+        nothing is due or `timeout` runs out.
+        """
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        if not self.backend.durable:
+            while self._tasks and loop.time() < deadline and self.backend.due():
+                await asyncio.sleep(0.05)
+        await self.stop(timeout=max(0.0, deadline - loop.time()))
+        if not self.backend.durable:
+            left = self.backend.depth()
+            if left:
+                logger.warning("%s deliveries were not sent before shutdown", left)
+
+
+def from_env(handler, queue="telegram", **kwargs):
+    """Build a delivery queue from `DELIVERY_*` environment variables,
+    `kwargs` override the `DeliveryQueue` settings"""
+    if os.environ.get("DELIVERY_BACKEND", "mongo") == "memory":
+        backend = MemoryBackend()
+    else:
+        backend = MongoBackend(
+            queue=queue, lease=int(os.environ.get("DELIVERY_LEASE", "60"))
+        )
+    settings = {
+        "workers": int(os.environ.get("DELIVERY_WORKERS", "4")),
+        "max_attempts": int(os.environ.get("DELIVERY_MAX_ATTEMPTS", "8")),
+        "poll_interval": float(os.environ.get("DELIVERY_POLL_INTERVAL", "1")),
+    }
+    settings.update(kwargs)
+    return DeliveryQueue(backend=backend, handler=handler, **settings)
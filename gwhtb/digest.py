@@ -0,0 +1,126 @@
+import asyncio
+import logging
+
+from formatter import pack
+from webhook import _push_blocks
+
+logger = logging.getLogger(__name__)
+
+# choices offered in the secrets menu, in seconds
+WINDOWS = (0, 30, 120, 600)
+
+
+def merge(events) -> list:
+    """Render buffered `(event_type, data, messages)` events as few messages.
+
+    Consecutive pushes to the same ref are merged into a single commit list.
+    A push that cannot be rendered again keeps the messages of its events.
+    """
+    entries = []  # (key, data, messages), key is None for a single event
+    for event_type, data, messages in events:
+        # branch deletions come without commits and without a head commit
+        if (
+            event_type == "push"
+            and data.get("commits") is not None
+            and data.get("head_commit") is not None
+        ):
+            key = (data["repository"]["full_name"], data["ref"])
+            if entries and entries[-1][0] == key:
+                merged = entries[-1][1]
+                merged["size"] = _push_size(merged) + _push_size(data)
+                merged["commits"] = merged["commits"] + data["commits"]
+                merged["head_commit"] = data["head_commit"]
+                # a single compare link does not cover the merged pushes
+                merged.pop("compare", None)
+                entries[-1][2].extend(messages)
+            else:
+                entries.append((key, dict(data), list(messages)))
+        else:
+            entries.append((None, None, messages))
+
+    blocks = [f"*Digest* \\({len(events)} events\\)"]
+    for key, data, messages in entries:
+        if key is None:
+            blocks.extend(messages)
+            continue
+        try:
+            # rendered in full first, a push failing halfway adds no blocks
+            blocks.extend(list(_push_blocks(data)))
+        except (KeyError, IndexError, TypeError):
+            blocks.extend(messages)
+    return pack(blocks)
+
+
+def _push_size(data) -> int:
+    return max(data.get("size") or 0, len(data["commits"]))
+
+
+class Digest(object):
+    """
+    Buffers events per chat, or forum topic, and sends them merged once the
+    window of the first buffered event closes or `max_events` are buffered.
+
+    :param outbox: `delivery.DeliveryQueue` the merged messages are put in
+    """
+
+    def __init__(self, outbox):
+        self.outbox = outbox
+        self._loop = None
+        self._buffers = {}
+        self._timers = {}
+        self._puts = set()
+
+    async def start(self):
+        self._loop = asyncio.get_running_loop()
+
+    def add(
+        self, chat_id, window, max_events, event_type, data, messages, thread_id=None
+    ):
+        """Buffer an event for `chat_id`. Safe to call from any thread."""
+        self._loop.call_soon_threadsafe(
+            self._add,
+            (chat_id, thread_id),
+            window,
+            max_events,
+            event_type,
+            data,
+            messages,
+        )
+
+    def _add(self, key, window, max_events, event_type, data, messages):
+        buffer = self._buffers.setdefault(key, [])
+        buffer.append((event_type, data, messages))
+        if len(buffer) >= max_events:
+            self._flush(key)
+        elif key not in self._timers:
+            self._timers[key] = self._loop.call_later(window, self._flush, key)
+
+    def _flush(self, key):
+        timer = self._timers.pop(key, None)
+        if timer is not None:
+            timer.cancel()
+        events = self._buffers.pop(key, None)
+        if not events:
+            return
+        chat_id, thread_id = key
+        logger.debug("flushing %s events for chat %s", len(events), chat_id)
+        try:
+            texts = merge(events)
+        except Exception:  # pylint: disable=broad-except
+            # runs from a timer, an error here would lose the whole buffer
+            logger.exception("could not merge %s events for %s", len(events), chat_id)
+            texts = pack([text for _, _, messages in events for text in messages])
+        put = asyncio.ensure_future(
+            self.outbox.put(
+                {"chat_id": chat_id, "thread_id": thread_id, "texts": texts}
+            )
+        )
+        self._puts.add(put)
+        put.add_done_callback(self._puts.discard)
+
+    async def stop(self):
+        """Send whatever is buffered"""
+        for key in list(self._buffers):
+            self._flush(key)
+        if self._puts:
+            await asyncio.wait(self._puts)
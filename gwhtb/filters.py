@@ -0,0 +1,96 @@
+import fnmatch
+import functools
+import re
+
+from webhook import EVENT_DESCRIPTIONS, FUNC_EVENT_FORMATS
+
+# events that can be toggled from the secrets menu
+EVENTS = tuple(sorted(set(EVENT_DESCRIPTIONS) | set(FUNC_EVENT_FORMATS)))
+
+# choices offered in the secrets menu, cycled like the digest windows
+BRANCH_PRESETS = (
+    (),
+    ("main", "master"),
+    ("main", "master", "release/*"),
+    ("refs/tags/*",),
+)
+ACTION_PRESETS = (
+    (),
+    (
+        "pull_request:opened",
+        "pull_request:closed",
+        "pull_request:reopened",
+        "issues:opened",
+        "issues:closed",
+        "release:published",
+    ),
+)
+
+
+def _ref(event_type, data):
+    """Branch an event is about, `refs/heads/` stripped, None if it has none"""
+    if event_type in ("pull_request", "pull_request_review"):
+        ref = data.get("pull_request", {}).get("base", {}).get("ref")
+    else:
+        ref = data.get("ref")
+    if not isinstance(ref, str):
+        return None
+    if ref.startswith("refs/heads/"):
+        return ref[len("refs/heads/") :]
+    return ref
+
+
+class Matcher(object):
+    """
+    Subscription rules of a secret, compiled once.
+
+    :param events: allowed event types, all when empty
+    :param branches: globs the ref of an event must match, e.g. `release/*`
+    :param actions: `event:action` pairs, an event listed here is only let
+        through for its listed actions
+    """
+
+    __slots__ = ("events", "branches", "actions")
+
+    def __init__(self, events=(), branches=(), actions=()):
+        self.events = frozenset(events)
+        self.branches = (
+            re.compile("|".join(fnmatch.translate(glob) for glob in branches))
+            if branches
+            else None
+        )
+        allowed = {}
+        for rule in actions:
+            event_type, _, action = rule.partition(":")
+            allowed.setdefault(event_type, set()).add(action)
+        self.actions = {key: frozenset(value) for key, value in allowed.items()}
+
+    def accepts_event(self, event_type) -> bool:
+        """Check the event type alone, before the payload is parsed"""
+        # the ping GitHub sends on creating a hook confirms the setup
+        return not self.events or event_type in self.events or event_type == "ping"
+
+    def accepts(self, event_type, data) -> bool:
+        """Check the ref and action of a parsed payload"""
+        if self.branches is not None:
+            ref = _ref(event_type, data)
+            if ref is not None and self.branches.match(ref) is None:
+                return False
+        actions = self.actions.get(event_type)
+        if actions is not None and data.get("action") not in actions:
+            return False
+        return True
+
+
+@functools.lru_cache(maxsize=1024)
+def _compile(events, branches, actions) -> Matcher:
+    return Matcher(events=events, branches=branches, actions=actions)
+
+
+def for_secret(secret) -> Matcher:
+    """Matcher of `secret`, shared by all secrets with the same rules"""
+    return _compile(
+        tuple(secret.events or ()),
+        tuple(secret.branches or ()),
+        tuple(secret.actions or ()),
+    )
@@ -0,0 +1,160 @@
+import re
+import string
+
+from tools import markdown_char_escape as mksc
+
+_FIELD = re.compile(r"^(\w+)((?:\[[^\]]+\])*)$")
+_INDEX = re.compile(r"\[([^\]]+)\]")
+_CONVERSIONS = {"r": repr, "s": str, "a": ascii}
+
+# values a template may render, a dict or a list would be written out whole
+_SCALARS = (str, int, float, type(None))
+
+# longest value a template renders, longer ones are cut
+VALUE_MAX_LENGTH = 1024
+
+# logins, actions and repository names come back with almost every event,
+# short values are escaped once
+_ESCAPED = {}  # value -> escaped value
+_ESCAPED_MAX_LENGTH = 64
+_ESCAPED_MAX_SIZE = 4096
+
+
+def _escape(value) -> str:
+    """Escape a value cut to `VALUE_MAX_LENGTH`, short values are kept escaped"""
+    if len(value) > VALUE_MAX_LENGTH:
+        return mksc(value[: VALUE_MAX_LENGTH - 1] + "…")
+    escaped = mksc(value)
+    if len(value) <= _ESCAPED_MAX_LENGTH:
+        if len(_ESCAPED) >= _ESCAPED_MAX_SIZE:
+            _ESCAPED.clear()
+        _ESCAPED[value] = escaped
+    return escaped
+
+
+def _field_path(field_name):
+    """`comment[user][login]` -> `("comment", "user", "login")`, like `str.format`"""
+    match = _FIELD.match(field_name)
+    if match is None:
+        raise ValueError(f"unsupported field {field_name!r}")
+    path = [match.group(1)]
+    for key in _INDEX.findall(match.group(2)):
+        path.append(int(key) if key.isdigit() else key)
+    return tuple(path)
+
+
+def _field_value(path, value, spec, conversion) -> str:
+    if not isinstance(value, _SCALARS):
+        raise TypeError(f"{'.'.join(map(str, path))} is not a single value")
+    if conversion:
+        value = _CONVERSIONS[conversion](value)
+    return format(value, spec)
+
+
+class Template(object):
+    """
+    A `str.format` template compiled once into field paths and a format string.
+
+    Rendering looks the fields up in the payload, escapes them for MarkdownV2
+    and fills them in with a single `str.format` call, the literal parts are
+    escaped at compile time.
+
+    :param source: template using `str.format` syntax, e.g. `{sender[login]}`
+    """
+
+    __slots__ = ("source", "_fields", "_format")
+
+    def __init__(self, source):
+        self.source = source
+        fields, parts = [], []
+        for literal, field, spec, conversion in string.Formatter().parse(source):
+            parts.append(mksc(literal).replace("{", "{{").replace("}", "}}"))
+            if field is not None:
+                parts.append("{}")
+                fields.append((_field_path(field), spec or "", conversion))
+        self._fields = tuple(fields)
+        self._format = "".join(parts).format
+
+    @property
+    def paths(self) -> tuple:
+        """Field paths the template reads, e.g. `("sender", "login")`"""
+        return tuple(path for path, _spec, _conversion in self._fields)
+
+    @property
+    def specs(self) -> tuple:
+        """Format spec and conversion of every field, e.g. `(".7", None)`"""
+        return tuple((spec, conversion) for _path, spec, conversion in self._fields)
+
+    def render(self, data) -> str:
+        """
+        Raise `KeyError`, `IndexError` or `TypeError` if a field is missing
+        or holds a dict or a list. Values are cut to `VALUE_MAX_LENGTH`.
+        """
+        values = []
+        for path, spec, conversion in self._fields:
+            value = data
+            for key in path:
+                value = value[key]
+            if spec or conversion or value.__class__ is not str:
+                if value.__class__ is int and value >= 0 and not spec:
+                    # digits need no escaping
+                    values.append(str(value))
+                    continue
+                value = _field_value(path, value, spec, conversion)
+            escaped = _ESCAPED.get(value)
+            values.append(_escape(value) if escaped is None else escaped)
+        return self._format(*values)
+
+
+# Telegram rejects messages longer than this many UTF-16 code units
+MESSAGE_LIMIT = 4096
+
+
+def message_length(text) -> int:
+    """Length of `text` as Telegram counts it"""
+    if text.isascii():
+        return len(text)
+    return len(text.encode("utf-16-le")) // 2
+
+
+def truncate_escaped(text, width) -> str:
+    """Cut escaped MarkdownV2 `text` to at most `width` characters.
+
+    The cut never separates a backslash from the character it escapes, so
+    an entity wrapped around the result stays well formed.
+    """
+    if message_length(text) <= width:
+        return text
+    cut = text[: width - 1]
+    while message_length(cut) > width - 1:
+        cut = cut[:-1]
+    backslashes = len(cut) - len(cut.rstrip("\\"))
+    if backslashes % 2:
+        cut = cut[:-1]
+    return cut + "…"
+
+
+def pack(blocks, limit=MESSAGE_LIMIT, separator="\n\n") -> list:
+    """
+    Join formatted blocks into as few messages as fit in `limit`.
+
+    Blocks are consumed lazily and never split between two messages, so
+    every entity opened in a block is closed in the same message.
+
+    :param blocks: iterable of escaped MarkdownV2 blocks, each self-contained
+    """
+    messages, current, size = [], [], 0
+    gap = message_length(separator)
+    for block in blocks:
+        length = message_length(block)
+        if length > limit:
+            block = truncate_escaped(block, limit)
+            length = message_length(block)
+        if current and size + gap + length > limit:
+            messages.append(separator.join(current))
+            current, size = [], 0
+        size += length + (gap if current else 0)
+        current.append(block)
+    if current:
+        messages.append(separator.join(current))
+    return messages
@@ -0,0 +1,161 @@
+import asyncio
+import logging
+import os
+import socket
+import uuid
+from datetime import datetime, timedelta
+
+import pymongo
+from pymongo.errors import DuplicateKeyError
+
+import db
+
+logger = logging.getLogger(__name__)
+
+
+class LocalLease(object):
+    """Always held, for a single process running with the memory backends"""
+
+    blocking = False
+
+    def __init__(self):
+        self.holder = f"{socket.gethostname()}:{os.getpid()}"
+
+    def acquire(self) -> bool:
+        return True
+
+    def release(self):
+        pass
+
+
+class MongoLease(object):
+    """
+    Lease in the `leases` collection, shared by every process and node.
+
+    Whoever holds it renews it before `ttl` runs out, anyone else takes it
+    over once it has expired.
+
+    :param name: name of the lease
+    :param ttl: seconds the lease is held without being renewed
+    """
+
+    blocking = True
+
+    def __init__(self, name="leader", ttl=15):
+        self.name = name
+        self.ttl = timedelta(seconds=ttl)
+        self.holder = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+
+    def acquire(self) -> bool:
+        """Take or renew the lease, False if someone else holds it"""
+        now = datetime.utcnow()
+        try:
+            lease = db.Lease._get_collection().find_one_and_update(
+                {
+                    "_id": self.name,
+                    "$or": [{"holder": self.holder}, {"expires": {"$lte": now}}],
+                },
+                {"$set": {"holder": self.holder, "expires": now + self.ttl}},
+                upsert=True,
+                return_document=pymongo.ReturnDocument.AFTER,
+            )
+        except DuplicateKeyError:
+            # the lease exists, is held by someone else and has not expired
+            return False
+        return lease is not None and lease["holder"] == self.holder
+
+    def release(self):
+        db.Lease._get_collection().delete_one({"_id": self.name, "holder": self.holder})
+
+
+class Coordinator(object):
+    """
+    Runs the duties only one process may run while it holds the lease.
+
+    :param lease: `MongoLease` or `LocalLease`
+    :param on_elected: coroutine function called when the lease is taken
+    :param on_demoted: coroutine function called when it is lost or released
+    :param interval: seconds between renewals, a third of the lease by default
+    """
+
+    def __init__(self, lease, on_elected, on_demoted, interval=5.0):
+        self.lease = lease
+        self.on_elected = on_elected
+        self.on_demoted = on_demoted
+        self.interval = interval
+        self.is_leader = False
+        self._task = None
+
+    async def _run(self, func):
+        if self.lease.blocking:
+            return await asyncio.get_running_loop().run_in_executor(None, func)
+        return func()
+
+    async def _step(self):
+        try:
+            acquired = await self._run(self.lease.acquire)
+        except Exception:  # pylint: disable=broad-except
+            # without a renewal the lease runs out, act as if it already did
+            logger.exception("could not renew the leader lease")
+            acquired = False
+        if acquired and not self.is_leader:
+            logger.info("%s is the leader", self.lease.holder)
+            self.is_leader = True
+            try:
+                await self.on_elected()
+            except Exception:  # pylint: disable=broad-except
+                # half started duties are stopped, another process may lead
+                logger.exception("%s could not take the lead", self.lease.holder)
+                await self._demote()
+        elif not acquired and self.is_leader:
+            logger.warning("%s lost the leader lease", self.lease.holder)
+            await self._demote(release=False)
+
+    async def _demote(self, release=True):
+        self.is_leader = False
+        try:
+            await self.on_demoted()
+        except Exception:  # pylint: disable=broad-except
+            logger.exception("%s could not step down cleanly", self.lease.holder)
+        if release:
+            try:
+                await self._run(self.lease.release)
+            except Exception:  # pylint: disable=broad-except
+                # it runs out on its own
+                logger.exception("could not release the leader lease")
+
+    async def _renew_forever(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self._step()
+            except Exception:  # pylint: disable=broad-except
+                # a dead loop would keep the lead without renewing the lease
+                logger.exception("leader election failed")
+
+    async def start(self):
+        await self._step()
+        self._task = asyncio.create_task(self._renew_forever())
+
+    async def stop(self):
+        """Give up the lease so another process takes over right away"""
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        if self.is_leader:
+            await self._demote()
+
+    def stats(self) -> dict:
+        return {"leader": self.is_leader, "holder": self.lease.holder}
+
+
+def from_env(on_elected, on_demoted) -> Coordinator:
+    """Build the coordinator from `LEADER_*` environment variables.
+
+    With the memory backends nothing is shared between processes, so the
+    process is always the leader.
+    """
+    if os.environ.get("DELIVERY_BACKEND", "mongo") == "memory":
+        return Coordinator(LocalLease(), on_elected, on_demoted)
+    ttl = float(os.environ.get("LEADER_LEASE", "15"))
+    return Coordinator(MongoLease(ttl=ttl), on_elected, on_demoted, interval=ttl / 3)
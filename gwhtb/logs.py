@@ -0,0 +1,159 @@
+import atexit
+import datetime
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import random
+import re
+
+# attributes every LogRecord has, anything else was passed with `extra=`
+_RECORD_ATTRIBUTES = frozenset(
+    logging.LogRecord("", 0, "", 0, "", (), None).__dict__
+) | {"message", "asctime"}
+
+# bot tokens show up in Bot API URLs, signatures and secrets in payloads
+_REDACTIONS = (
+    (re.compile(r"bot\d+:[\w-]+"), "bot<token>"),
+    (re.compile(r"sha256=[0-9a-fA-F]{64}"), "sha256=<signature>"),
+    (
+        re.compile(r"""(["']?(?:secret|token)["']?\s*[:=]\s*["']?)[^"'\s,&}]+""", re.I),
+        r"\1<redacted>",
+    ),
+)
+
+
+def redact(text: str) -> str:
+    for pattern, replacement in _REDACTIONS:
+        text = pattern.sub(replacement, text)
+    return text
+
+
+def truncate(text: str, limit: int) -> str:
+    if limit and len(text) > limit:
+        return f"{text[:limit]}... ({len(text) - limit} more characters)"
+    return text
+
+
+class SamplingFilter(logging.Filter):
+    """
+    Keeps a share of the records below WARNING, warnings and errors are
+    always kept.
+
+    :param rate: share of the DEBUG and INFO records kept, 1.0 keeps all
+    """
+
+    def __init__(self, rate=1.0):
+        super().__init__()
+        self.rate = rate
+
+    def filter(self, record) -> bool:
+        if self.rate >= 1.0 or record.levelno >= logging.WARNING:
+            return True
+        return random.random() < self.rate
+
+
+def render_message(record, max_length) -> str:
+    """Message of `record`, redacted and truncated"""
+    return truncate(redact(record.getMessage()), max_length)
+
+
+class TextFormatter(logging.Formatter):
+    def __init__(self, max_length=2000):
+        super().__init__("%(asctime)s - %(name)s - %(levelname)s - %(message)s")
+        self.max_length = max_length
+
+    def formatMessage(self, record) -> str:
+        record.message = render_message(record, self.max_length)
+        return super().formatMessage(record)
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per line, fields passed with `extra=` are included"""
+
+    def __init__(self, max_length=2000):
+        super().__init__()
+        self.max_length = max_length
+
+    def format(self, record) -> str:
+        entry = {
+            "time": datetime.datetime.fromtimestamp(
+                record.created, datetime.timezone.utc
+            ).isoformat(),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": render_message(record, self.max_length),
+        }
+        for key, value in record.__dict__.items():
+            if key not in _RECORD_ATTRIBUTES:
+                entry[key] = value
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry["exception"] = redact(record.exc_text)
+        return json.dumps(entry, default=str, ensure_ascii=False)
+
+
+class LazyQueueHandler(logging.handlers.QueueHandler):
+    """
+    `QueueHandler` that leaves formatting to the listener thread.
+
+    The stock handler merges the message and arguments before queueing,
+    which puts the formatting cost back on the event loop. Only the
+    traceback is rendered here, so its frames are not kept alive.
+    """
+
+    def prepare(self, record):
+        if record.exc_info:
+            if not record.exc_text:
+                record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+_listener = None
+
+
+def configure():
+    """
+    Route all logging through a queue drained by a background thread.
+
+    Configured with `LOG_LEVEL` (default INFO), `LOG_FORMAT` (`text` or
+    `json`), `LOG_SAMPLE_RATE` (share of DEBUG and INFO records kept) and
+    `LOG_MAX_LENGTH` (characters kept of a message, 0 keeps everything).
+    """
+    global _listener
+    if _listener is not None:
+        return
+
+    level = os.environ.get("LOG_LEVEL", "INFO").upper()
+    max_length = int(os.environ.get("LOG_MAX_LENGTH", "2000"))
+    if os.environ.get("LOG_FORMAT", "text") == "json":
+        formatter = JsonFormatter(max_length=max_length)
+    else:
+        formatter = TextFormatter(max_length=max_length)
+
+    output = logging.StreamHandler()
+    output.setFormatter(formatter)
+
+    records = queue.SimpleQueue()
+    handler = LazyQueueHandler(records)
+    handler.addFilter(
+        SamplingFilter(rate=float(os.environ.get("LOG_SAMPLE_RATE", "1.0")))
+    )
+
+    root = logging.getLogger()
+    for existing in list(root.handlers):
+        root.removeHandler(existing)
+    root.addHandler(handler)
+    root.setLevel(level)
+    if level != "DEBUG":
+        # one line per Bot API request
+        logging.getLogger("httpx").setLevel(logging.WARNING)
+
+    _listener = logging.handlers.QueueListener(
+        records, output, respect_handler_level=True
+    )
+    _listener.start()
+    atexit.register(_listener.stop)
@@ -1,8 +1,15 @@
 # pylint: disable=wrong-import-position, unused-import, missing-module-docstring, import-error
-from crypt import methods
+import time
+
+# start of the startup clock, imports included
+STARTED = time.perf_counter()
+
 import os
 import logging
 import asyncio
+import contextlib
+import functools
+import weakref
 
 from telegram import __version__ as TG_VER
 
@@ -25,21 +32,35 @@ from telegram.ext import (
     CommandHandler,
     ContextTypes,
     CallbackQueryHandler,
+    MessageHandler,
 )
+from telegram.ext import filters as message_filters
 
 import webhook
 from webhook import Webhook
-import uvicorn
-from asgiref.wsgi import WsgiToAsgi
-from flask import Flask, request, Response
+import admission
+import delivery
+import telegram_client
+import ratelimit
+import digest
+import filters
+import leader
+import logs
+import metrics
+import templates
+from dedup import deduplicator
+from starlette.applications import Starlette
+from starlette.requests import Request
+from starlette.responses import JSONResponse, PlainTextResponse, Response
+from starlette.routing import Route
 
 import db
 import telegram_menu
 
-# Enable logging
-logging.basicConfig(
-    format="%(asctime)s - %(name)s - %(levelname)s - %(message)s", level=logging.DEBUG
-)
+IMPORTED = time.perf_counter()
+
+# Enable logging, LOG_* variables pick the level, format and sampling
+logs.configure()
 logger = logging.getLogger(__name__)
 
 
@@ -50,23 +71,205 @@ async def help(update: Update, context: ContextTypes.DEFAULT_TYPE):
     )
 
 
-async def send_github(secret, data, formatted_data):
-    token = os.environ.get("TOKEN", None)
-    bot = telegram.Bot(token=token)
+async def send_github(bot, payload):
+    """Send the messages of a delivery in order.
+
+    `sent` is kept in the payload, a retried delivery resumes after the
+    messages that already went out. A delivery with a `thread` continues
+    the message of an earlier event, see `webhook.thread`. A delivery for a
+    busy chat is parked instead of holding its worker, see `park`.
+    """
+    chat_id = payload["chat_id"]
+    # a parked delivery comes back when the slot held for it is due
+    if not payload.pop("parked", False):
+        park(chat_id, payload)
+    thread = payload.get("thread")
+    if thread is None:
+        return await send_messages(bot, payload)
+    # two events of a thread at once would both find no message to continue
+    async with thread_lock(chat_id, payload.get("thread_id"), thread[1]):
+        return await send_messages(bot, payload)
+
+
+async def send_messages(bot, payload):
+    """`send_github` past parking, with the lock of its thread held"""
+    texts = payload.get("texts") or [payload["text"]]
+    chat_id, thread_id = payload["chat_id"], payload.get("thread_id")
+    mode, key = payload.get("thread") or (None, None)
+    previous = None
+    if key is not None and payload.get("sent", 0) == 0:
+        previous = await db.repository.message_id(chat_id, thread_id, key)
+
+    if previous is not None and mode == "edit" and len(texts) == 1:
+        if await edit_github(bot, chat_id, previous, texts[0]):
+            payload["sent"] = 1
+            # keeps the reference alive for its TTL
+            await db.repository.remember_message(chat_id, thread_id, key, previous)
+            return
+
+    first = payload.get("sent", 0)
+    for index in range(first, len(texts)):
+        if index > first:
+            park(chat_id, payload)
+        reply = None
+        if index == 0 and previous is not None and mode == "reply":
+            reply = telegram.ReplyParameters(
+                message_id=previous, allow_sending_without_reply=True
+            )
+        with metrics.TELEGRAM_SEND_SECONDS.time():
+            message = await ratelimit.scheduler.submit(
+                chat_id,
+                bot.send_message,
+                chat_id=chat_id,
+                message_thread_id=thread_id,
+                text=texts[index],
+                parse_mode=telegram.constants.ParseMode.MARKDOWN_V2,
+                disable_web_page_preview=True,
+                reply_parameters=reply,
+            )
+        payload["sent"] = index + 1
+        # only edited events start a thread, a review sent before its pull
+        # request would be edited over; replies point at the first message
+        if index == 0 and mode == "edit":
+            await db.repository.remember_message(
+                chat_id, thread_id, key, message.message_id
+            )
+
+
+# held by the delivery sending to a message thread, dropped once unused
+_thread_locks = weakref.WeakValueDictionary()
+
+
+def thread_lock(*key) -> asyncio.Lock:
+    """Lock serializing the deliveries of one `(chat_id, thread_id, key)`"""
+    lock = _thread_locks.get(key)
+    if lock is None:
+        lock = _thread_locks[key] = asyncio.Lock()
+    return lock
+
 
-    await bot.send_message(
-        chat_id=secret.chat_id,
-        text=formatted_data,
-        parse_mode=telegram.constants.ParseMode.MARKDOWN_V2,
-        disable_web_page_preview=True,
+def park(chat_id, payload):
+    """
+    Put a delivery back rather than hold a worker while its chat is busy.
+
+    :raises delivery.Deferred: if the chat cannot take a message within
+        `PARK_AFTER` seconds
+    """
+    delay = ratelimit.scheduler.park(chat_id, PARK_AFTER)
+    if delay:
+        payload["parked"] = True
+        raise delivery.Deferred(delay)
+
+
+async def edit_github(bot, chat_id, message_id, text) -> bool:
+    """Replace the text of an earlier message, False if it cannot be edited"""
+    try:
+        with metrics.TELEGRAM_SEND_SECONDS.time():
+            await ratelimit.scheduler.submit(
+                chat_id,
+                bot.edit_message_text,
+                chat_id=chat_id,
+                message_id=message_id,
+                text=text,
+                parse_mode=telegram.constants.ParseMode.MARKDOWN_V2,
+                disable_web_page_preview=True,
+            )
+    except telegram.error.BadRequest as error:
+        if "not modified" in str(error):
+            return True
+        # deleted, or too old to be edited, a new message is sent instead
+        logger.info("could not edit message %s in %s: %s", message_id, chat_id, error)
+        return False
+    return True
+
+
+def too_busy(endpoint, reason, retry_after) -> Response:
+    """503 when the endpoint is saturated, 429 when a single identity is"""
+    metrics.REJECTED_REQUESTS.labels(endpoint, reason).inc()
+    status = 429 if reason in ("key_in_flight", "rate") else 503
+    return PlainTextResponse(
+        "Too busy, retry later", status, headers={"Retry-After": str(retry_after)}
     )
 
 
-async def main() -> None:
-    """Start the bot."""
-    print("*********** Setting up DB connection")
-    db.global_init()
+@contextlib.contextmanager
+def startup_phase(name):
+    """Log and export how long a phase of the startup took"""
+    started = time.perf_counter()
+    yield
+    took = time.perf_counter() - started
+    metrics.STARTUP_SECONDS.labels(name).set(took)
+    logger.info("startup: %s took %.3fs", name, took)
+
+
+async def process_update(application, payload):
+    """Feed a Telegram update to the handlers of the leader"""
+    await application.update_queue.put(
+        Update.de_json(data=payload["update"], bot=application.bot)
+    )
+
+
+# seconds a delivery waits for its chat before it is parked in the queue, so
+# the workers keep serving other chats while a noisy one works off a backlog
+PARK_AFTER = float(os.environ.get("DELIVERY_PARK_AFTER", "1"))
+# events about the same PR, deployment or status edit or reply to one message
+MESSAGE_THREADS = os.environ.get("MESSAGE_THREADS", "1") != "0"
+
+# Telegram updates waiting for the handlers, /telegram answers 503 past this
+UPDATE_QUEUE_SIZE = int(os.environ.get("UPDATE_QUEUE_SIZE", "1000"))
+# seconds between two samples of the gauges, queue depths included
+GAUGE_SAMPLE_INTERVAL = 5
+# seconds shutdown waits for queued sends, and /ready for the database
+DRAIN_TIMEOUT = float(os.environ.get("DRAIN_TIMEOUT", "10"))
+READY_TIMEOUT = float(os.environ.get("READY_TIMEOUT", "2"))
+
+# GitHub caps webhook payloads at 25 MB
+MAX_BODY_SIZE = int(os.environ.get("MAX_BODY_SIZE", str(25 * 1024 * 1024)))
+# bodies larger than this are hashed off the event loop
+THREADED_HASH_SIZE = 1024 * 1024
+
+
+# children bound once, recording is an attribute lookup and an addition
+STAGE_SECRET_LOOKUP = metrics.GITHUB_STAGE_SECONDS.labels("secret_lookup")
+STAGE_READ_BODY = metrics.GITHUB_STAGE_SECONDS.labels("read_body")
+STAGE_HMAC = metrics.GITHUB_STAGE_SECONDS.labels("hmac")
+STAGE_PARSE = metrics.GITHUB_STAGE_SECONDS.labels("parse")
+STAGE_FORMAT = metrics.GITHUB_STAGE_SECONDS.labels("format")
+STAGE_DEDUP = metrics.GITHUB_STAGE_SECONDS.labels("dedup")
+STAGE_DB_UPDATE = metrics.GITHUB_STAGE_SECONDS.labels("db_update")
+STAGE_ENQUEUE = metrics.GITHUB_STAGE_SECONDS.labels("enqueue")
+
+
+async def read_body(request: Request, limit=MAX_BODY_SIZE):
+    """Read the request body as it streams in, None if it is over `limit` bytes"""
+    length = request.headers.get("Content-Length")
+    if length is not None and length.isdigit() and int(length) > limit:
+        return None
+    body = bytearray()
+    async for chunk in request.stream():
+        body += chunk
+        if len(body) > limit:
+            return None
+    return bytes(body)
+
+
+async def verify(wbh: Webhook, headers, body) -> bool:
+    """`Webhook.verify`, in a thread for large bodies since hashlib releases the GIL"""
+    if len(body) < THREADED_HASH_SIZE:
+        return wbh.verify(headers=headers, body=body)
+    return await asyncio.get_running_loop().run_in_executor(
+        None, functools.partial(wbh.verify, headers=headers, body=body)
+    )
 
+
+def create_app(serving: asyncio.Event = None) -> Starlette:
+    """Build the ASGI app. The bot and the workers are started in its lifespan,
+    so every server process started with `uvicorn --factory` gets its own.
+
+    :param serving: set by the caller once the server listens, the Telegram
+        webhook is registered after that. Without it the end of the lifespan
+        startup stands in, uvicorn binds right after.
+    """
     url = os.environ.get("URL", None)
     assert url is not None, "set environment variable URL to your domain url."
     token = os.environ.get("TOKEN", None)
@@ -77,12 +280,15 @@ async def main() -> None:
     # proxy_url = "socks5://127.0.0.1:1080"
     # proxy_url = "http://127.0.0.1:1081"
     # Create the Application and pass it your bot's token.
+    # Its bot is shared by every outbound send so connections stay warm,
+    # pool size and timeouts are configured with TELEGRAM_* variables.
+    bot_request = telegram_client.request_from_env()
     application = (
-        Application.builder().token(token)
-        # .read_timeout(30)
-        # .write_timeout(30)
-        # .pool_timeout(30)
-        .connect_timeout(30)
+        Application.builder()
+        .token(token)
+        .base_url(os.environ.get("TELEGRAM_BASE_URL", "https://api.telegram.org/bot"))
+        .request(bot_request)
+        .update_queue(asyncio.Queue(maxsize=UPDATE_QUEUE_SIZE))
         # .get_updates_read_timeout(42)
         # .proxy_url(proxy_url)
         .build()
@@ -92,89 +298,400 @@ async def main() -> None:
     application.add_handler(CommandHandler("start", help))
     application.add_handler(CommandHandler("menu", telegram_menu.init_menu))
     application.add_handler(CallbackQueryHandler(telegram_menu.menu_router))
+    # the text of a template asked for by the menu
+    application.add_handler(
+        MessageHandler(
+            message_filters.UpdateType.MESSAGE
+            & message_filters.TEXT
+            & ~message_filters.COMMAND,
+            telegram_menu.template_text,
+        )
+    )
+
+    # requests over these limits are answered at once instead of piling up
+    github_admission = admission.github_from_env()
+    telegram_admission = admission.telegram_from_env()
+
+    # Telegram sends are queued and retried off the /github request path
+    outbox = delivery.from_env(handler=functools.partial(send_github, application.bot))
+    # secrets in digest mode get their events merged per chat
+    digests = digest.Digest(outbox=outbox)
+    # Telegram updates received by a worker that is not the leader
+    handoff = delivery.from_env(
+        handler=functools.partial(process_update, application),
+        queue="updates",
+        workers=1,
+        max_attempts=1,
+        poll_interval=0.2,
+    )
+    webhook_url = f"{url}/telegram"
+    # `starting`, `ready` or `draining`, see /ready
+    phase = "starting"
+    listening = None
+    registration = None
+    ping = None
+
+    async def lead():
+        """Duties of the one process holding the leader lease"""
+        nonlocal registration
+        # messages sent by the previous leader are unknown to this cache
+        db.message_cache.clear()
+        await application.start()
+        await outbox.start()
+        await handoff.start()
+        registration = asyncio.create_task(register_webhook())
+
+    async def register_webhook():
+        # Telegram posts pending updates at once, they would hit a closed port
+        await listening.wait()
+        logger.debug("setting webhook url to \n\t%s", webhook_url)
+        try:
+            with startup_phase("set_webhook"):
+                await application.bot.set_webhook(url=webhook_url)
+        except Exception:  # pylint: disable=broad-except
+            logger.exception("could not set the webhook url")
+
+    async def step_down():
+        if registration is not None:
+            registration.cancel()
+        await handoff.drain(DRAIN_TIMEOUT)
+        await outbox.drain(DRAIN_TIMEOUT)
+        await application.stop()
+
+    async def warm_up_database():
+        try:
+            await asyncio.gather(
+                db.repository.warm_up(), outbox.warm_up(), handoff.warm_up()
+            )
+        except Exception:  # pylint: disable=broad-except
+            # not fatal, /ready tells until the database answers
+            logger.exception("could not warm up the database")
+
+    async def check_database():
+        nonlocal ping
+        # one ping at a time however often the probe asks, it may block a thread
+        if ping is None or ping.done():
+            ping = asyncio.ensure_future(db.repository.ping())
+            ping.add_done_callback(lambda done: done.cancelled() or done.exception())
+        await asyncio.wait_for(asyncio.shield(ping), READY_TIMEOUT)
+
+    coordinator = leader.from_env(on_elected=lead, on_demoted=step_down)
+
+    async def health(request: Request):
+        """Liveness, answers as long as the event loop does"""
+        return PlainTextResponse("Hello, World!")
+
+    async def ready(request: Request):
+        """Readiness, started, not draining and the database answers"""
+        if phase != "ready":
+            return JSONResponse({"ready": False, "phase": phase}, 503)
+        try:
+            await check_database()
+        except Exception:  # pylint: disable=broad-except
+            # the error names hosts and may carry credentials, it stays in the logs
+            logger.exception("readiness check could not reach the database")
+            return JSONResponse(
+                {"ready": False, "phase": phase, "database": "unreachable"}, 503
+            )
+        return JSONResponse(
+            {"ready": True, "phase": phase, "leader": coordinator.is_leader}
+        )
+
+    async def pool(request: Request):
+        return JSONResponse(bot_request.stats())
 
-    # Run the bot until the user presses Ctrl-C
-    # application.run_polling(poll_interval=2)
+    async def cache(request: Request):
+        return JSONResponse(db.secret_cache.stats())
 
-    # Pass webhook settings to telegram
-    url = f"{url}/telegram"
-    logger.debug(f"setting webhook url to \n\t{url}")
-    await application.bot.set_webhook(url=url)
+    async def dedup(request: Request):
+        return JSONResponse(deduplicator.stats())
 
-    app = Flask(__name__)
+    async def leader_status(request: Request):
+        return JSONResponse(coordinator.stats())
 
-    @app.get("/health")
-    def health():
-        return "Hello, World!"
+    async def metrics_endpoint(request: Request):
+        return Response(metrics.render(), media_type=metrics.CONTENT_TYPE)
 
-    @app.route("/telegram", methods=["POST"])
-    async def telegram():
+    async def admission_status(request: Request):
+        return JSONResponse(
+            {
+                "github": github_admission.stats(),
+                "telegram": telegram_admission.stats(),
+            }
+        )
+
+    async def telegram(request: Request):
+        try:
+            telegram_admission.acquire()
+        except admission.Rejected as rejected:
+            return too_busy("telegram", rejected.reason, rejected.retry_after)
+        try:
+            return await handle_telegram(request)
+        finally:
+            telegram_admission.release()
+
+    async def handle_telegram(request: Request):
         """Handle incoming Telegram updates by putting them into the `update_queue`"""
         content_type = request.headers.get("Content-Type")
-        logger.debug(f"Content-Type : {content_type}")
+        logger.debug("Content-Type : %s", content_type)
         if content_type == "application/json":
-            json = request.json
-            await application.update_queue.put(
-                Update.de_json(data=json, bot=application.bot)
-            )
+            json = await request.json()
+            if not coordinator.is_leader:
+                await handoff.put({"update": json})
+                return Response()
+            try:
+                application.update_queue.put_nowait(
+                    Update.de_json(data=json, bot=application.bot)
+                )
+            except asyncio.QueueFull:
+                # Telegram redelivers the update later
+                return too_busy("telegram", "queue_full", 1)
             return Response()
         else:
             logger.info("Content-Type not supported!")
-            return "Content-Type not supported!"
+            return PlainTextResponse("Content-Type not supported!")
 
-    @app.route("/github", methods=["POST"])
-    async def github():
+    async def github(request: Request):
         """https://doma.in/github?identity=IDENTITY"""
+        identity = request.query_params.get("identity", None)
+        try:
+            github_admission.acquire(identity)
+        except admission.Rejected as rejected:
+            response = too_busy("github", rejected.reason, rejected.retry_after)
+        else:
+            try:
+                response = await handle_github(request)
+            finally:
+                github_admission.release(identity)
+        metrics.GITHUB_RESPONSES.labels(response.status_code).inc()
+        return response
+
+    async def handle_github(request: Request):
         content_type = request.headers.get("Content-Type")
-        identity = request.args.get("identity", None)
+        identity = request.query_params.get("identity", None)
 
-        logger.debug(f"Content-Type : {content_type}")
-        logger.debug(f"Got Identity : {identity}")
+        logger.debug("Content-Type : %s", content_type)
+        logger.debug("Got Identity : %s", identity)
 
         if identity is None:
-            return "No Identity provided", 400
+            return PlainTextResponse("No Identity provided", 400)
+
+        # unsigned deliveries never reach the database
+        if not webhook.has_signature(request.headers):
+            logger.debug("Hash mismatch.")
+            return PlainTextResponse("Hash mismatch", 401)
 
-        secret = db.Secret.get(identity=identity)
+        with STAGE_SECRET_LOOKUP.time():
+            secret = await db.repository.cached_secret(identity)
         if secret is None:
-            logger.debug(f"Identity not found.")
-            return "Invalid or unauthorized apikey", 401
-
-        wbh = Webhook(secret=secret.secret)
-        payload = wbh.postreceive(request=request)
-        if payload is None:
-            logger.debug(f"Hash mismatch.")
-            return "Hash mismatch", 401
-        data, formatted = payload
-
-        repo_url = data["repository"]["html_url"]
-        if secret.repository == "None":
-            secret.repository = repo_url
-        elif secret.repository != repo_url:
-            logger.debug(
-                f"Invalid repository {repo_url}."
-                + f"Recorded repository for this secret {secret.repository}"
+            logger.debug("Identity not found.")
+            return PlainTextResponse("Invalid or unauthorized apikey", 401)
+
+        with STAGE_READ_BODY.time():
+            body = await read_body(request)
+        if body is None:
+            return PlainTextResponse("Payload too large", 413)
+        wbh = webhook.for_secret(secret.secret)
+        with STAGE_HMAC.time():
+            verified = await verify(wbh, request.headers, body)
+        if not verified:
+            logger.debug("Hash mismatch.")
+            return PlainTextResponse("Hash mismatch", 401)
+
+        event_type = request.headers.get("X-Github-Event")
+        metrics.GITHUB_EVENTS.labels(
+            event_type if event_type in filters.EVENTS else "other"
+        ).inc()
+
+        # filtered out events cost no parsing, formatting, DB write or send
+        matcher = filters.for_secret(secret)
+        if not matcher.accepts_event(event_type):
+            return PlainTextResponse("Filtered", 200)
+
+        # a template of the secret may read fields the built-in ones do not
+        secret_templates = templates.for_secret(secret)
+        with STAGE_PARSE.time():
+            data = wbh.parse(
+                headers=request.headers,
+                body=body,
+                fields=secret_templates.fields(event_type),
+            )
+        if data is None:
+            logger.debug("Hash mismatch.")
+            return PlainTextResponse("Hash mismatch", 401)
+        if not matcher.accepts(event_type, data):
+            return PlainTextResponse("Filtered", 200)
+
+        # redeliveries are answered before anything is formatted or sent
+        guid = request.headers.get("X-Github-Delivery")
+        with STAGE_DEDUP.time():
+            duplicate = await deduplicator.is_duplicate(guid)
+        if duplicate:
+            return PlainTextResponse("Duplicate delivery", 200)
+
+        # the claim only holds once the jobs are queued, GitHub's redelivery
+        # of an event rejected or failing below must not be suppressed
+        accepted = False
+        try:
+            with STAGE_FORMAT.time():
+                messages = wbh.format(
+                    headers=request.headers,
+                    data=data,
+                    template=secret_templates.template(event_type, data),
+                )
+
+            repo_url = data["repository"]["html_url"]
+            if secret.repository == "None":
+                # binding the repository is the only change made before
+                # answering, the other workers drop their copy of the secret
+                secret.repository = repo_url
+                with STAGE_DB_UPDATE.time():
+                    await db.repository.save(secret)
+                    await db.repository.invalidate_secret(secret.identity)
+            elif secret.repository != repo_url:
+                logger.debug(
+                    "Invalid repository %s. Recorded repository for this secret %s",
+                    repo_url,
+                    secret.repository,
+                )
+                return PlainTextResponse(
+                    "Invalid repository. Request another secret for your new repo.", 401
+                )
+            db.repository.touch(secret)
+
+            # formatted once, then one job per target so a failing chat
+            # does not hold back the others
+            destinations = secret.destinations()
+            if secret.digest_window > 0:
+                for target in destinations:
+                    digests.add(
+                        chat_id=target.chat_id,
+                        thread_id=target.thread_id,
+                        window=secret.digest_window,
+                        max_events=secret.digest_max_events,
+                        event_type=event_type,
+                        data=data,
+                        messages=messages,
+                    )
+            else:
+                jobs = [
+                    {
+                        "chat_id": target.chat_id,
+                        "thread_id": target.thread_id,
+                        "texts": messages,
+                    }
+                    for target in destinations
+                ]
+                thread = webhook.thread(event_type, data) if MESSAGE_THREADS else None
+                if thread is not None:
+                    for job in jobs:
+                        job["thread"] = thread
+                with STAGE_ENQUEUE.time():
+                    await outbox.put_many(jobs)
+
+            accepted = True
+            return PlainTextResponse("Accepted", 202)
+        finally:
+            if not accepted:
+                await deduplicator.release(guid)
+
+    async def sample_gauges():
+        while True:
+            metrics.UPDATE_QUEUE_DEPTH.set(application.update_queue.qsize())
+            metrics.RATELIMIT_QUEUED.set(ratelimit.scheduler.queued())
+            metrics.IN_FLIGHT_REQUESTS.labels("github").set(github_admission.in_flight)
+            metrics.IN_FLIGHT_REQUESTS.labels("telegram").set(
+                telegram_admission.in_flight
             )
-            return "Invalid repository. Request another secret for your new repo.", 401
-        secret.update()
+            for name, queue in (("telegram", outbox), ("updates", handoff)):
+                try:
+                    depth = await queue.depth()
+                except Exception:  # pylint: disable=broad-except
+                    logger.exception("could not sample the depth of %s", name)
+                else:
+                    metrics.DELIVERY_QUEUE_DEPTH.labels(name).set(depth)
+            await asyncio.sleep(GAUGE_SAMPLE_INTERVAL)
+
+    @contextlib.asynccontextmanager
+    async def lifespan(app):
+        nonlocal phase, listening
+        listening = serving if serving is not None else asyncio.Event()
+        metrics.STARTUP_SECONDS.labels("imports").set(IMPORTED - STARTED)
+        logger.info("startup: imports took %.3fs", IMPORTED - STARTED)
+        logger.info("Setting up DB connection")
+        db.global_init()
+
+        try:
+            with startup_phase("warm_up"):
+                # connections and indexes side by side with getMe of the bot
+                await asyncio.gather(application.initialize(), warm_up_database())
+            with startup_phase("workers"):
+                await db.repository.start()
+                await digests.start()
+                # every worker serves /github and /telegram, the leader also
+                # registers the webhook and runs the rate-limited send loop
+                await coordinator.start()
+            sampler = asyncio.create_task(sample_gauges())
+            phase = "ready"
+            total = time.perf_counter() - STARTED
+            metrics.STARTUP_SECONDS.labels("total").set(total)
+            logger.info("startup: ready after %.3fs", total)
+            if serving is None:
+                listening.set()
+
+            yield
+
+            phase = "draining"
+            sampler.cancel()
+            # digests flush into the outbox, which is drained by step_down
+            await digests.stop()
+            await coordinator.stop()
+            logger.info("telegram pool stats: %s", bot_request.stats())
+            logger.info("secret cache stats: %s", db.secret_cache.stats())
+            db.repository.shutdown()
+        finally:
+            await application.shutdown()
+            metrics.process_stopped()
+
+    return Starlette(
+        routes=[
+            Route("/health", health, methods=["GET"]),
+            Route("/ready", ready, methods=["GET"]),
+            Route("/health/pool", pool, methods=["GET"]),
+            Route("/health/cache", cache, methods=["GET"]),
+            Route("/health/dedup", dedup, methods=["GET"]),
+            Route("/health/leader", leader_status, methods=["GET"]),
+            Route("/health/admission", admission_status, methods=["GET"]),
+            Route("/metrics", metrics_endpoint, methods=["GET"]),
+            Route("/telegram", telegram, methods=["POST"]),
+            Route("/github", github, methods=["POST"]),
+        ],
+        lifespan=lifespan,
+    )
 
-        await send_github(secret=secret, data=data, formatted_data=formatted)
 
-        return "OK", 204
+async def main() -> None:
+    """Start the bot."""
+    # only needed here, `uvicorn --factory` has it imported already
+    import uvicorn
 
-    asgi_app = WsgiToAsgi(app)
+    serving = asyncio.Event()
     webserver = uvicorn.Server(
         config=uvicorn.Config(
-            app=asgi_app,
+            app=create_app(serving),
             port=4560,
             use_colors=False,
             host="0.0.0.0",
+            # uvicorn's loggers go through the queue set up by logs.configure
+            log_config=None,
         )
     )
-
-    async with application:
-        await application.start()
-        await webserver.serve()
-        await application.stop()
+    server = asyncio.create_task(webserver.serve())
+    # `started` is set once the socket listens
+    while not webserver.started and not server.done():
+        await asyncio.sleep(0.01)
+    serving.set()
+    await server
 
 
 if __name__ == "__main__":
@@ -0,0 +1,124 @@
+"""
+Prometheus metrics of the bot.
+
+Under `uvicorn --workers N` each server process has its own counters, set
+`PROMETHEUS_MULTIPROC_DIR` to an empty directory before the server starts and
+every process writes its samples there, so `/metrics` answers the sum over all
+of them whichever process is asked. Without it the process keeps its samples
+in memory, which is right for a single one.
+"""
+
+import os
+
+import prometheus_client
+from prometheus_client import Counter, Gauge, Histogram, multiprocess
+
+MULTIPROCESS_DIR = os.environ.get("PROMETHEUS_MULTIPROC_DIR")
+if MULTIPROCESS_DIR:
+    os.makedirs(MULTIPROCESS_DIR, exist_ok=True)
+
+# seconds, from a cached secret lookup to a slow Telegram call
+DEFAULT_BUCKETS = (
+    0.0001,
+    0.00025,
+    0.0005,
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+)
+
+# content type of `render`
+CONTENT_TYPE = prometheus_client.CONTENT_TYPE_LATEST
+
+
+def render() -> bytes:
+    """All metrics in the Prometheus text exposition format"""
+    if not MULTIPROCESS_DIR:
+        return prometheus_client.generate_latest()
+    # collected from the files of every process at each scrape
+    registry = prometheus_client.CollectorRegistry()
+    multiprocess.MultiProcessCollector(registry)
+    return prometheus_client.generate_latest(registry)
+
+
+def process_stopped():
+    """Drop the gauges of this process from the aggregate, call it on shutdown"""
+    if MULTIPROCESS_DIR:
+        multiprocess.mark_process_dead(os.getpid())
+
+
+GITHUB_STAGE_SECONDS = Histogram(
+    "gwhtb_github_stage_seconds",
+    "Time spent in each stage of a /github request.",
+    ["stage"],
+    buckets=DEFAULT_BUCKETS,
+)
+GITHUB_EVENTS = Counter(
+    "gwhtb_github_events", "Verified GitHub deliveries by event type.", ["event"]
+)
+GITHUB_RESPONSES = Counter(
+    "gwhtb_github_responses", "/github responses by status code.", ["code"]
+)
+TELEGRAM_SEND_SECONDS = Histogram(
+    "gwhtb_telegram_send_seconds",
+    "Time to send one notification, rate limiting included.",
+    buckets=DEFAULT_BUCKETS,
+)
+TELEGRAM_REQUEST_SECONDS = Histogram(
+    "gwhtb_telegram_request_seconds",
+    "Latency of Bot API requests by method.",
+    ["method"],
+    buckets=DEFAULT_BUCKETS,
+)
+TELEGRAM_ERRORS = Counter(
+    "gwhtb_telegram_errors",
+    "Failed Bot API requests by method and status code, or `network`.",
+    ["method", "code"],
+)
+# gauges are sampled, functions would only be read by the process scraped;
+# they add up over the live processes unless the value is shared by all
+UPDATE_QUEUE_DEPTH = Gauge(
+    "gwhtb_update_queue_depth",
+    "Telegram updates waiting in the update queue, sampled.",
+    multiprocess_mode="livesum",
+)
+IN_FLIGHT_REQUESTS = Gauge(
+    "gwhtb_in_flight_requests",
+    "Requests in progress by endpoint, sampled.",
+    ["endpoint"],
+    multiprocess_mode="livesum",
+)
+REJECTED_REQUESTS = Counter(
+    "gwhtb_rejected_requests",
+    "Requests shed by admission control by endpoint and reason.",
+    ["endpoint", "reason"],
+)
+DELIVERY_QUEUE_DEPTH = Gauge(
+    "gwhtb_delivery_queue_depth",
+    "Jobs pending or in flight by delivery queue, sampled.",
+    ["queue"],
+    # every process counts the same collection
+    multiprocess_mode="livemax",
+)
+RATELIMIT_QUEUED = Gauge(
+    "gwhtb_ratelimit_queued",
+    "Telegram calls waiting for the flood limits, sampled.",
+    multiprocess_mode="livesum",
+)
+STARTUP_SECONDS = Gauge(
+    "gwhtb_startup_seconds",
+    "Duration of each phase of the last startup, `total` since the first import.",
+    ["phase"],
+    # the slowest process
+    multiprocess_mode="livemax",
+)
@@ -0,0 +1,250 @@
+import asyncio
+import collections
+import functools
+import logging
+import os
+import time
+
+import telegram
+
+from tools import retry_after_seconds
+
+logger = logging.getLogger(__name__)
+
+
+# tolerance for floating point drift when refilling
+EPSILON = 1e-9
+
+
+class TokenBucket(object):
+    """
+    Classic token bucket.
+
+    :param rate: tokens added per second
+    :param capacity: maximum number of tokens, i.e. the allowed burst
+    :param now: current time of the clock the bucket is used with
+    """
+
+    def __init__(self, rate, capacity, now):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = now
+        self.paused_until = now
+
+    def _refill(self, now):
+        if now > self.updated:
+            self.tokens = min(
+                self.capacity, self.tokens + (now - self.updated) * self.rate
+            )
+            self.updated = now
+
+    def delay(self, now) -> float:
+        """Seconds until a token can be taken, 0 if one is available now"""
+        self._refill(now)
+        wait = 0.0 if self.tokens >= 1 - EPSILON else (1 - self.tokens) / self.rate
+        return max(wait, self.paused_until - now)
+
+    def take(self, now):
+        self._refill(now)
+        self.tokens -= 1
+
+    def pause(self, until):
+        """Hand out no tokens before `until`, e.g. after a `RetryAfter`"""
+        self.paused_until = max(self.paused_until, until)
+        self.tokens = min(self.tokens, 0)
+
+    def full(self, now) -> bool:
+        self._refill(now)
+        return self.tokens >= self.capacity - EPSILON and self.paused_until <= now
+
+
+class Scheduler(object):
+    """
+    Dispatches Telegram calls under the global and the per-chat flood limits.
+
+    Calls wait in a queue per chat, chats with queued calls are served
+    round-robin so a noisy chat cannot starve the others.
+
+    :param global_rate: messages per second for the whole bot
+    :param group_rate: messages per second for each group or channel
+    :param private_rate: messages per second for each private chat
+    :param burst: capacity of every bucket
+    :param max_retries: `RetryAfter` errors absorbed before giving up on a call
+    :param clock: monotonic clock, in seconds
+    :param sleep: coroutine function sleeping on `clock`
+    """
+
+    def __init__(
+        self,
+        global_rate=30.0,
+        group_rate=20 / 60,
+        private_rate=1.0,
+        burst=1,
+        max_retries=3,
+        max_buckets=10000,
+        clock=time.monotonic,
+        sleep=asyncio.sleep,
+    ):
+        self.group_rate = group_rate
+        self.private_rate = private_rate
+        self.burst = burst
+        self.max_retries = max_retries
+        self.max_buckets = max_buckets
+        self.clock = clock
+        self.sleep = sleep
+        self._global = TokenBucket(global_rate, burst, clock())
+        self._buckets = {}
+        self._queues = {}
+        self._ring = collections.deque()  # chats with queued calls
+        self._parked = {}  # chat id -> first slot after the ones held
+        self._wakeup = None
+        self._task = None
+        self.sent = 0
+        self.throttled = 0
+
+    def _rate(self, chat_id):
+        return self.group_rate if chat_id.startswith("-") else self.private_rate
+
+    def _bucket(self, chat_id):
+        bucket = self._buckets.get(chat_id)
+        if bucket is None:
+            now = self.clock()
+            if len(self._buckets) >= self.max_buckets:
+                # a full bucket behaves exactly like a new one, forget those
+                for key in [k for k, b in self._buckets.items() if b.full(now)]:
+                    del self._buckets[key]
+            rate = self._rate(chat_id)
+            bucket = self._buckets[chat_id] = TokenBucket(rate, self.burst, now)
+        return bucket
+
+    def _enqueue(self, chat_id, item, front=False):
+        queue = self._queues.get(chat_id)
+        if queue is None:
+            queue = self._queues[chat_id] = collections.deque()
+            self._ring.append(chat_id)
+        if front:
+            queue.appendleft(item)
+        else:
+            queue.append(item)
+        if self._wakeup is None:
+            self._wakeup = asyncio.Event()
+        self._wakeup.set()
+        if self._task is None:
+            self._task = asyncio.ensure_future(self._dispatch())
+
+    def queued(self) -> int:
+        return sum(len(queue) for queue in self._queues.values())
+
+    async def submit(self, chat_id, func, /, *args, **kwargs):
+        """Call `func(*args, **kwargs)` once `chat_id` may receive a message"""
+        future = asyncio.get_running_loop().create_future()
+        self._enqueue(
+            str(chat_id), (future, functools.partial(func, *args, **kwargs), 0)
+        )
+        return await future
+
+    def park(self, chat_id, threshold=0.0) -> float:
+        """
+        Hold a send slot of `chat_id` for a call submitted later.
+
+        A delivery worker parks a job instead of waiting on a busy chat. The
+        slot comes after the calls queued for the chat and the slots held
+        before, so parked jobs keep their order.
+
+        :param threshold: seconds a call may wait in the queue, if it would
+            be sent sooner nothing is held and 0 returned
+        :returns: seconds until the slot
+        """
+        chat_id = str(chat_id)
+        now = self.clock()
+        rate = self._rate(chat_id)
+        queue = self._queues.get(chat_id) or ()
+        wait = self._bucket(chat_id).delay(now) + len(queue) / rate
+        wait = max(wait, self._parked.get(chat_id, now) - now)
+        if wait <= threshold:
+            return 0.0
+        if len(self._parked) >= self.max_buckets:
+            for key in [k for k, until in self._parked.items() if until <= now]:
+                del self._parked[key]
+        self._parked[chat_id] = now + wait + 1 / rate
+        return wait
+
+    async def _wait(self, timeout):
+        """Sleep `timeout` seconds or until a new call is submitted"""
+        self._wakeup.clear()
+        sleeper = asyncio.ensure_future(self.sleep(timeout))
+        waker = asyncio.ensure_future(self._wakeup.wait())
+        await asyncio.wait((sleeper, waker), return_when=asyncio.FIRST_COMPLETED)
+        sleeper.cancel()
+        waker.cancel()
+
+    async def _dispatch(self):
+        try:
+            while self._ring:
+                now = self.clock()
+                wait = self._global.delay(now)
+                if wait > 0:
+                    await self.sleep(wait)
+                    continue
+
+                chosen, soonest = None, None
+                for _ in range(len(self._ring)):
+                    chat_id = self._ring[0]
+                    self._ring.rotate(-1)
+                    wait = self._bucket(chat_id).delay(now)
+                    if wait <= 0:
+                        chosen = chat_id
+                        break
+                    soonest = wait if soonest is None else min(soonest, wait)
+                if chosen is None:
+                    await self._wait(soonest)
+                    continue
+
+                self._global.take(now)
+                self._bucket(chosen).take(now)
+                queue = self._queues[chosen]
+                future, call, attempts = queue.popleft()
+                if not queue:
+                    # the chosen chat was rotated to the end of the ring
+                    del self._queues[chosen]
+                    self._ring.pop()
+                asyncio.ensure_future(self._send(chosen, future, call, attempts))
+        finally:
+            self._task = None
+
+    async def _send(self, chat_id, future, call, attempts):
+        if future.cancelled():
+            return
+        try:
+            result = await call()
+        except telegram.error.RetryAfter as error:
+            self.throttled += 1
+            delay = retry_after_seconds(error)
+            logger.warning("chat %s throttled for %ss", chat_id, delay)
+            self._bucket(chat_id).pause(self.clock() + delay)
+            if attempts < self.max_retries:
+                self._enqueue(chat_id, (future, call, attempts + 1), front=True)
+            elif not future.cancelled():
+                future.set_exception(error)
+        except Exception as error:  # pylint: disable=broad-except
+            if not future.cancelled():
+                future.set_exception(error)
+        else:
+            self.sent += 1
+            if not future.cancelled():
+                future.set_result(result)
+
+
+def from_env() -> Scheduler:
+    """Build the scheduler from `RATELIMIT_*` environment variables"""
+    return Scheduler(
+        global_rate=float(os.environ.get("RATELIMIT_GLOBAL", "30")),
+        group_rate=float(os.environ.get("RATELIMIT_GROUP_PER_MINUTE", "20")) / 60,
+        private_rate=float(os.environ.get("RATELIMIT_PRIVATE", "1")),
+        burst=int(os.environ.get("RATELIMIT_BURST", "1")),
+    )
+
+
+# shared by every outbound send of this process
+scheduler = from_env()
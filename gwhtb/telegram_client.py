@@ -0,0 +1,104 @@
+import os
+import logging
+import time
+
+import httpx
+from telegram.request import HTTPXRequest
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+
+class PooledRequest(HTTPXRequest):
+    """
+    `HTTPXRequest` that keeps track of how its connection pool is used.
+
+    :param connection_pool_size: maximum number of connections to the bot API
+    :param keepalive_connections: idle connections kept open for reuse
+    :param keepalive_expiry: seconds an idle connection is kept open
+    """
+
+    def __init__(
+        self,
+        connection_pool_size=64,
+        keepalive_connections=32,
+        keepalive_expiry=60.0,
+        **kwargs,
+    ):
+        limits = httpx.Limits(
+            max_connections=connection_pool_size,
+            max_keepalive_connections=keepalive_connections,
+            keepalive_expiry=keepalive_expiry,
+        )
+        super().__init__(
+            connection_pool_size=connection_pool_size,
+            httpx_kwargs={"limits": limits},
+            **kwargs,
+        )
+        self.pool_size = connection_pool_size
+        self.in_use = 0
+        self.peak_in_use = 0
+        self.requests = 0
+        self.waits = 0
+        self.pool_timeouts = 0
+
+    async def do_request(self, *args, **kwargs):
+        if self.in_use >= self.pool_size:
+            # every connection is busy, this request waits for the pool
+            self.waits += 1
+        self.in_use += 1
+        self.requests += 1
+        self.peak_in_use = max(self.peak_in_use, self.in_use)
+        url = kwargs["url"] if "url" in kwargs else args[0]
+        method = url.rsplit("/", 1)[-1]
+        start = time.perf_counter()
+        try:
+            code, payload = await super().do_request(*args, **kwargs)
+        except Exception as error:
+            if "Pool timeout" in str(error):
+                self.pool_timeouts += 1
+            metrics.TELEGRAM_ERRORS.labels(method, "network").inc()
+            raise
+        finally:
+            self.in_use -= 1
+            metrics.TELEGRAM_REQUEST_SECONDS.labels(method).observe(
+                time.perf_counter() - start
+            )
+        if code >= 300:
+            metrics.TELEGRAM_ERRORS.labels(method, code).inc()
+        return code, payload
+
+    def _connections(self):
+        # httpx does not expose its pool, look it up defensively
+        transport = getattr(self._client, "_transport", None)
+        pool = getattr(transport, "_pool", None)
+        return list(getattr(pool, "connections", []))
+
+    def stats(self) -> dict:
+        connections = self._connections()
+        return {
+            "pool_size": self.pool_size,
+            "http_version": self.http_version,
+            "connections": len(connections),
+            "idle": sum(1 for connection in connections if connection.is_idle()),
+            "in_use": self.in_use,
+            "peak_in_use": self.peak_in_use,
+            "requests": self.requests,
+            "waits": self.waits,
+            "pool_timeouts": self.pool_timeouts,
+        }
+
+
+def request_from_env() -> PooledRequest:
+    """Build the shared bot request from `TELEGRAM_*` environment variables"""
+    return PooledRequest(
+        connection_pool_size=int(os.environ.get("TELEGRAM_POOL_SIZE", "64")),
+        keepalive_connections=int(os.environ.get("TELEGRAM_KEEPALIVE", "32")),
+        keepalive_expiry=float(os.environ.get("TELEGRAM_KEEPALIVE_EXPIRY", "60")),
+        http_version=os.environ.get("TELEGRAM_HTTP_VERSION", "2"),
+        connect_timeout=float(os.environ.get("TELEGRAM_CONNECT_TIMEOUT", "30")),
+        read_timeout=float(os.environ.get("TELEGRAM_READ_TIMEOUT", "10")),
+        write_timeout=float(os.environ.get("TELEGRAM_WRITE_TIMEOUT", "10")),
+        pool_timeout=float(os.environ.get("TELEGRAM_POOL_TIMEOUT", "5")),
+    )
@@ -1,8 +1,10 @@
 import os
-from typing import Any
+import collections
 import functools
 import secrets
 import logging
+import random
+import time
 
 from telegram import __version__ as TG_VER
 
@@ -17,24 +19,45 @@ if __version_info__ < (20, 0, 0, "alpha", 1):
         f"{TG_VER} version of this example, "
         f"visit https://docs.python-telegram-bot.org/en/v{TG_VER}/examples.html"
     )
+import mongoengine
 import telegram
+from bson import ObjectId
 from telegram import InlineKeyboardButton, InlineKeyboardMarkup, Update
 from telegram.ext import (
     ContextTypes,
 )
 
 import db
+import digest
+from callbacks import State, encode, decode
+import filters
+import ratelimit
+import templates
+import webhook
 from tools import markdown_char_escape
 
 
 logger = logging.getLogger(__name__)
 
+# chats and forum topics a single secret can fan out to
+MAX_TARGETS = int(os.environ.get("MAX_TARGETS", "10"))
+# secrets listed per page of "my secrets"
+SECRETS_PAGE_SIZE = int(os.environ.get("SECRETS_PAGE_SIZE", "10"))
+# seconds documents read by the menu are reused while navigating it
+MENU_CACHE_TTL = float(os.environ.get("MENU_CACHE_TTL", "60"))
+# secrets a user's menu keeps short ids for, older buttons expire
+MENU_SLOTS = int(os.environ.get("MENU_SLOTS", "256"))
+
+# directions of the "my secrets" page cursor
+FORWARD, BACK = 0, 1
+
 
 def extract_message_fields(update: Update):
     return {
         "user_id": str(update.message.from_user.id),
         "chat_type": update.message.chat.type,
         "chat_id": str(update.message.chat.id),
+        "thread_id": topic_id(update.message),
     }
 
 
@@ -43,59 +66,191 @@ def extract_callback_query_fields(update: Update):
         "user_id": str(update.callback_query.from_user.id),
         "chat_type": update.callback_query.message.chat.type,
         "chat_id": str(update.callback_query.message.chat.id),
+        "thread_id": topic_id(update.callback_query.message),
     }
 
 
+def topic_id(message):
+    """Forum topic the menu is used in, None outside of forums"""
+    if getattr(message, "is_topic_message", False):
+        return message.message_thread_id
+    return None
+
+
+def current_target(fields: dict):
+    return db.Target(chat_id=fields["chat_id"], thread_id=fields["thread_id"])
+
+
 def reply_func(update: Update):
     if hasattr(update.callback_query, "edit_message_text"):
         func = update.callback_query.edit_message_text
     else:
         func = update.message.reply_text
-    return func
+    # replies share the flood limits with webhook notifications
+    return functools.partial(ratelimit.scheduler.submit, update.effective_chat.id, func)
+
+
+class MenuSession(object):
+    """
+    Menu state of one Telegram user, kept in `context.user_data`.
+
+    Buttons refer to secrets by short ids handed out here instead of their
+    40 character identity. Ids start at a random offset, so the buttons of
+    menus sent by an earlier session, e.g. before a restart or a leader
+    change, name no secret of this one. The documents the menu reads are
+    reused for `ttl` seconds so going back and forth between screens reads
+    nothing.
+    Only the menu writes secrets besides the repository binding of the
+    first event, which shows up once the entry expires.
+
+    :param ttl: seconds a document read is reused
+    :param slots: short ids kept, the oldest are forgotten first
+    """
+
+    def __init__(self, ttl=MENU_CACHE_TTL, slots=MENU_SLOTS, clock=time.monotonic):
+        self.ttl = ttl
+        self.slots = slots
+        self.clock = clock
+        self._identities = collections.OrderedDict()  # short id -> identity
+        self._slots = {}  # identity -> short id
+        self._next_slot = random.getrandbits(32)
+        self._user = None  # (read at, user)
+        self._secrets = {}  # identity -> (read at, secret)
+        self._pages = collections.OrderedDict()  # cursor -> (read at, page)
+        # (chat id, identity, event) of the template the next message sets
+        self.pending_template = None
+
+    def _fresh(self, entry):
+        return entry is not None and self.clock() - entry[0] < self.ttl
+
+    def slot(self, identity: str) -> int:
+        """Short id of a secret for `callback_data`"""
+        if identity in self._slots:
+            return self._slots[identity]
+        slot, self._next_slot = self._next_slot, self._next_slot + 1
+        self._identities[slot] = identity
+        self._slots[identity] = slot
+        while len(self._identities) > self.slots:
+            _, old = self._identities.popitem(last=False)
+            del self._slots[old]
+            self._secrets.pop(old, None)
+        return slot
+
+    def identity(self, slot: int) -> str:
+        """Identity behind a short id, None once it was forgotten"""
+        return self._identities.get(slot)
+
+    async def get_user(self, telegram_id: str):
+        if not self._fresh(self._user):
+            user = await db.repository.get_user(telegram_id)
+            self._user = (self.clock(), user)
+        return self._user[1]
+
+    def set_user(self, user):
+        self._user = (self.clock(), user)
+
+    async def get_secret(self, identity: str):
+        entry = self._secrets.get(identity)
+        if not self._fresh(entry):
+            secret = await db.repository.get_secret(identity)
+            if secret is None:
+                return None
+            entry = self._secrets[identity] = (self.clock(), secret)
+        return entry[1]
+
+    async def secrets_page(self, user, after, before, limit):
+        key = (after, before, limit)
+        entry = self._pages.get(key)
+        if not self._fresh(entry):
+            page = await db.repository.secrets_page(
+                user, after=after, before=before, limit=limit
+            )
+            entry = self._pages[key] = (self.clock(), page)
+            while len(self._pages) > 8:
+                self._pages.popitem(last=False)
+        return entry[1]
 
+    def remember(self, secret):
+        """Cache a secret that was just created, listings have to be read again"""
+        self._secrets[secret.identity] = (self.clock(), secret)
+        self._pages.clear()
 
-def get_state_context(data):
-    logger.debug(f"got keyboard context : {data}")
-    if "-" in data:
-        dlist = data.split("-")
-        state, context = dlist[0], dlist[1:]
-    else:
-        state, context = data, None
-    return state, context
+    def forget(self, identity: str):
+        """Drop a deleted or possibly stale secret and the listings"""
+        self._secrets.pop(identity, None)
+        self._pages.clear()
+
+
+def menu_session(context: ContextTypes.DEFAULT_TYPE) -> MenuSession:
+    session = context.user_data.get("menu")
+    if session is None:
+        session = context.user_data["menu"] = MenuSession()
+    return session
 
 
 async def init_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
     fields = extract_message_fields(update=update)
-    return await state_dict["7917"](update, context, fields=fields)
+    return await main_menu(update, context, fields=fields)
 
 
 async def menu_router(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """
+    Decode `callback_data` and run the handler `MENU` has for its state.
+
+    States marked to take a secret get it as `fields["secret"]` and its short
+    id as `fields["slot"]`, the remaining arguments are in `fields["args"]`.
+    """
     fields = extract_callback_query_fields(update=update)
 
     query = update.callback_query
     await query.answer()
-
-    state, fields["context"] = get_state_context(query.data)
-
-    if state in state_dict.keys():
-        return await state_dict[state](update, context, fields=fields)
-    elif state == "none":
+    # any other button than the one asking for it cancels a template edit
+    menu_session(context).pending_template = None
+
+    logger.debug("got keyboard context : %s", query.data)
+    try:
+        state, args = decode(query.data)
+    except ValueError:
+        return await reply_func(update)(text="Invalid state.")
+    handler, takes_secret = MENU[state]
+    fields["args"] = args
+    if not takes_secret:
+        return await handler(update, context, fields=fields)
+
+    session = menu_session(context)
+    secret = None
+    if args and isinstance(args[0], int):
+        identity = session.identity(args[0])
+        if identity is not None:
+            secret = await session.get_secret(identity)
+    elif args:  # legacy buttons name the identity, only the owner may use them
+        user = await session.get_user(fields["user_id"])
+        secret = await session.get_secret(args[0])
+        if secret is not None and (user is None or secret.owner_id() != user.id):
+            secret = None
+    if secret is None:
         return await reply_func(update)(
-            text=f"Action is not supported yet. \
-developers are working on it. Please be patient"
+            text="This menu has expired, open it again with /menu."
         )
-    else:
-        return await reply_func(update)(text=f"Invalid state.")
+    fields["secret"] = secret
+    fields["slot"] = session.slot(secret.identity)
+    fields["args"] = args[1:]
+    try:
+        return await handler(update, context, fields=fields)
+    except Exception:
+        # the cached document may hold changes that were never saved
+        session.forget(secret.identity)
+        raise
 
 
 async def main_menu(update: Update, context: ContextTypes.DEFAULT_TYPE, fields) -> None:
     keyboard = [
         [
-            InlineKeyboardButton("new secret", callback_data="30564"),
-            InlineKeyboardButton("my secrets", callback_data="20356"),
+            InlineKeyboardButton("new secret", callback_data=encode(State.NEW_SECRET)),
+            InlineKeyboardButton("my secrets", callback_data=encode(State.SECRETS)),
         ],
         [
-            InlineKeyboardButton("exit", callback_data="6491"),
+            InlineKeyboardButton("exit", callback_data=encode(State.EXIT)),
         ],
     ]
 
@@ -105,28 +260,33 @@ async def main_menu(update: Update, context: ContextTypes.DEFAULT_TYPE, fields)
 
 
 async def secret(update: Update, context: ContextTypes.DEFAULT_TYPE, fields: dict):
-    while True:
-        identity = secrets.token_hex(nbytes=20)
-        if db.Secret.get(identity=identity) is None:
-            break
-
-    secret = secrets.token_hex(nbytes=20)
-    secret = db.Secret(identity=identity, secret=secret, chat_id=fields["chat_id"])
-
-    user = db.User.get(telegram_id=fields["user_id"])
+    session = menu_session(context)
+    user = await session.get_user(fields["user_id"])
     if user is None:
         user = db.User(telegram_id=fields["user_id"])
-        user.save()
+        await db.repository.save(user)
+        session.set_user(user)
 
-    user.secrets.append(secret)
+    secret = db.Secret(
+        secret=secrets.token_hex(nbytes=20), chat_id=fields["chat_id"], user=user
+    )
+    if fields["thread_id"] is not None:
+        secret.targets = [current_target(fields)]
 
-    secret.user = user
-    secret.update()
+    # the unique index on `identity` settles the unlikely collision
+    while True:
+        secret.identity = secrets.token_hex(nbytes=20)
+        try:
+            await db.repository.insert(secret)
+            break
+        except mongoengine.NotUniqueError:
+            logger.warning("generated identity is taken, drawing another")
+    session.remember(secret)
 
     keyboard = [
         [
-            InlineKeyboardButton("back", callback_data="7917"),
-            InlineKeyboardButton("exit", callback_data="6491"),
+            InlineKeyboardButton("back", callback_data=encode(State.MAIN)),
+            InlineKeyboardButton("exit", callback_data=encode(State.EXIT)),
         ],
     ]
 
@@ -142,45 +302,114 @@ Payload URL: \n{markdown_char_escape(url)}/github?identity\={markdown_char_escap
     )
 
 
+def secret_label(secret) -> str:
+    """Repository a secret is bound to, its identity until the first event"""
+    if secret.repository == "None":
+        return f"unused secret {secret.identity[:8]}"
+    return secret.repository.rstrip("/").split("github.com/")[-1]
+
+
+def page_cursor(args):
+    """`[FORWARD, id]` pages forward from `id`, `[BACK, id]` back, else start"""
+    if len(args) != 2:
+        return None, None
+    direction, cursor = args
+    if isinstance(cursor, str):  # legacy buttons, `["a", "<hex id>"]`
+        if not ObjectId.is_valid(cursor):
+            return None, None
+        direction = FORWARD if direction == "a" else BACK
+        cursor = ObjectId(cursor)
+    return (cursor, None) if direction == FORWARD else (None, cursor)
+
+
 async def my_secrets(update: Update, context: ContextTypes.DEFAULT_TYPE, fields: dict):
-    user = db.User.get(telegram_id=fields["user_id"])
-    secrets_list = db.Secret.objects(user=user)
+    """One page of the user's secrets, the cursor travels in `callback_data`"""
+    session = menu_session(context)
+    user = await session.get_user(fields["user_id"])
+    after, before = page_cursor(fields.get("args", []))
+    if user is None:
+        secrets_list, more = [], False
+    else:
+        secrets_list, more = await session.secrets_page(
+            user, after=after, before=before, limit=SECRETS_PAGE_SIZE
+        )
+    if before is not None:
+        has_previous, has_next = more, True
+    else:
+        has_previous, has_next = after is not None, more
 
     keyboard = [
         [
             InlineKeyboardButton(
-                str(secret.identity), callback_data=f"20243-{str(secret.identity)}"
+                secret_label(secret),
+                callback_data=encode(State.SECRET, session.slot(secret.identity)),
             )
         ]
         for secret in secrets_list
     ]
+    pages = []
+    if has_previous and secrets_list:
+        pages.append(
+            InlineKeyboardButton(
+                "‹ previous",
+                callback_data=encode(State.SECRETS, BACK, secrets_list[0].id),
+            )
+        )
+    if has_next and secrets_list:
+        pages.append(
+            InlineKeyboardButton(
+                "next ›",
+                callback_data=encode(State.SECRETS, FORWARD, secrets_list[-1].id),
+            )
+        )
+    if pages:
+        keyboard.append(pages)
     keyboard += [
         [
-            InlineKeyboardButton("back", callback_data="7917"),
-            InlineKeyboardButton("exit", callback_data="6491"),
+            InlineKeyboardButton("back", callback_data=encode(State.MAIN)),
+            InlineKeyboardButton("exit", callback_data=encode(State.EXIT)),
         ]
     ]
 
     reply_markup = InlineKeyboardMarkup(keyboard)
     await reply_func(update=update)(
-        "Please choose a secret:", reply_markup=reply_markup
+        "Please choose a secret:" if secrets_list else "You have no secrets yet.",
+        reply_markup=reply_markup,
     )
 
 
 async def secrets_menu(
     update: Update, context: ContextTypes.DEFAULT_TYPE, fields: dict
 ):
-    secret = db.Secret.get(identity=fields["context"][0])
+    secret, slot = fields["secret"], fields["slot"]
     url = os.environ.get("URL", None)
     keyboard = [
         [
             InlineKeyboardButton(
-                "delete", callback_data=f"18787-{fields['context'][0]}"
+                f"digest: {digest_label(secret.digest_window)}",
+                callback_data=encode(State.DIGEST, slot),
             ),
+            InlineKeyboardButton("delete", callback_data=encode(State.DELETE, slot)),
         ],
         [
-            InlineKeyboardButton("back", callback_data="20356"),
-            InlineKeyboardButton("exit", callback_data="6491"),
+            InlineKeyboardButton("filters", callback_data=encode(State.FILTERS, slot)),
+            InlineKeyboardButton(
+                (
+                    "remove this chat"
+                    if current_target(fields) in secret.destinations()
+                    else "add this chat"
+                ),
+                callback_data=encode(State.TARGET, slot),
+            ),
+        ],
+        [
+            InlineKeyboardButton(
+                "templates", callback_data=encode(State.TEMPLATES, slot)
+            ),
+        ],
+        [
+            InlineKeyboardButton("back", callback_data=encode(State.SECRETS)),
+            InlineKeyboardButton("exit", callback_data=encode(State.EXIT)),
         ],
     ]
 
@@ -189,25 +418,324 @@ async def secrets_menu(
     await reply_func(update=update)(
         f"Secret:\n||{markdown_char_escape(str(secret.secret))}||\n\n\
 Repository: \n {markdown_char_escape(secret.repository)} \n\n\
+Digest: \n {markdown_char_escape(digest_label(secret.digest_window))} \n\n\
+Chats: \n {markdown_char_escape(targets_label(secret.destinations()))} \n\n\
 Payload URL: \n{markdown_char_escape(url)}/github?identity\={markdown_char_escape(secret.identity)}",
         parse_mode=telegram.constants.ParseMode.MARKDOWN_V2,
         reply_markup=reply_markup,
     )
 
 
+def targets_label(targets) -> str:
+    return ", ".join(
+        target.chat_id
+        if target.thread_id is None
+        else f"{target.chat_id} (topic {target.thread_id})"
+        for target in targets
+    )
+
+
+async def secret_target(
+    update: Update, context: ContextTypes.DEFAULT_TYPE, fields: dict
+):
+    """Add the chat the menu is used in to the targets of a secret, or remove it"""
+    secret = fields["secret"]
+    target = current_target(fields)
+    targets = secret.destinations()
+    if target in targets:
+        if len(targets) == 1:
+            return await reply_func(update)(
+                text="A secret needs a chat, delete the secret instead."
+            )
+        targets.remove(target)
+    elif len(targets) < MAX_TARGETS:
+        targets.append(target)
+    else:
+        return await reply_func(update)(
+            text=f"A secret can send to {MAX_TARGETS} chats at most."
+        )
+    secret.targets = targets
+    await db.repository.save(secret)
+    await db.repository.invalidate_secret(secret.identity)
+    return await secrets_menu(update, context, fields=fields)
+
+
+def digest_label(window: int) -> str:
+    if not window:
+        return "off"
+    if window % 60 == 0:
+        return f"{window // 60}m"
+    return f"{window}s"
+
+
+async def secret_digest(
+    update: Update, context: ContextTypes.DEFAULT_TYPE, fields: dict
+):
+    """Cycle the digest window of a secret through `digest.WINDOWS`"""
+    secret = fields["secret"]
+    windows = digest.WINDOWS
+    if secret.digest_window in windows:
+        position = windows.index(secret.digest_window)
+    else:
+        position = -1
+    secret.digest_window = windows[(position + 1) % len(windows)]
+    await db.repository.save(secret)
+    await db.repository.invalidate_secret(secret.identity)
+    return await secrets_menu(update, context, fields=fields)
+
+
+def filter_label(rules) -> str:
+    if not rules:
+        return "all"
+    return ", ".join(rules)
+
+
+def events_label(events) -> str:
+    muted = [event for event in filters.EVENTS if event not in events]
+    if events and len(muted) < len(events):
+        return "all but " + ", ".join(muted)
+    return filter_label(events)
+
+
+UNKNOWN_EVENT = "Unknown event, open the menu again with /menu."
+
+
+def button_event(args):
+    """Event type a button names, None if the bot does not format it"""
+    if not args:
+        return None
+    return args[0] if args[0] in filters.EVENTS else None
+
+
+async def filters_menu(
+    update: Update, context: ContextTypes.DEFAULT_TYPE, fields: dict
+):
+    secret = fields["secret"]
+    slot = fields["slot"]
+    events = secret.events or filters.EVENTS
+    toggles = [
+        InlineKeyboardButton(
+            f"{'✅' if event in events else '▫️'} {event}",
+            callback_data=encode(State.FILTER_EVENT, slot, event),
+        )
+        for event in filters.EVENTS
+    ]
+    keyboard = [toggles[i : i + 2] for i in range(0, len(toggles), 2)]
+    keyboard += [
+        [
+            InlineKeyboardButton(
+                f"branches: {filter_label(secret.branches)}",
+                callback_data=encode(State.FILTER_BRANCHES, slot),
+            ),
+        ],
+        [
+            InlineKeyboardButton(
+                f"actions: {'all' if not secret.actions else 'some'}",
+                callback_data=encode(State.FILTER_ACTIONS, slot),
+            ),
+        ],
+        [
+            InlineKeyboardButton("back", callback_data=encode(State.SECRET, slot)),
+            InlineKeyboardButton("exit", callback_data=encode(State.EXIT)),
+        ],
+    ]
+
+    reply_markup = InlineKeyboardMarkup(keyboard)
+
+    await reply_func(update=update)(
+        f"Events: \n {markdown_char_escape(events_label(secret.events))} \n\n\
+Branches: \n {markdown_char_escape(filter_label(secret.branches))} \n\n\
+Actions: \n {markdown_char_escape(filter_label(secret.actions))}",
+        parse_mode=telegram.constants.ParseMode.MARKDOWN_V2,
+        reply_markup=reply_markup,
+    )
+
+
+async def filter_event(
+    update: Update, context: ContextTypes.DEFAULT_TYPE, fields: dict
+):
+    """Toggle one event type of a secret, an empty list allows every event"""
+    secret = fields["secret"]
+    event = button_event(fields["args"])
+    if event is None:
+        return await reply_func(update)(text=UNKNOWN_EVENT)
+    events = set(secret.events or filters.EVENTS) ^ {event}
+    if events:  # the last allowed event cannot be unticked
+        secret.events = [] if events >= set(filters.EVENTS) else sorted(events)
+        await db.repository.save(secret)
+        await db.repository.invalidate_secret(secret.identity)
+    return await filters_menu(update, context, fields=fields)
+
+
+async def filter_branches(
+    update: Update, context: ContextTypes.DEFAULT_TYPE, fields: dict
+):
+    """Cycle the branch globs of a secret through `filters.BRANCH_PRESETS`"""
+    secret = fields["secret"]
+    secret.branches = list(_next_preset(filters.BRANCH_PRESETS, secret.branches))
+    await db.repository.save(secret)
+    await db.repository.invalidate_secret(secret.identity)
+    return await filters_menu(update, context, fields=fields)
+
+
+async def filter_actions(
+    update: Update, context: ContextTypes.DEFAULT_TYPE, fields: dict
+):
+    """Cycle the action rules of a secret through `filters.ACTION_PRESETS`"""
+    secret = fields["secret"]
+    secret.actions = list(_next_preset(filters.ACTION_PRESETS, secret.actions))
+    await db.repository.save(secret)
+    await db.repository.invalidate_secret(secret.identity)
+    return await filters_menu(update, context, fields=fields)
+
+
+def _next_preset(presets, current):
+    current = tuple(current or ())
+    position = presets.index(current) if current in presets else -1
+    return presets[(position + 1) % len(presets)]
+
+
+async def templates_menu(
+    update: Update, context: ContextTypes.DEFAULT_TYPE, fields: dict
+):
+    """Events of a secret, the ones with a template of their own are marked"""
+    secret, slot = fields["secret"], fields["slot"]
+    custom = secret.templates or {}
+    buttons = [
+        InlineKeyboardButton(
+            f"{'✏️' if event in custom else '▫️'} {event}",
+            callback_data=encode(State.TEMPLATE, slot, event),
+        )
+        for event in filters.EVENTS
+    ]
+    keyboard = [buttons[i : i + 2] for i in range(0, len(buttons), 2)]
+    keyboard += [
+        [
+            InlineKeyboardButton("back", callback_data=encode(State.SECRET, slot)),
+            InlineKeyboardButton("exit", callback_data=encode(State.EXIT)),
+        ],
+    ]
+
+    reply_markup = InlineKeyboardMarkup(keyboard)
+
+    label = ", ".join(sorted(custom)) if custom else "built-in"
+    await reply_func(update=update)(
+        f"Templates: \n {markdown_char_escape(label)}",
+        parse_mode=telegram.constants.ParseMode.MARKDOWN_V2,
+        reply_markup=reply_markup,
+    )
+
+
+async def template_menu(
+    update: Update, context: ContextTypes.DEFAULT_TYPE, fields: dict
+):
+    """Show the template of one event and wait for a new one"""
+    secret, slot = fields["secret"], fields["slot"]
+    event = button_event(fields["args"])
+    if event is None:
+        return await reply_func(update)(text=UNKNOWN_EVENT)
+    source = (secret.templates or {}).get(event)
+    menu_session(context).pending_template = (
+        fields["chat_id"],
+        secret.identity,
+        event,
+    )
+
+    keyboard = []
+    if source is not None:
+        keyboard.append(
+            [
+                InlineKeyboardButton(
+                    "use the built-in template",
+                    callback_data=encode(State.TEMPLATE_RESET, slot, event),
+                )
+            ]
+        )
+    keyboard.append(
+        [
+            InlineKeyboardButton("back", callback_data=encode(State.TEMPLATES, slot)),
+            InlineKeyboardButton("exit", callback_data=encode(State.EXIT)),
+        ]
+    )
+
+    reply_markup = InlineKeyboardMarkup(keyboard)
+
+    current = source or webhook.EVENT_DESCRIPTIONS.get(event, "(built-in formatting)")
+    # plain text, the braces of templates would need escaping in MarkdownV2
+    await reply_func(update=update)(
+        f"Template of {event}:\n\n{current}\n\n\
+Reply with a new template to replace it. Fields of the payload are written \
+like {{sender[login]}} or {{repository[full_name]}}, they are escaped when \
+the message is sent.",
+        reply_markup=reply_markup,
+    )
+
+
+async def template_reset(
+    update: Update, context: ContextTypes.DEFAULT_TYPE, fields: dict
+):
+    """Drop the template of one event, the built-in one is used again"""
+    secret = fields["secret"]
+    event = button_event(fields["args"])
+    if event is None:
+        return await reply_func(update)(text=UNKNOWN_EVENT)
+    if secret.templates and event in secret.templates:
+        del secret.templates[event]
+        await db.repository.save(secret)
+        await db.repository.invalidate_secret(secret.identity)
+    return await templates_menu(update, context, fields=fields)
+
+
+async def template_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Set the template `template_menu` asked for to the text of a message"""
+    session = menu_session(context)
+    fields = extract_message_fields(update=update)
+    if session.pending_template is None:
+        return None
+    chat_id, identity, event = session.pending_template
+    if chat_id != fields["chat_id"]:
+        return None
+
+    source = update.message.text
+    try:
+        templates.compile_template(source)
+    except ValueError as error:
+        return await reply_func(update)(
+            text=f"Invalid template: {error}. Send another one."
+        )
+    secret = await session.get_secret(identity)
+    session.pending_template = None
+    if secret is None:
+        return await reply_func(update)(
+            text="This menu has expired, open it again with /menu."
+        )
+    secret.templates[event] = source
+    try:
+        await db.repository.save(secret)
+    except Exception:
+        session.forget(identity)
+        raise
+    await db.repository.invalidate_secret(identity)
+    fields["secret"] = secret
+    fields["slot"] = session.slot(identity)
+    return await templates_menu(update, context, fields=fields)
+
+
 async def secret_delete(
     update: Update, context: ContextTypes.DEFAULT_TYPE, fields: dict
 ):
-    secret = db.Secret.get(identity=fields["context"][0])
+    secret = fields["secret"]
     identity = secret.identity
     repository = secret.repository
     secret_srt = secret.secret
-    secret.delete()
+    await db.repository.delete(secret)
+    await db.repository.invalidate_secret(identity)
+    menu_session(context).forget(identity)
 
     keyboard = [
         [
-            InlineKeyboardButton("back", callback_data="20356"),
-            InlineKeyboardButton("exit", callback_data="6491"),
+            InlineKeyboardButton("back", callback_data=encode(State.SECRETS)),
+            InlineKeyboardButton("exit", callback_data=encode(State.EXIT)),
         ],
     ]
 
@@ -229,11 +757,23 @@ async def exit(update: Update, context: ContextTypes.DEFAULT_TYPE, fields: dict)
     await reply_func(update)("🌸")
 
 
-state_dict = {
-    "7917": main_menu,
-    "30564": secret,
-    "20356": my_secrets,
-    "20243": secrets_menu,
-    "18787": secret_delete,
-    "6491": exit,
+Transition = collections.namedtuple("Transition", ("handler", "secret"))
+
+# what every button does, `secret` handlers get the secret the button is for
+MENU = {
+    State.MAIN: Transition(main_menu, secret=False),
+    State.NEW_SECRET: Transition(secret, secret=False),
+    State.SECRETS: Transition(my_secrets, secret=False),
+    State.SECRET: Transition(secrets_menu, secret=True),
+    State.DELETE: Transition(secret_delete, secret=True),
+    State.DIGEST: Transition(secret_digest, secret=True),
+    State.TARGET: Transition(secret_target, secret=True),
+    State.FILTERS: Transition(filters_menu, secret=True),
+    State.FILTER_EVENT: Transition(filter_event, secret=True),
+    State.FILTER_BRANCHES: Transition(filter_branches, secret=True),
+    State.FILTER_ACTIONS: Transition(filter_actions, secret=True),
+    State.EXIT: Transition(exit, secret=False),
+    State.TEMPLATES: Transition(templates_menu, secret=True),
+    State.TEMPLATE: Transition(template_menu, secret=True),
+    State.TEMPLATE_RESET: Transition(template_reset, secret=True),
 }
@@ -0,0 +1,96 @@
+import functools
+import logging
+import os
+import re
+
+import webhook
+from formatter import Template
+
+logger = logging.getLogger(__name__)
+
+# longest template a secret may set
+TEMPLATE_MAX_LENGTH = int(os.environ.get("TEMPLATE_MAX_LENGTH", "1024"))
+
+# the only format spec a secret's template may use, a precision cutting a
+# field short: a width or a fill would let one template render megabytes
+_PRECISION = re.compile(r"^\.\d{1,2}$")
+
+
+class Templates(object):
+    """
+    Templates of one secret, compiled once.
+
+    Keys are event types, or `event:action` to only apply to one action.
+    An event without a template of its own keeps the built-in formatting,
+    one with a template no longer uses any built-in one.
+
+    :param overrides: `(key, source)` pairs, sources in `str.format` syntax
+    """
+
+    __slots__ = ("overrides", "_fields", "_by_action")
+
+    def __init__(self, overrides=()):
+        self.overrides = {}
+        for key, source in overrides:
+            try:
+                self.overrides[key] = compile_template(source)
+            except ValueError as error:
+                # saved before the current rules, the built-in one is used
+                logger.warning("Ignoring the %s template: %s", key, error)
+        self._fields = {}  # event type -> field tree
+        # event types with a template for one of their actions
+        self._by_action = {
+            key.partition(":")[0] for key in self.overrides if ":" in key
+        }
+
+    def template(self, event_type, data):
+        """Template rendering this event, None for the built-in formatting"""
+        if event_type not in self._by_action:
+            return self.overrides.get(event_type)
+        action = data.get("action")
+        if isinstance(action, str):
+            template = self.overrides.get(f"{event_type}:{action}")
+            if template is not None:
+                return template
+        return self.overrides.get(event_type)
+
+    def fields(self, event_type) -> dict:
+        """Field tree to parse an event with, the fields templates read included"""
+        tree = self._fields.get(event_type)
+        if tree is None:
+            extra = ()
+            for key, template in self.overrides.items():
+                if key.partition(":")[0] == event_type:
+                    extra += template.paths
+            tree = self._fields[event_type] = webhook.event_fields(event_type, extra)
+        return tree
+
+
+def compile_template(source) -> Template:
+    """
+    Check a template a user sent.
+
+    :raises ValueError: if it is too long, its braces do not match, a field
+        is not a plain `name[key]...` lookup or has a conversion or a format
+        spec other than a precision of at most two digits
+    """
+    if len(source) > TEMPLATE_MAX_LENGTH:
+        raise ValueError(f"templates are {TEMPLATE_MAX_LENGTH} characters at most")
+    template = Template(source)
+    for spec, conversion in template.specs:
+        if conversion:
+            raise ValueError(f"conversions like !{conversion} are not supported")
+        if spec and not _PRECISION.match(spec):
+            raise ValueError(f"unsupported format spec {spec!r}, only :.N is")
+    return template
+
+
+@functools.lru_cache(maxsize=1024)
+def _compile(overrides) -> Templates:
+    return Templates(overrides)
+
+
+def for_secret(secret) -> Templates:
+    """Templates of `secret`, shared by all secrets with the same overrides"""
+    # keyed by content, an edited template is compiled on its first use
+    return _compile(tuple(sorted((secret.templates or {}).items())))
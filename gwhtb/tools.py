@@ -1,24 +1,46 @@
+# characters with a meaning in Telegram's MarkdownV2, the backslash goes first
+# so the escapes added for the other characters are not escaped again
+MARKDOWN_SPECIAL_CHARS = "\\_*[]()~`>#+-=|{}.!"
+
+_MARKDOWN_ESCAPES = tuple((char, "\\" + char) for char in MARKDOWN_SPECIAL_CHARS)
+
+# logins, branches and repository names hold these if anything, a short
+# string without any of the others skips the full pass
+_COMMON_ESCAPES = (("-", "\\-"), (".", "\\."), ("_", "\\_"))
+_RARE_CHARS = frozenset(MARKDOWN_SPECIAL_CHARS) - {"-", ".", "_"}
+_SHORT = 64
+
+# joins fields escaped in one go, it cannot appear in GitHub payload text
+_SEPARATOR = "\x00"
+
+
 def markdown_char_escape(string_to_scape: str) -> str:
-    for char in [
-        "_",
-        "*",
-        "[",
-        "]",
-        "(",
-        ")",
-        "~",
-        "`",
-        ">",
-        "#",
-        "+",
-        "-",
-        "=",
-        "|",
-        "{",
-        "}",
-        ".",
-        "!",
-    ]:
-        string_to_scape = string_to_scape.replace(char, rf"\{char}")
+    if len(string_to_scape) <= _SHORT and _RARE_CHARS.isdisjoint(string_to_scape):
+        for char, escaped in _COMMON_ESCAPES:
+            if char in string_to_scape:
+                string_to_scape = string_to_scape.replace(char, escaped)
+        return string_to_scape
+
+    for char, escaped in _MARKDOWN_ESCAPES:
+        # most fields hold few of these, a membership test is cheaper
+        # than a `replace` call copying nothing
+        if char in string_to_scape:
+            string_to_scape = string_to_scape.replace(char, escaped)
 
     return string_to_scape
+
+
+def markdown_escape_many(strings: list) -> list:
+    """Escape a batch of strings with a single `markdown_char_escape` call"""
+    escaped = markdown_char_escape(_SEPARATOR.join(strings)).split(_SEPARATOR)
+    if len(escaped) != len(strings):
+        return [markdown_char_escape(string) for string in strings]
+    return escaped
+
+
+def retry_after_seconds(error) -> float:
+    """Seconds to wait from a ``telegram.error.RetryAfter``, whatever PTB version raised it"""
+    retry_after = error.retry_after
+    if hasattr(retry_after, "total_seconds"):
+        return retry_after.total_seconds()
+    return float(retry_after)
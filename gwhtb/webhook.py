@@ -1,18 +1,28 @@
 import collections
+import functools
+import os
 import hashlib
 import hmac
 import logging
 import json
+import re
+from urllib.parse import parse_qs
 import six
-from tools import markdown_char_escape as mksc
+
+try:
+    import orjson
+
+    _loads = orjson.loads
+except ImportError:  # pragma: no cover
+    _loads = json.loads
+from tools import markdown_char_escape as mksc, markdown_escape_many
+from formatter import MESSAGE_LIMIT, Template, pack, truncate_escaped
 
 
 class Webhook(object):
     """
-    Construct a webhook on the given :code:`app`.
+    Verifies and decodes GitHub webhook deliveries.
 
-    :param app: Flask app that will host the webhook
-    :param endpoint: the endpoint for the registered URL rule
     :param secret: Optional secret, used to authenticate the hook comes from Github
     """
 
@@ -30,6 +40,8 @@ class Webhook(object):
         if secret is not None and not isinstance(secret, six.binary_type):
             secret = secret.encode("utf-8")
         self._secret = secret
+        # keyed once, every digest starts from a copy of it
+        self._mac = hmac.new(secret, digestmod=hashlib.sha256) if secret else None
 
     def hook(self, event_type="push"):
         """
@@ -47,56 +59,89 @@ class Webhook(object):
 
     def _get_digest(self, data):
         """Return message digest if a secret key was provided"""
-        return hmac.new(self.secret, data, hashlib.sha256).hexdigest()
-
-    def postreceive(self, request):
-        """Callback from Flask"""
-
-        digest = self._get_digest(request.data)
-
-        if digest is not None:
-            sig_parts = _get_header("x-hub-signature-256", request).split("=", 1)
-            if not isinstance(digest, six.text_type):
-                digest = six.text_type(digest)
-
-            if (
-                len(sig_parts) < 2
-                or sig_parts[0] != "sha256"
-                or not hmac.compare_digest(sig_parts[1], digest)
-            ):
-                return None
-
-        event_type = _get_header("X-Github-Event", request)
-        content_type = _get_header("content-type", request)
-        data = (
-            json.loads(request.form.to_dict(flat=True)["payload"])
-            if content_type == "application/x-www-form-urlencoded"
-            else request.get_json()
-        )
+        if self._mac is None:
+            return None
+        mac = self._mac.copy()
+        mac.update(data)
+        return mac.hexdigest()
+
+    def verify(self, headers, body):
+        """Check the `X-Hub-Signature-256` header against the raw body"""
+        if self._mac is None:
+            return True
+
+        # malformed signatures are rejected without hashing the body
+        if not has_signature(headers):
+            return False
+        signature = _get_header("x-hub-signature-256", headers)
+        return hmac.compare_digest(signature[7:], self._get_digest(body))
+
+    def parse(self, headers, body, fields=None):
+        """
+        Parse a verified delivery into the fields of it the bot reads.
+
+        :param fields: field tree to keep, see `event_fields`
+        """
+        event_type = _get_header("X-Github-Event", headers)
+        content_type = _get_header("content-type", headers)
+        try:
+            data = (
+                _loads(parse_qs(body.decode("utf-8"))["payload"][0])
+                if content_type == "application/x-www-form-urlencoded"
+                else _loads(body)
+            )
+        except (KeyError, ValueError):
+            data = None
 
-        if data is None:
+        if not isinstance(data, dict):
             return None
+        # payloads can be megabytes, only their size is logged
+        self._logger.debug("%s payload of %s bytes", event_type, len(body))
+        return extract(event_type, data, fields)
 
-        self._logger.debug(f"event_type: {event_type}")
-        self._logger.debug(f"content_type: {content_type}")
+    def format(self, headers, data, template=None) -> list:
+        """
+        Format a parsed delivery as the messages to send.
+
+        :param template: `formatter.Template` replacing the built-in one
+        """
+        event_type = _get_header("X-Github-Event", headers)
+        messages = format_messages(event_type, data, template)
+
+        self._logger.debug("event_type: %s", event_type)
         self._logger.info(
-            "%s (%s)",
-            _format_event(event_type, data),
-            _get_header("X-Github-Delivery", request),
+            "%s (%s, %s messages)",
+            messages[0],
+            _get_header("X-Github-Delivery", headers),
+            len(messages),
         )
-        self._logger.debug(f"Payload:\n {data}")
 
         # for hook in self._hooks.get(event_type, []):
         #     hook(data)
 
-        return data, _format_event(event_type, data)
+        return messages
+
+
+_SIGNATURE = re.compile(r"sha256=[0-9a-f]{64}")
+
+
+def has_signature(headers) -> bool:
+    """Whether the delivery carries a well-formed `X-Hub-Signature-256`"""
+    signature = _get_header("x-hub-signature-256", headers)
+    return signature is not None and _SIGNATURE.fullmatch(signature) is not None
+
 
+@functools.lru_cache(maxsize=1024)
+def for_secret(secret) -> "Webhook":
+    """`Webhook` for `secret`, kept so its HMAC key is only set up once"""
+    return Webhook(secret=secret)
 
-def _get_header(key, request):
+
+def _get_header(key, headers):
     """Return message header"""
 
     try:
-        return request.headers[key]
+        return headers[key]
     except KeyError:
         return None
 
@@ -110,7 +155,7 @@ EVENT_DESCRIPTIONS = {
     "{repository[full_name]}",
     "deployment": "{sender[login]} deployed {deployment[ref]} to "
     "{deployment[environment]} in {repository[full_name]}",
-    "deployment_status": "deployment of {deployement[ref]} to "
+    "deployment_status": "deployment of {deployment[ref]} to "
     "{deployment[environment]} "
     "{deployment_status[state]} in "
     "{repository[full_name]}",
@@ -143,31 +188,250 @@ EVENT_DESCRIPTIONS = {
     "team_add": "{sender[login]} added repository {repository[full_name]} to "
     "team {team[name]}",
     "watch": "{sender[login]} {action} watch in repository " "{repository[full_name]}",
+    "check_run": "check {check_run[name]} {action} on "
+    "{check_run[head_sha]:.7} in {repository[full_name]}",
+    "check_suite": "check suite on {check_suite[head_branch]} {action} in "
+    "{repository[full_name]}",
+    "workflow_run": "workflow {workflow_run[name]} #{workflow_run[run_number]} "
+    "{action} on {workflow_run[head_branch]} in {repository[full_name]}",
+    "workflow_job": "job {workflow_job[name]} of {workflow_job[workflow_name]} "
+    "{action} in {repository[full_name]}",
+    "discussion": "{sender[login]} {action} discussion #{discussion[number]} "
+    "{discussion[title]} in {repository[full_name]}",
+    "discussion_comment": "{comment[user][login]} {action} comment on "
+    "discussion #{discussion[number]} in {repository[full_name]}",
+}
+
+# templates of a single action, used instead of the one of the event
+ACTION_DESCRIPTIONS = {
+    "check_run:completed": "check {check_run[name]} {check_run[conclusion]} on "
+    "{check_run[head_sha]:.7} in {repository[full_name]}",
+    "check_suite:completed": "check suite on {check_suite[head_branch]} "
+    "{check_suite[conclusion]} in {repository[full_name]}",
+    "workflow_run:completed": "workflow {workflow_run[name]} "
+    "#{workflow_run[run_number]} {workflow_run[conclusion]} on "
+    "{workflow_run[head_branch]} in {repository[full_name]}",
+    "workflow_job:completed": "job {workflow_job[name]} of "
+    "{workflow_job[workflow_name]} {workflow_job[conclusion]} in "
+    "{repository[full_name]}",
+}
+
+
+# commits listed for a push, the rest are summed up with a compare link
+PUSH_MAX_COMMITS = int(os.environ.get("PUSH_MAX_COMMITS", "20"))
+# escaped characters kept of a single commit message
+COMMIT_MESSAGE_LIMIT = 1024
+
+
+def _push_blocks(data, max_commits=PUSH_MAX_COMMITS):
+    """Yield the header of a push, then one block per listed commit"""
+    repository = data["repository"]
+    head_commit = data["head_commit"]
+    yield (
+        f"In repo:\n"
+        f"[{mksc(repository['full_name'])}]({mksc(repository['html_url'])}) \n"
+        f"[{mksc(head_commit['committer']['name'])}]"
+        f"({mksc(data['sender']['html_url'])}) "
+        f"*pushed* [{mksc(data['ref'])}]({mksc(head_commit['url'])})"
+    )
+
+    commits = data["commits"]
+    listed = commits[:max_commits]
+    for message in markdown_escape_many([commit["message"] for commit in listed]):
+        message = truncate_escaped(message, COMMIT_MESSAGE_LIMIT)
+        yield f"_*commit message*_: \n`{message}`"
+
+    # GitHub lists at most 20 commits, `size` is the real count
+    more = max(data.get("size") or 0, len(commits)) - len(listed)
+    if more > 0:
+        link = f" [compare]({mksc(data['compare'])})" if data.get("compare") else ""
+        yield f"_and {more} more commits_{link}"
+
+
+FUNC_EVENT_BLOCKS = {
+    "push": _push_blocks,
 }
 
 FUNC_EVENT_FORMATS = {
-    "push": (
-        lambda data: f"In repo:\n\
-[{mksc(data['repository']['full_name'])}]({mksc(data['repository']['html_url'])}) \n\
-[{mksc(data['head_commit']['committer']['name'])}]({mksc(data['sender']['html_url'])}) \
-*pushed* [{mksc(data['ref'])}]({mksc(data['head_commit']['url'])})\n\n"
-        + "\n\n".join(
-            [
-                f"_*commit message*_: \n`{mksc(commit['message'])}`"
-                for commit in data["commits"]
-            ]
-        )
-    ),
+    "push": lambda data: "\n\n".join(_push_blocks(data)),
+}
+
+# templates are parsed once, rendering only looks fields up and escapes them
+COMPILED_DESCRIPTIONS = {
+    key: Template(description)
+    for key, description in {**EVENT_DESCRIPTIONS, **ACTION_DESCRIPTIONS}.items()
+}
+_ACTION_EVENTS = frozenset(key.partition(":")[0] for key in ACTION_DESCRIPTIONS)
+
+
+# fields kept of every payload, besides those its formatter reads
+COMMON_FIELDS = (
+    ("repository", "full_name"),
+    ("repository", "html_url"),
+    # read by the subscription rules in filters.py
+    ("action",),
+    ("ref",),
+    ("pull_request", "base", "ref"),
+)
+
+PUSH_FIELDS = (
+    ("ref",),
+    ("size",),
+    ("compare",),
+    ("sender", "html_url"),
+    ("head_commit", "committer", "name"),
+    ("head_commit", "url"),
+    ("commits", "message"),
+)
+
+
+# events about one evolving object, keyed by the fields naming it. Later
+# events edit the message of the first one in place, or reply to it. Only
+# `edit` events start a thread, a `reply` one without a message to answer
+# is sent on its own.
+THREADS = {
+    "pull_request": ("edit", "pr", (("pull_request", "number"),)),
+    "pull_request_review": ("reply", "pr", (("pull_request", "number"),)),
+    "pull_request_review_comment": ("reply", "pr", (("pull_request", "number"),)),
+    "deployment": ("edit", "deployment", (("deployment", "id"),)),
+    "deployment_status": ("edit", "deployment", (("deployment", "id"),)),
+    "status": ("edit", "status", (("sha",), ("context",))),
 }
 
 
-def _format_event(event_type, data):
+def _field_tree(paths) -> dict:
+    """`[("a", "b"), ("a", "c")]` -> `{"a": {"b": None, "c": None}}`"""
+    tree = {}
+    for path in paths:
+        node = tree
+        for key in path[:-1]:
+            child = node.setdefault(key, {})
+            if child is None:  # the whole value is kept already
+                break
+            node = child
+        else:
+            node[path[-1]] = None
+    return tree
+
+
+def _thread_paths(event_type) -> tuple:
+    return THREADS[event_type][2] if event_type in THREADS else ()
+
+
+def event_paths(event_type) -> tuple:
+    """Field paths the built-in formatting and the routes read of an event"""
+    if event_type in FUNC_EVENT_FORMATS:
+        return PUSH_FIELDS + COMMON_FIELDS
+    paths = COMMON_FIELDS + _thread_paths(event_type)
+    for key, template in COMPILED_DESCRIPTIONS.items():
+        if key.partition(":")[0] == event_type:
+            paths += template.paths
+    return paths
+
+
+EVENT_FIELDS = {
+    event_type: _field_tree(event_paths(event_type))
+    for event_type in set(EVENT_DESCRIPTIONS) | set(FUNC_EVENT_FORMATS)
+}
+DEFAULT_FIELDS = _field_tree(COMMON_FIELDS)
+
+
+def event_fields(event_type, extra=()) -> dict:
+    """
+    Field tree `extract` keeps of an event.
+
+    :param extra: paths read besides the built-in ones, e.g. by a template
+        of a secret
+    """
+    if not extra:
+        return EVENT_FIELDS.get(event_type, DEFAULT_FIELDS)
+    return _field_tree(event_paths(event_type) + tuple(extra))
+
+
+def _pick(source, tree) -> dict:
+    picked = {}
+    for key, subtree in tree.items():
+        if key not in source:
+            continue
+        value = source[key]
+        if subtree is not None:
+            if type(value) is dict:
+                value = _pick(value, subtree)
+            elif type(value) is list:
+                value = [
+                    _pick(item, subtree) if type(item) is dict else item
+                    for item in value
+                ]
+        picked[key] = value
+    return picked
+
+
+def extract(event_type, data, fields=None) -> dict:
+    """Keep only the fields of a payload its formatter and the routes read"""
+    if fields is None:
+        fields = EVENT_FIELDS.get(event_type, DEFAULT_FIELDS)
+    return _pick(data, fields)
+
+
+def thread(event_type, data):
+    """
+    `(mode, key)` of the message thread an event belongs to, `mode` is
+    `edit` or `reply`. None if the event stands on its own.
+    """
+    spec = THREADS.get(event_type)
+    if spec is None:
+        return None
+    mode, kind, paths = spec
+    parts = [kind]
     try:
-        if event_type in EVENT_DESCRIPTIONS.keys():
-            return EVENT_DESCRIPTIONS[event_type].format(**data)
+        parts.append(data["repository"]["full_name"])
+        for path in paths:
+            value = data
+            for key in path:
+                value = value[key]
+            parts.append(str(value))
+    except (KeyError, IndexError, TypeError):
+        return None
+    return mode, ":".join(parts)
+
+
+def builtin_template(event_type, data):
+    """Built-in template of an event, the one of its action first"""
+    if event_type in _ACTION_EVENTS:
+        template = COMPILED_DESCRIPTIONS.get(f"{event_type}:{data.get('action')}")
+        if template is not None:
+            return template
+    return COMPILED_DESCRIPTIONS.get(event_type)
+
+
+def _format_event(event_type, data, template=None):
+    try:
+        if template is None:
+            template = builtin_template(event_type, data)
+        if template is not None:
+            return template.render(data)
         return FUNC_EVENT_FORMATS[event_type](data)
-    except KeyError:
-        return event_type
+    except (KeyError, IndexError, TypeError, ValueError):
+        # ValueError: a format spec of a secret's template not fitting a value
+        return mksc(str(event_type))
+
+
+def format_messages(event_type, data, template=None) -> list:
+    """
+    Format an event as the messages to send, each within Telegram's limit.
+
+    :param template: `formatter.Template` replacing the built-in formatting
+    """
+    if template is not None or event_type not in FUNC_EVENT_BLOCKS:
+        formatted = _format_event(event_type, data, template)
+        # even if every character took two UTF-16 units it would fit
+        if len(formatted) <= MESSAGE_LIMIT // 2:
+            return [formatted]
+        return pack([formatted])
+    try:
+        return pack(FUNC_EVENT_BLOCKS[event_type](data))
+    except (KeyError, IndexError, TypeError):
+        return [mksc(str(event_type))]
 
 
 # -----------------------------------------------------------------------------
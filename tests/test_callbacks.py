@@ -0,0 +1,47 @@
+import base64
+
+import pytest
+from bson import ObjectId
+
+from callbacks import MAX_CALLBACK_DATA, State, decode, encode
+
+
+def test_round_trip():
+    oid = ObjectId()
+    data = encode(State.FILTER_EVENT, 300, oid, "pull_request")
+    assert len(data) <= MAX_CALLBACK_DATA
+    assert decode(data) == (State.FILTER_EVENT, [300, oid, "pull_request"])
+
+
+def test_state_without_arguments():
+    assert decode(encode(State.MAIN)) == (State.MAIN, [])
+
+
+def test_legacy_numeric_states():
+    assert decode("20243-abc") == (State.SECRET, ["abc"])
+    assert decode("7917") == (State.MAIN, [])
+    # only the states of the keyboards sent before the encoding are known
+    with pytest.raises(ValueError):
+        decode("14035-abc-3")
+
+
+def raw(*bytes_):
+    return base64.urlsafe_b64encode(bytes(bytes_)).rstrip(b"=").decode()
+
+
+@pytest.mark.parametrize(
+    "data",
+    [
+        "",
+        "zz!",
+        raw(200),  # no such state
+        raw(State.SECRET, 0, 1, 2),  # truncated object id
+        raw(State.SECRET, 1, 0x80),  # truncated varint
+        raw(State.TEMPLATE, 2, 5, ord("a")),  # truncated string
+        raw(State.TEMPLATE, 2, 1, 0xFF),  # not UTF-8
+        raw(State.SECRET, 9),  # unknown tag
+    ],
+)
+def test_rejects_data_it_did_not_produce(data):
+    with pytest.raises(ValueError):
+        decode(data)
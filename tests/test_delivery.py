@@ -0,0 +1,61 @@
+import asyncio
+from datetime import datetime, timedelta
+
+import mongoengine
+import pytest
+
+import db
+import delivery
+
+mongomock = pytest.importorskip("mongomock")
+
+
+@pytest.fixture
+def backend():
+    mongoengine.connect(
+        db="tests",
+        alias="core",
+        host="mongodb://localhost",
+        mongo_client_class=mongomock.MongoClient,
+    )
+    yield delivery.MongoBackend(queue="tests", lease=60)
+    db.Delivery.objects(queue="tests").delete()
+    mongoengine.disconnect(alias="core")
+
+
+def expire(job_id):
+    db.Delivery.objects(id=job_id).update_one(
+        set__locked_until=datetime.utcnow() - timedelta(seconds=1)
+    )
+
+
+def test_claim_takes_a_job_once(backend):
+    job_id = backend.put({"n": 1})
+    job = backend.claim()
+    assert job.id == job_id and job.attempts == 0
+    assert backend.claim() is None
+
+
+def test_reclaiming_an_expired_lease_counts_as_an_attempt(backend):
+    job_id = backend.put({"n": 1})
+    backend.claim()
+    expire(job_id)
+    job = backend.claim()
+    assert job.id == job_id and job.attempts == 1
+
+
+def test_job_that_keeps_losing_its_lease_is_buried(backend):
+    job_id = backend.put({"n": 1})
+    handled = []
+
+    async def handler(payload):
+        handled.append(payload)
+
+    queue = delivery.DeliveryQueue(backend, handler, max_attempts=3)
+    for _ in range(3):
+        backend.claim()
+        expire(job_id)
+    asyncio.run(queue._process(backend.claim()))
+
+    assert not handled
+    assert db.Delivery.objects(id=job_id).get().status == "dead"
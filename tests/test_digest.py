@@ -0,0 +1,94 @@
+import asyncio
+
+import digest
+
+
+def push(ref="refs/heads/main", messages=("fix",), size=None):
+    return {
+        "ref": ref,
+        "size": len(messages) if size is None else size,
+        "compare": "https://github.com/o/r/compare/a...b",
+        "repository": {"full_name": "o/r", "html_url": "https://github.com/o/r"},
+        "sender": {"html_url": "https://github.com/u"},
+        "head_commit": {"committer": {"name": "u"}, "url": "https://github.com/c"},
+        "commits": [{"message": message} for message in messages],
+    }
+
+
+def deletion(ref="refs/heads/main"):
+    data = push(ref, messages=())
+    data["head_commit"] = None
+    data["deleted"] = True
+    return data
+
+
+def test_merges_consecutive_pushes_to_the_same_ref():
+    texts = digest.merge(
+        [
+            ("push", push(messages=("one",)), ["first"]),
+            ("push", push(messages=("two",)), ["second"]),
+        ]
+    )
+    assert len(texts) == 1
+    assert texts[0].count("*pushed*") == 1
+    assert "`one`" in texts[0] and "`two`" in texts[0]
+    assert "first" not in texts[0]
+
+
+def test_other_refs_and_events_keep_their_messages():
+    texts = digest.merge(
+        [
+            ("push", push(messages=("one",)), ["first"]),
+            ("issues", {"action": "opened"}, ["issue opened"]),
+            ("push", push(ref="refs/heads/dev", messages=("two",)), ["second"]),
+        ]
+    )
+    assert texts[0].count("*pushed*") == 2
+    assert "issue opened" in texts[0]
+
+
+def test_branch_deletion_keeps_its_messages():
+    texts = digest.merge(
+        [
+            ("push", push(), ["pushed"]),
+            ("push", deletion(), ["deleted main"]),
+            ("push", push(messages=("after",)), ["pushed again"]),
+        ]
+    )
+    assert "deleted main" in texts[0]
+    assert "`after`" in texts[0]
+
+
+def test_push_missing_fields_falls_back_to_its_messages():
+    broken = push()
+    del broken["head_commit"]["committer"]
+    texts = digest.merge([("push", broken, ["as sent alone"])])
+    assert "as sent alone" in texts[0]
+    assert "*pushed*" not in texts[0]
+
+
+class Outbox(object):
+    def __init__(self):
+        self.payloads = []
+
+    async def put(self, payload):
+        self.payloads.append(payload)
+
+
+def test_flush_sends_the_buffered_messages_if_merging_fails(monkeypatch):
+    def fail(events):
+        raise RuntimeError("boom")
+
+    monkeypatch.setattr(digest, "merge", fail)
+
+    async def run():
+        outbox = Outbox()
+        buffer = digest.Digest(outbox)
+        await buffer.start()
+        buffer._add(("1", None), 60, 10, "issues", {}, ["one"])
+        buffer._add(("1", None), 60, 10, "issues", {}, ["two"])
+        await buffer.stop()
+        return outbox.payloads
+
+    payloads = asyncio.run(run())
+    assert payloads == [{"chat_id": "1", "thread_id": None, "texts": ["one\n\ntwo"]}]
@@ -0,0 +1,41 @@
+from filters import Matcher
+
+
+def test_empty_rules_let_everything_through():
+    matcher = Matcher()
+    assert matcher.accepts_event("push")
+    assert matcher.accepts("push", {"ref": "refs/heads/anything"})
+
+
+def test_events():
+    matcher = Matcher(events=["issues"])
+    assert matcher.accepts_event("issues")
+    assert not matcher.accepts_event("push")
+    # confirms the hook was set up, whatever the rules
+    assert matcher.accepts_event("ping")
+
+
+def test_branches():
+    matcher = Matcher(branches=["main", "release/*"])
+    assert matcher.accepts("push", {"ref": "refs/heads/main"})
+    assert matcher.accepts("push", {"ref": "refs/heads/release/1.0"})
+    assert not matcher.accepts("push", {"ref": "refs/heads/mainline"})
+    assert not matcher.accepts("push", {"ref": "refs/tags/v1"})
+    # events without a ref are not about a branch
+    assert matcher.accepts("issues", {"action": "opened"})
+
+
+def test_pull_requests_match_their_base_branch():
+    matcher = Matcher(branches=["main"])
+    assert matcher.accepts("pull_request", {"pull_request": {"base": {"ref": "main"}}})
+    assert not matcher.accepts(
+        "pull_request", {"pull_request": {"base": {"ref": "dev"}}}
+    )
+
+
+def test_actions_only_restrict_the_listed_events():
+    matcher = Matcher(actions=["pull_request:opened", "issues:closed"])
+    assert matcher.accepts("pull_request", {"action": "opened"})
+    assert not matcher.accepts("pull_request", {"action": "closed"})
+    assert matcher.accepts("issues", {"action": "closed"})
+    assert matcher.accepts("release", {"action": "published"})
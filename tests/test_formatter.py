@@ -0,0 +1,29 @@
+from formatter import message_length, pack
+
+
+def test_joins_blocks_into_one_message():
+    assert pack(["a", "b", "c"]) == ["a\n\nb\n\nc"]
+
+
+def test_never_splits_a_block():
+    blocks = ["x" * 30, "y" * 30, "z" * 30]
+    assert pack(blocks, limit=70) == ["x" * 30 + "\n\n" + "y" * 30, "z" * 30]
+
+
+def test_cuts_a_block_over_the_limit():
+    messages = pack(["a", "b" * 100], limit=20)
+    assert messages[0] == "a"
+    assert len(messages[1]) == 20 and messages[1].endswith("…")
+
+
+def test_cut_keeps_escapes_whole():
+    for limit in (10, 11):
+        [message] = pack(["\\." * 50], limit=limit)
+        cut = message[:-1]
+        assert len(message) <= limit
+        assert (len(cut) - len(cut.rstrip("\\"))) % 2 == 0
+
+
+def test_counts_utf16_code_units():
+    assert message_length("😀") == 2
+    assert pack(["😀" * 3, "😀" * 3], limit=13) == ["😀" * 3, "😀" * 3]